@@ -11,29 +11,191 @@
 # of the License, or (at your option) any later version.
 # See http://www.gnu.org/licenses/gpl-2.0.html for full license text.
 
-import argparse
-import datetime
+# Only modules needed by every invocation are imported here, everything
+# else is imported by the functions using it to keep startup fast.
+import atexit
+import fcntl
+import fnmatch
+import glob
+import itertools
+import logging
 import os
-import shutil
 import re
-import fnmatch
+import shutil
+import stat
 import sys
-import tarfile
-import subprocess
-import atexit
-import hashlib
-import tempfile
-import logging
-import glob
-import ConfigParser
-import StringIO
-from urlparse import urlparse
+import threading
+import time
+
+
+class Trace(object):
+    '''Records the commands run and the steps of invocations as events in
+    the Chrome trace event format, which trace viewers like chrome://tracing
+    or Perfetto display as one track per invocation and thread. Nothing is
+    recorded until enable() is called.'''
+
+    def __init__(self):
+        self.events = None
+        self.pid = None
+        self.threads = set()
+        self.filenames = []
+
+    def enable(self, pid, name):
+        '''Record events on the track pid, labelled name.'''
+
+        self.events = []
+        self.pid = pid
+        self.threads = set()
+        self.events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                            'args': {'name': name}})
+
+    def complete_events(self, name, cat, start, **args):
+        '''Return the events telling that name, of category cat, ran from
+        start until now in the current thread, without recording them. args
+        are shown with the event.'''
+
+        if self.events is None:
+            return []
+
+        events = []
+        end = time.time()
+        thread = threading.current_thread()
+        if thread.ident not in self.threads:
+            self.threads.add(thread.ident)
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': self.pid, 'tid': thread.ident,
+                           'args': {'name': thread.name}})
+        events.append({'name': name, 'cat': cat, 'ph': 'X',
+                       'ts': int(start * 1000000),
+                       'dur': int((end - start) * 1000000),
+                       'pid': self.pid, 'tid': thread.ident, 'args': args})
+        return events
+
+    def complete(self, name, cat, start, **args):
+        '''Record that name, of category cat, ran from start until now in
+        the current thread. args are shown with the event.'''
+
+        if self.events is not None:
+            self.events.extend(self.complete_events(name, cat, start, **args))
+
+    def flush(self):
+        '''Append the events recorded to the trace files.'''
+
+        for filename in self.filenames:
+            write_trace(filename, self.events or [])
+        self.filenames = []
+
+
+def write_trace(filename, events):
+    '''Append the trace events to the file filename. Its JSON array is left
+    open, as allowed by the trace event format, so events of further
+    invocations can be appended.'''
+
+    import json
+
+    data = ''.join([json.dumps(event) + ',\n' for event in events])
+    trace_fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    try:
+        # several invocations may write to it
+        fcntl.flock(trace_fd, fcntl.LOCK_EX)
+        if os.fstat(trace_fd).st_size == 0:
+            data = '[\n' + data
+        while data:
+            data = data[os.write(trace_fd, data):]
+    finally:
+        os.close(trace_fd)
+
+
+TRACE = Trace()
+
+# the commands currently running, see terminate_commands()
+RUNNING_COMMANDS = set()
+# whether terminate_commands() was called, the commands fail then
+TERMINATING = False
+
+
+def _proc_stat(pid):
+    '''Return the state and parent PID of process pid as told by /proc, or
+    None if it's gone.'''
+
+    try:
+        stat_fp = open('/proc/%s/stat' % pid)
+        try:
+            data = stat_fp.read()
+        finally:
+            stat_fp.close()
+    except IOError:
+        return None
+    # the command name in parentheses may contain anything
+    fields = data[data.rindex(')') + 2:].split()
+    return fields[0], int(fields[1])
+
+
+def _descendants(pid):
+    '''Return the PIDs of the processes below process pid, on systems with
+    a /proc file system.'''
+
+    children = {}
+    if os.path.isdir('/proc'):
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat_res = _proc_stat(name)
+                if stat_res:
+                    children.setdefault(stat_res[1], []).append(int(name))
+
+    pids = []
+    parents = [pid]
+    while parents:
+        found = children.get(parents.pop(), [])
+        pids.extend(found)
+        parents.extend(found)
+    return pids
+
+
+def terminate_commands():
+    '''Terminate the commands still running and the processes they started,
+    e.g. the remote helpers of git, and wait for them to exit, so the
+    directories they write to can be removed.'''
+
+    import signal
+
+    global TERMINATING
+    TERMINATING = True
+
+    procs = list(RUNNING_COMMANDS)
+    # found before they are orphaned by terminating their parents
+    pids = []
+    for proc in procs:
+        pids.extend(_descendants(proc.pid))
+    for proc in procs:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    for proc in procs:
+        proc.wait()
+    # zombies are fine, they don't write anymore
+    deadline = time.time() + 10
+    for pid in pids:
+        while time.time() < deadline:
+            stat_res = _proc_stat(pid)
+            if stat_res is None or stat_res[0] == 'Z':
+                break
+            time.sleep(0.01)
 
 
 def safe_run(cmd, cwd, interactive=False):
     """Execute the command cmd in the working directory cwd and check return
     value. If the command returns non-zero raise a SystemExit exception."""
 
+    import subprocess
+
     logging.debug("COMMAND: %s", cmd)
 
     # Ensure we get predictable results when parsing the output of commands
@@ -41,22 +203,29 @@ def safe_run(cmd, cwd, interactive=False):
     env = os.environ.copy()
     env['LANG'] = 'C'
 
+    start = time.time()
     proc = subprocess.Popen(cmd,
                             shell=False,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
                             cwd=cwd,
                             env=env)
+    RUNNING_COMMANDS.add(proc)
     output = ''
-    if interactive:
-        stdout_lines = []
-        while proc.poll() is None:
-            for line in proc.stdout:
-                print line.rstrip()
-                stdout_lines.append(line.rstrip())
-        output = '\n'.join(stdout_lines)
-    else:
-        output = proc.communicate()[0]
+    try:
+        if interactive:
+            stdout_lines = []
+            while proc.poll() is None:
+                for line in proc.stdout:
+                    print line.rstrip()
+                    stdout_lines.append(line.rstrip())
+            output = '\n'.join(stdout_lines)
+        else:
+            output = proc.communicate()[0]
+    finally:
+        RUNNING_COMMANDS.discard(proc)
+    TRACE.complete(' '.join(cmd[:2]), 'command', start, cmd=cmd, cwd=cwd,
+                   status=proc.returncode, output=len(output))
 
     if proc.returncode:
         logging.info("ERROR(%d): %s", proc.returncode, repr(output))
@@ -66,39 +235,484 @@ def safe_run(cmd, cwd, interactive=False):
     return (proc.returncode, output)
 
 
+def run_lines(cmd, cwd):
+    """Execute the command cmd in the working directory cwd and lazily yield
+    its output line by line. Closing the iterator early terminates the command.
+    If the command returns non-zero raise a SystemExit exception."""
+
+    import subprocess
+    import tempfile
+
+    logging.debug("COMMAND: %s", cmd)
+
+    env = os.environ.copy()
+    env['LANG'] = 'C'
+
+    # Errors go to a file: a pipe only read after the output would block
+    # commands writing lots of warnings.
+    errors_fp = tempfile.TemporaryFile()
+    start = time.time()
+    proc = subprocess.Popen(cmd,
+                            shell=False,
+                            stdout=subprocess.PIPE,
+                            stderr=errors_fp,
+                            cwd=cwd,
+                            env=env)
+    RUNNING_COMMANDS.add(proc)
+    finished = False
+    size = 0
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            size += len(line)
+            yield line.rstrip('\n')
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+            proc.wait()
+            RUNNING_COMMANDS.discard(proc)
+            proc.stdout.close()
+            errors_fp.close()
+            TRACE.complete(' '.join(cmd[:2]), 'command', start, cmd=cmd,
+                           cwd=cwd, status=proc.returncode, output=size)
+
+    proc.wait()
+    RUNNING_COMMANDS.discard(proc)
+    proc.stdout.close()
+    errors_fp.seek(0, os.SEEK_SET)
+    errors = errors_fp.read()
+    errors_fp.close()
+    TRACE.complete(' '.join(cmd[:2]), 'command', start, cmd=cmd, cwd=cwd,
+                   status=proc.returncode, output=size + len(errors))
+    if proc.returncode:
+        logging.info("ERROR(%d): %s", proc.returncode, repr(errors))
+        sys.exit("Command failed(%d): %s" % (proc.returncode, repr(errors)))
+
+
+class OutputFile(object):
+    '''A file object writing to a temporary file in the directory of dst.
+    commit() atomically replaces dst with it, abort() removes it.
+
+    durability selects what is synced to disk before commit() returns:
+    'none' leaves it to the kernel, 'file' syncs the contents and 'dir'
+    additionally syncs the directory holding the new name.'''
+
+    durability = 'none'
+
+    def __init__(self, dst, bufsize=-1):
+        self.dst = dst
+        self.name = os.path.join(os.path.dirname(dst), '.%s.%s' % (
+            os.path.basename(dst), os.urandom(4).encode('hex')))
+        fd = os.open(self.name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        self.fp = os.fdopen(fd, 'wb', bufsize)
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def commit(self):
+        self.fp.flush()
+        if self.durability != 'none':
+            os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.rename(self.name, self.dst)
+        self.name = None
+        if self.durability == 'dir':
+            dir_fd = os.open(os.path.dirname(self.dst) or '.', os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def abort(self):
+        if self.name:
+            self.fp.close()
+            os.unlink(self.name)
+            self.name = None
+
+
+# Options of every git command fetching into a clone. A "git gc --auto"
+# triggered by the fetch would run under the cache lock, and clones
+# created by older versions don't have auto-gc disabled in their config.
+# Cached clones are repacked by --maintain-cache instead.
+GIT_FETCH_CONFIG = ['-c', 'gc.auto=0']
+
+
+def _git_mirror_config(url, clone_dir, kwargs):
+    """Return the git options which redirect fetching from url and the
+    submodules of the repository in clone_dir to their mirrors. The
+    repository configuration keeps referring to the upstream URLs."""
+
+    if not kwargs.get('mirror'):
+        return []
+
+    rewrites = {url: kwargs['mirror']}
+    gitmodules = os.path.join(clone_dir, '.gitmodules')
+    if os.path.isfile(gitmodules):
+        output = safe_run(['git', 'config', '--file', gitmodules, '--list'],
+                          cwd=clone_dir)[1]
+        for line in output.splitlines():
+            key, _, submodule_url = line.partition('=')
+            if re.match(r'^submodule\..*\.url$', key):
+                mirror = rewrite_url(submodule_url, kwargs['url_rewrites'])
+                if mirror:
+                    rewrites[submodule_url] = mirror
+
+    # prefix rules also cover nested submodules
+    for pattern, replacement in kwargs['url_rewrites']:
+        if not pattern.startswith('re:'):
+            rewrites[pattern] = replacement
+
+    config = []
+    for upstream, mirror in sorted(rewrites.items()):
+        config.extend(['-c', 'url.%s.insteadOf=%s' % (mirror, upstream)])
+    return config
+
+
+def _git_submodules(clone_dir):
+    """Return (name, path, commit) for each submodule of the GIT repository
+    in clone_dir, taking the commit from the index."""
+
+    if not os.path.exists(os.path.join(clone_dir, '.gitmodules')):
+        return []
+    try:
+        config = safe_run(['git', 'config', '--file', '.gitmodules',
+                           '--get-regexp', r'^submodule\..*\.path$'],
+                          cwd=clone_dir)[1]
+    except SystemExit:
+        return []
+    names = {}
+    for line in config.splitlines():
+        key, _, path = line.partition(' ')
+        names[path] = key[len('submodule.'):-len('.path')]
+    if not names:
+        return []
+
+    submodules = []
+    for line in safe_run(['git', 'ls-files', '--stage', '--'] +
+                         sorted(names), cwd=clone_dir)[1].splitlines():
+        info, _, path = line.partition('\t')
+        mode, commit = info.split()[:2]
+        if mode == '160000' and path in names:
+            submodules.append((names[path], path, commit))
+    return submodules
+
+
+def _update_submodules_git(url, clone_dir, kwargs, init=False):
+    """Update the submodules of the GIT repository in clone_dir, preferring
+    their mirrors. Only submodules whose commit changed since the last
+    update or whose checkout is missing are updated, in parallel."""
+
+    from multiprocessing.pool import ThreadPool
+
+    # commits of the submodules at the last update
+    statefile = os.path.join(clone_dir, '.git', 'tar_scm_submodules')
+    recorded = {}
+    if os.path.exists(statefile):
+        for line in open(statefile):
+            commit, _, path = line.rstrip('\n').partition(' ')
+            recorded[path] = commit
+
+    submodules = _git_submodules(clone_dir)
+    paths = []
+    for name, path, commit in submodules:
+        if not init and not os.path.isdir(
+                os.path.join(clone_dir, '.git', 'modules', name)):
+            # only initialized submodules are updated
+            continue
+        if recorded.get(path) != commit or \
+                not os.path.exists(os.path.join(clone_dir, path, '.git')):
+            paths.append(path)
+    if not paths:
+        logging.debug("Submodules unchanged")
+        return
+
+    config = _git_mirror_config(url, clone_dir, kwargs)
+
+    def update(command):
+        '''Run a submodule command, returning SystemExit on failure.'''
+
+        try:
+            if config:
+                try:
+                    safe_run(['git'] + GIT_FETCH_CONFIG + config + command,
+                             cwd=clone_dir)
+                    return
+                except SystemExit:
+                    logging.warning("Updating submodules from mirrors "
+                                    "failed, falling back to upstream")
+            safe_run(['git'] + GIT_FETCH_CONFIG + command, cwd=clone_dir)
+        except SystemExit, e:
+            return e
+
+    # registering the submodules writes .git/config, so it can't be done
+    # in parallel
+    if init:
+        error = update(['submodule', 'init', '--'] + paths)
+        if error:
+            raise error
+
+    pool = ThreadPool(kwargs.get('jobs') or 1)
+    try:
+        errors = pool.map(lambda path: update(['submodule', 'update',
+                                               '--recursive', '--', path]),
+                          paths)
+    finally:
+        pool.close()
+        pool.join()
+    for error in errors:
+        if error:
+            raise error
+
+    state = OutputFile(statefile)
+    try:
+        for name, path, commit in submodules:
+            state.write("%s %s\n" % (commit, path))
+        state.commit()
+    finally:
+        state.abort()
+
+
+def _git_refspecs(revision):
+    """Return the alternative refspecs revision may refer to, see
+    switch_revision_git(), in the order they are tried."""
+
+    if revision is None:
+        revision = 'master'
+
+    if revision.startswith('refs/'):
+        return ['+%s:%s' % (revision, revision)]
+    refspecs = ['+refs/heads/%s:refs/remotes/origin/%s' % (revision, revision),
+                '+refs/tags/%s:refs/tags/%s' % (revision, revision)]
+    if re.match('^[0-9a-f]{40}$', revision):
+        refspecs.insert(0, revision)
+    return refspecs
+
+
+def _git_has_commit(clone_dir, rev):
+    """Tell whether the commit rev is in the GIT repository clone_dir."""
+
+    try:
+        safe_run(['git', 'cat-file', '-e', rev + '^{commit}'], cwd=clone_dir)
+    except SystemExit:
+        return False
+    return True
+
+
+def _fetch_targeted_git(url, clone_dir, revision, kwargs):
+    """Fetch only the refs needed for the revisions of all outputs instead
+    of all branches and tags of the remote, in a single fetch. Tags are only
+    fetched if the version or the changes entries are derived from them, and
+    then only those pointing into the fetched history. Returns False if a
+    revision couldn't be fetched this way."""
+
+    mirror_config = _git_mirror_config(url, clone_dir, kwargs)
+    command = ['git'] + GIT_FETCH_CONFIG + mirror_config + \
+        ['fetch', '--update-head-ok']
+    if '@PARENT_TAG@' not in (kwargs.get('versionformat') or '') and \
+            not kwargs.get('changesgenerate'):
+        command.append('--no-tags')
+
+    revisions = [output['revision'] for output in kwargs.get('output', [])]
+    wanted = []
+    for rev in set(revisions or [revision]):
+        # commits never change, so known ones needn't be fetched
+        if rev and re.match('^[0-9a-f]{40}$', rev) and \
+                _git_has_commit(clone_dir, rev):
+            continue
+        wanted.append((rev, _git_refspecs(rev)))
+    if not wanted:
+        _fetch_changesrevision_git(clone_dir, mirror_config, kwargs)
+        return True
+
+    # fetching a ref the remote doesn't have fails the whole fetch
+    refs = [refspec.lstrip('+').split(':')[0]
+            for rev, refspecs in wanted for refspec in refspecs
+            if ':' in refspec]
+    try:
+        advertised = set(
+            line.split('\t')[1] for line in safe_run(
+                ['git'] + mirror_config + ['ls-remote', 'origin'] + refs,
+                cwd=clone_dir)[1].splitlines() if '\t' in line)
+    except SystemExit:
+        advertised = set()
+
+    fetch_refspecs = []
+    for rev, refspecs in wanted:
+        for refspec in refspecs:
+            if ':' not in refspec or \
+                    refspec.lstrip('+').split(':')[0] in advertised:
+                fetch_refspecs.append(refspec)
+                break
+        else:
+            logging.info("%s: Targeted fetch failed, fetching all refs", rev)
+            return False
+
+    try:
+        safe_run(command + ['origin'] + fetch_refspecs, cwd=clone_dir,
+                 interactive=sys.stdout.isatty())
+    except SystemExit:
+        logging.info("Targeted fetch failed, fetching all refs")
+        return False
+    _fetch_changesrevision_git(clone_dir, mirror_config, kwargs)
+    return True
+
+
+def _fetch_changesrevision_git(clone_dir, mirror_config, kwargs):
+    """Fetch the commit the changes entries of the last run went up to, it
+    may not be in the history of the refs fetched by a targeted fetch. It
+    may be gone from the remote as well, see read_changes_log_git()."""
+
+    rev = kwargs.get('changesrevision')
+    if not rev or not re.match('^[0-9a-f]{40}$', rev) or \
+            _git_has_commit(clone_dir, rev):
+        return
+    try:
+        safe_run(['git'] + GIT_FETCH_CONFIG + mirror_config +
+                 ['fetch', '--no-tags', 'origin', rev], cwd=clone_dir)
+    except SystemExit:
+        logging.info("%s: Fetching the last changes revision failed", rev)
+
+
 def fetch_upstream_git(url, clone_dir, revision, cwd, kwargs):
     """fetch sources from GIT"""
 
-    safe_run(['git', 'clone', url, clone_dir], cwd=cwd,
-             interactive=sys.stdout.isatty())
-    if 'submodules' in kwargs and kwargs['submodules']:
-        safe_run(['git', 'submodule', 'update', '--init', '--recursive'],
-                 clone_dir)
+    if kwargs.get('targeted_fetch'):
+        safe_run(['git', 'init', '-q', clone_dir], cwd=cwd)
+        safe_run(['git', 'config', 'gc.auto', '0'], cwd=clone_dir)
+        safe_run(['git', 'remote', 'add', 'origin', url], cwd=clone_dir)
+        if not _fetch_targeted_git(url, clone_dir, revision, kwargs):
+            update_cache_git(url, clone_dir, revision,
+                             dict(kwargs, targeted_fetch=False))
+    else:
+        # auto-gc is disabled for cached clones, see maintain_cache_git()
+        safe_run(['git'] + _git_mirror_config(url, clone_dir, kwargs) +
+                 ['clone', '--config', 'gc.auto=0', url, clone_dir],
+                 cwd=cwd, interactive=sys.stdout.isatty())
+        if 'submodules' in kwargs and kwargs['submodules']:
+            _update_submodules_git(url, clone_dir, kwargs, init=True)
+
+
+def _svn_url(url, subdir):
+    if not subdir:
+        return url
+    return url.rstrip('/') + '/' + subdir.strip('/')
+
+
+def _svn_sparse_dirs(clone_dir, include):
+    """Return the top-level directories of the SVN checkout in clone_dir which
+    may hold members selected by the include patterns, or None if the whole
+    tree is needed."""
+
+    if not include:
+        return None
+
+    dirs = []
+    for entry in os.listdir(clone_dir):
+        if entry == '.svn' or \
+                not os.path.isdir(os.path.join(clone_dir, entry)):
+            continue
+        for pattern in include:
+            if '/' not in pattern:
+                if re.search(r'[*?[]', pattern):
+                    # matches the tarball's top-level directory as well as
+                    # any other member
+                    return None
+                continue
+            # The top-level directory of the tarball is not known yet, so
+            # assume it is matched by the first component of the pattern.
+            # Members of a directory are only packed if the directory
+            # itself is matched by a pattern.
+            rest = pattern.split('/', 1)[1]
+            if fnmatch.fnmatch('top/' + entry, '*/' + rest):
+                dirs.append(entry)
+                break
+    return dirs
 
 
 def fetch_upstream_svn(url, clone_dir, revision, cwd, kwargs):
     """fetch sources from SVN"""
 
-    command = ['svn', 'checkout', '--non-interactive', url, clone_dir]
+    # Only the requested sub-directory is checked out. If include patterns
+    # are given, only the top-level directories matching them are checked
+    # out in full.
+    command = ['svn', 'checkout', '--non-interactive',
+               _svn_url(kwargs.get('mirror') or url, kwargs.get('subdir')),
+               clone_dir]
     if revision:
         command.insert(4, '-r%s' % revision)
+    if kwargs.get('include'):
+        command.insert(4, '--depth=immediates')
     safe_run(command, cwd, interactive=sys.stdout.isatty())
 
+    if kwargs.get('include'):
+        _update_sparse_svn(clone_dir, revision, kwargs['include'], True)
+
 
 def fetch_upstream_hg(url, clone_dir, revision, cwd, kwargs):
     """fetch sources from HG"""
 
-    safe_run(['hg', 'clone', url, clone_dir], cwd,
+    # The clone only holds the repository store: each run checks out the
+    # requested revision into a share of it (see switch_revision_hg). Use a
+    # stream clone if the server allows it.
+    safe_run(['hg', 'clone', '-U', '--uncompressed',
+              kwargs.get('mirror') or url, clone_dir], cwd,
              interactive=sys.stdout.isatty())
+    if kwargs.get('mirror'):
+        # keep referring to upstream, mirrors are passed to each pull
+        hgrc = open(os.path.join(clone_dir, '.hg', 'hgrc'), 'w')
+        hgrc.write("[paths]\ndefault = %s\n" % url)
+        hgrc.close()
+
+
+def _update_branch_bzr(url, repocachedir, source=None):
+    """Mirror the BZR branch at url, fetched from source if given, into the
+    shared repository of the cache and return its location. Revisions common
+    to several branches are thus only stored and transferred once."""
+
+    if source is None:
+        source = url
+
+    shared_repo = os.path.join(repocachedir, 'bzr')
+    branchhash = get_repocache_hash('bzr', url, '')
+    branch = os.path.join(shared_repo, branchhash)
+
+    lock_fp = lock_cache(repocachedir, 'bzr')
+    try:
+        if not os.path.isdir(shared_repo):
+            safe_run(['bzr', 'init-repo', '--no-trees', shared_repo],
+                     cwd=repocachedir)
+    finally:
+        lock_fp.close()
+
+    # Each branch has a lock of its own, so different branches are fetched
+    # concurrently. BZR locks the shared repository while writing to it.
+    lock_fp = lock_cache(repocachedir, 'bzr.' + branchhash)
+    try:
+        if not os.path.isdir(branch):
+            safe_run(['bzr', 'branch', '--no-tree', source, branch],
+                     cwd=shared_repo, interactive=sys.stdout.isatty())
+        else:
+            safe_run(['bzr', 'pull', '--overwrite', '-d', branch, source],
+                     cwd=shared_repo, interactive=sys.stdout.isatty())
+    finally:
+        lock_fp.close()
+
+    return branch
 
 
 def fetch_upstream_bzr(url, clone_dir, revision, cwd, kwargs):
     """fetch sources from BZR"""
 
-    command = ['bzr', 'checkout', url, clone_dir]
+    if kwargs.get('repocachedir'):
+        # lightweight checkout of the branch in the shared repository
+        branch = _update_branch_bzr(url, kwargs['repocachedir'],
+                                    kwargs.get('mirror'))
+        command = ['bzr', 'checkout', '--lightweight', branch, clone_dir]
+    else:
+        command = ['bzr', 'checkout', kwargs.get('mirror') or url, clone_dir]
     if revision:
-        command.insert(3, '-r')
-        command.insert(4, revision)
+        command.insert(2, '-r')
+        command.insert(3, revision)
     safe_run(command, cwd, interactive=sys.stdout.isatty())
 
 
@@ -110,30 +724,72 @@ FETCH_UPSTREAM_COMMANDS = {
 }
 
 
-def update_cache_git(url, clone_dir, revision):
+def update_cache_git(url, clone_dir, revision, kwargs):
     """update sources from GIT"""
 
-    safe_run(['git', 'fetch', '--tags'],
+    if kwargs.get('targeted_fetch') and \
+            _fetch_targeted_git(url, clone_dir, revision, kwargs):
+        return
+
+    config = GIT_FETCH_CONFIG + _git_mirror_config(url, clone_dir, kwargs)
+    safe_run(['git'] + config + ['fetch', '--tags'],
              cwd=clone_dir, interactive=sys.stdout.isatty())
-    safe_run(['git', 'fetch'],
+    safe_run(['git'] + config + ['fetch'],
              cwd=clone_dir, interactive=sys.stdout.isatty())
 
 
-def update_cache_svn(url, clone_dir, revision):
+def _update_sparse_svn(clone_dir, revision, include, sparse):
+    """Make sure the parts of the SVN checkout in clone_dir needed for the
+    include patterns are checked out at full depth. sparse tells whether the
+    top-level directory of the checkout is checked out at full depth."""
+
+    command = ['svn', 'update', '--non-interactive', '--set-depth=infinity']
+    if revision:
+        command.append('-r%s' % revision)
+
+    dirs = _svn_sparse_dirs(clone_dir, include)
+    if dirs is None:
+        if sparse:
+            safe_run(command, cwd=clone_dir,
+                     interactive=sys.stdout.isatty())
+    elif dirs:
+        safe_run(command + dirs, cwd=clone_dir,
+                 interactive=sys.stdout.isatty())
+
+
+def update_cache_svn(url, clone_dir, revision, kwargs):
     """update sources from SVN"""
 
+    url = _svn_url(kwargs.get('mirror') or url, kwargs.get('subdir'))
+    info = safe_run(['svn', 'info'], cwd=clone_dir)[1]
+    match = re.search('^URL: (.*)$', info, re.MULTILINE)
+    root = re.search('^Repository Root: (.*)$', info, re.MULTILINE)
+
     command = ['svn', 'update']
+    if root and not url.startswith(root.group(1)):
+        # checked out from a mirror of the repository or vice versa
+        safe_run(['svn', 'relocate', '--non-interactive', url],
+                 cwd=clone_dir)
+    elif match is None or match.group(1).rstrip('/') != url.rstrip('/'):
+        # checkouts created by older versions hold the whole repository
+        command = ['svn', 'switch', url]
     if revision:
         command.insert(3, "-r%s" % revision)
     safe_run(command, cwd=clone_dir, interactive=sys.stdout.isatty())
 
+    # svn info only reports the depth of sparse checkouts
+    _update_sparse_svn(clone_dir, revision, kwargs.get('include'),
+                       re.search('^Depth: ', info, re.MULTILINE) is not None)
 
-def update_cache_hg(url, clone_dir, revision):
-    """update sources from HG"""
 
+def _pull_hg(clone_dir, revision=None, source=None):
+    command = ['hg', 'pull']
+    if revision:
+        command.extend(['-r', revision])
+    if source:
+        command.append(source)
     try:
-        safe_run(['hg', 'pull'], cwd=clone_dir,
-                 interactive=sys.stdout.isatty())
+        safe_run(command, cwd=clone_dir, interactive=sys.stdout.isatty())
     except SystemExit, e:
         # Contrary to the docs, hg pull returns exit code 1 when
         # there are no changes to pull, but we don't want to treat
@@ -142,9 +798,35 @@ def update_cache_hg(url, clone_dir, revision):
             raise
 
 
-def update_cache_bzr(url, clone_dir, revision):
+def update_cache_hg(url, clone_dir, revision, kwargs):
+    """update sources from HG"""
+
+    # Local revision numbers differ between clones so they can't be used to
+    # restrict the pull.
+    source = kwargs.get('mirror')
+    if revision is None or re.match('^[0-9]+$', revision):
+        _pull_hg(clone_dir, source=source)
+        return
+
+    try:
+        _pull_hg(clone_dir, revision, source)
+        safe_run(['hg', 'log', '-l1', '-r', revision, '--template', '{node}'],
+                 cwd=clone_dir)
+    except SystemExit:
+        # A tag is only known locally once the changeset adding it to
+        # .hgtags has been pulled too.
+        _pull_hg(clone_dir, source=source)
+
+
+def update_cache_bzr(url, clone_dir, revision, kwargs):
     """update sources from BZR"""
 
+    # Checkouts created by older versions carry their own repository and
+    # are updated from upstream by bzr update directly.
+    if kwargs.get('repocachedir') and \
+            not os.path.isdir(os.path.join(clone_dir, '.bzr', 'repository')):
+        _update_branch_bzr(url, kwargs['repocachedir'], kwargs.get('mirror'))
+
     command = ['bzr', 'update']
     if revision:
         command.insert(3, '-r')
@@ -160,7 +842,7 @@ UPDATE_CACHE_COMMANDS = {
 }
 
 
-def switch_revision_git(clone_dir, revision):
+def switch_revision_git(clone_dir, revision, kwargs):
     """Switch sources to revision. The GIT revision may refer to any of the
     following:
     - explicit SHA1: a1b2c3d4....
@@ -187,30 +869,69 @@ def switch_revision_git(clone_dir, revision):
     else:
         sys.exit('%s: No such revision' % revision)
 
-    # only update submodules if they have been enabled
-    if os.path.exists(
-            os.path.join(clone_dir, os.path.join('.git', 'modules'))):
-        safe_run(['git', 'submodule', 'update', '--recursive'], cwd=clone_dir)
+    # only update submodules if they have been enabled, targeted fetches
+    # only have a working tree to initialize them from now
+    initialized = os.path.exists(
+        os.path.join(clone_dir, os.path.join('.git', 'modules')))
+    if initialized or (kwargs.get('targeted_fetch') and
+                       kwargs.get('submodules')):
+        _update_submodules_git(kwargs['url'], clone_dir, kwargs,
+                               init=not initialized)
+
+    return clone_dir
+
+
+def _hg_largefiles_config(kwargs):
+    '''Return the hg options enabling the largefiles extension, if requested.
+    Largefiles are kept in the repository cache so they are shared by all
+    repositories.'''
+
+    if not kwargs.get('lfs'):
+        return []
+    config = ['--config', 'extensions.largefiles=']
+    if kwargs.get('repocachedir'):
+        config.extend(['--config', 'largefiles.usercache=' +
+                       os.path.join(kwargs['repocachedir'], 'largefiles')])
+    return config
 
 
-def switch_revision_hg(clone_dir, revision):
-    """Switch sources to revision."""
+def switch_revision_hg(clone_dir, revision, kwargs):
+    """Switch sources to revision. The repository store in clone_dir is
+    shared into a temporary working copy which is returned."""
 
     if revision is None:
         revision = 'tip'
 
+    largefiles = _hg_largefiles_config(kwargs)
+    if largefiles:
+        # only fetch the largefiles of the revision being packaged
+        safe_run(['hg'] + largefiles + ['lfpull', '-r', revision],
+                 cwd=clone_dir)
+
+    share_dir = mkscratchdir(kwargs.get('scratchdir'), kwargs['outdir'])
+    share_dir = os.path.join(share_dir, os.path.basename(clone_dir))
+
+    safe_run(['hg', '--config', 'extensions.share=', 'share', '-U',
+              clone_dir, share_dir], cwd=kwargs['outdir'])
     try:
-        safe_run(['hg', 'update', revision], cwd=clone_dir,
+        safe_run(['hg'] + largefiles + ['update', revision], cwd=share_dir,
                  interactive=sys.stdout.isatty())
     except SystemExit:
         sys.exit('%s: No such revision' % revision)
 
+    if kwargs.get('package_meta'):
+        # the packaged metadata must not refer to our cache
+        safe_run(['hg', '--config', 'extensions.share=', 'unshare'],
+                 cwd=share_dir)
+
+    return share_dir
+
 
-def switch_revision_none(clone_dir, revision):
+def switch_revision_none(clone_dir, revision, kwargs):
     """Switch sources to revision. Dummy implementation for version control
     systems that change revision during fetch/update."""
 
-    return
+    return clone_dir
 
 
 SWITCH_REVISION_COMMANDS = {
@@ -221,7 +942,20 @@ SWITCH_REVISION_COMMANDS = {
 }
 
 
+def _common_subdir(subdirs):
+    '''Return the deepest sub-directory containing all of subdirs.'''
+
+    common = []
+    for parts in zip(*[filter(None, subdir.split('/')) for subdir in subdirs]):
+        if len(set(parts)) > 1:
+            break
+        common.append(parts[0])
+    return '/'.join(common)
+
+
 def _calc_dir_to_clone_to(scm, url, out_dir):
+    from urlparse import urlparse
+
     # separate path from parameters etc.
     url_path = urlparse(url)[2].rstrip('/')
 
@@ -236,29 +970,68 @@ def _calc_dir_to_clone_to(scm, url, out_dir):
     return clone_dir
 
 
-def fetch_upstream(scm, url, revision, out_dir, **kwargs):
-    """Fetch sources from repository and checkout given revision."""
+def fetch_upstream(scm, url, revision, out_dir, kwargs):
+    """Fetch sources from repository into out_dir. Returns the directory
+    holding the repository, see switch_revision() for checking out the
+    revisions to package."""
 
     clone_dir = _calc_dir_to_clone_to(scm, url, out_dir)
-
-    if not os.path.isdir(clone_dir):
-        # initial clone
-        os.mkdir(clone_dir)
-        FETCH_UPSTREAM_COMMANDS[scm](url, clone_dir, revision, cwd=out_dir,
-                                     kwargs=kwargs)
-    else:
+    initial = not os.path.isdir(clone_dir)
+    if not initial:
         logging.info("Detected cached repository...")
-        UPDATE_CACHE_COMMANDS[scm](url, clone_dir, revision)
-
-    # switch_to_revision
-    SWITCH_REVISION_COMMANDS[scm](clone_dir, revision)
 
+    # The SCM commands fetch from kwargs['mirror'] if it is set. The cache
+    # is always keyed by the upstream URL.
+    kwargs['url'] = url
+    kwargs.setdefault('url_rewrites', [])
+    sources = [None]
+    mirror = rewrite_url(url, kwargs['url_rewrites'])
+    if mirror:
+        sources.insert(0, mirror)
+    for source in sources:
+        kwargs['mirror'] = source
+        if source:
+            logging.info("Fetching %s from mirror %s", url, source)
+        try:
+            if initial:
+                os.mkdir(clone_dir)
+                FETCH_UPSTREAM_COMMANDS[scm](url, clone_dir, revision,
+                                             cwd=out_dir, kwargs=kwargs)
+            else:
+                UPDATE_CACHE_COMMANDS[scm](url, clone_dir, revision, kwargs)
+            break
+        except SystemExit:
+            if source is None:
+                raise
+            logging.warning("Fetching from mirror %s failed, falling back "
+                            "to %s", source, url)
+            if initial:
+                shutil.rmtree(clone_dir)
+
+    # SVN and BZR working copies are at the revision fetched
+    kwargs['revision'] = revision
     return clone_dir
 
 
-def prep_tree_for_tar(repodir, subdir, outdir, dstname):
+def switch_revision(scm, clone_dir, revision, kwargs):
+    """Checkout revision of the repository fetched into clone_dir by
+    fetch_upstream(). Returns the directory holding the checked out
+    sources."""
+
+    if SWITCH_REVISION_COMMANDS[scm] is switch_revision_none and \
+            revision != kwargs['revision']:
+        UPDATE_CACHE_COMMANDS[scm](kwargs['url'], clone_dir, revision, kwargs)
+        kwargs['revision'] = revision
+
+    return SWITCH_REVISION_COMMANDS[scm](clone_dir, revision, kwargs)
+
+
+def prep_tree_for_tar(scm, repodir, subdir, outdir, dstname,
+                      package_metadata=False):
     """Prepare directory tree for creation of the tarball by copying the
-    requested sub-directory to the top-level destination directory."""
+    requested sub-directory to the top-level destination directory. SVN
+    checkouts only hold a sub-directory of the repository already, see
+    fetch_upstream_svn, so subdir is relative to it."""
 
     src = os.path.join(repodir, subdir)
     if not os.path.exists(src):
@@ -270,16 +1043,594 @@ def prep_tree_for_tar(repodir, subdir, outdir, dstname):
          os.path.samefile(os.path.dirname(src), dst)):
         sys.exit("%s: src and dst refer to same file" % src)
 
-    shutil.copytree(src, dst)
+    if scm == 'svn' and not package_metadata:
+        # skip the administrative files and pristine copies of the checkout
+        safe_run(['svn', 'export', '--non-interactive', '-q', src, dst],
+                 cwd=outdir)
+    else:
+        shutil.copytree(src, dst)
 
     return dst
 
 
+# Output buffer of the fast tar writer, a multiple of tarfile.RECORDSIZE
+TAR_BUFSIZE = 1024 * 10240
+# Bodies of files at least this large are mapped instead of read
+TAR_MMAP_THRESHOLD = 64 * 1024
+# Only files at least this large are deduplicated, the table of candidates
+# grows with their number
+TAR_DEDUPE_MIN_SIZE = 4 * 1024
+
+
+def _walk_tar_members(path, arcname, exclude):
+    '''Yield (path, arcname, stat result) for path and all files below it in
+    archive order. Members for which exclude(arcname) returns True are
+    skipped, just like the contents of excluded directories.
+
+    Only the entries of the directories currently being walked are kept, so
+    memory use grows with the size of the largest directory and the depth
+    of the tree, but not with the number of files in the tree.'''
+
+    if exclude(arcname):
+        return
+    statres = os.lstat(path)
+    yield path, arcname, statres
+    if not stat.S_ISDIR(statres.st_mode):
+        return
+
+    stack = [(path, arcname, iter(sorted(os.listdir(path))))]
+    while stack:
+        dirpath, dirarcname, names = stack[-1]
+        for name in names:
+            path = os.path.join(dirpath, name)
+            arcname = dirarcname + '/' + name
+            if exclude(arcname):
+                continue
+            statres = os.lstat(path)
+            yield path, arcname, statres
+            if stat.S_ISDIR(statres.st_mode):
+                stack.append((path, arcname, iter(sorted(os.listdir(path)))))
+                break
+        else:
+            stack.pop()
+
+
+def _get_tarinfo(path, arcname, statres, inodes):
+    '''Create a TarInfo for a file from its stat result. inodes maps the
+    inodes of files with several links to the first member referring to
+    them and the number of links not archived yet. Inodes are forgotten
+    once all their links have been archived. Returns None for files which
+    can't be archived.'''
+
+    import tarfile
+
+    tarinfo = tarfile.TarInfo(arcname)
+    mode = statres.st_mode
+    if stat.S_ISREG(mode):
+        inode = (statres.st_ino, statres.st_dev)
+        if statres.st_nlink > 1 and inode in inodes:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname, links = inodes[inode]
+            if links > 1:
+                inodes[inode] = (tarinfo.linkname, links - 1)
+            else:
+                del inodes[inode]
+        else:
+            if statres.st_nlink > 1:
+                inodes[inode] = (arcname, statres.st_nlink - 1)
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = statres.st_size
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(path)
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        if stat.S_ISCHR(mode):
+            tarinfo.type = tarfile.CHRTYPE
+        else:
+            tarinfo.type = tarfile.BLKTYPE
+        tarinfo.devmajor = os.major(statres.st_rdev)
+        tarinfo.devminor = os.minor(statres.st_rdev)
+    else:
+        return None
+
+    tarinfo.mode = stat.S_IMODE(mode)
+    tarinfo.mtime = int(statres.st_mtime)
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = "root"
+    return tarinfo
+
+
+def _write_body(tar_fp, path, size, blocksize):
+    '''Copy the contents of file path into the archive and pad them to a
+    multiple of blocksize. Large files are mapped and handed to a single
+    write() instead of being copied through the interpreter in small
+    chunks. Returns the number of bytes written.'''
+
+    import mmap
+
+    src_fp = open(path, 'rb')
+    try:
+        if size >= TAR_MMAP_THRESHOLD:
+            data = mmap.mmap(src_fp.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                tar_fp.write(data)
+            finally:
+                data.close()
+        else:
+            data = src_fp.read(size)
+            if len(data) != size:
+                raise IOError("%s: unexpected end of file" % path)
+            tar_fp.write(data)
+    finally:
+        src_fp.close()
+
+    padding = -size % blocksize
+    tar_fp.write('\0' * padding)
+    return size + padding
+
+
+def _write_tar_member(tar_fp, path, tarinfo):
+    '''Write the member described by tarinfo, with the contents of file path,
+    to a tar archive. Returns the number of bytes written.'''
+
+    import tarfile
+
+    header = tarinfo.tobuf(tarfile.GNU_FORMAT)
+    tar_fp.write(header)
+    length = len(header)
+    if tarinfo.type == tarfile.REGTYPE and tarinfo.size:
+        length += _write_body(tar_fp, path, tarinfo.size, tarfile.BLOCKSIZE)
+    return length
+
+
+def _write_tar_end(tar_fp, offset):
+    '''Write the end of archive marker of a tar archive of offset bytes,
+    padded to a full record like tarfile does.'''
+
+    import tarfile
+
+    offset += tarfile.BLOCKSIZE * 2
+    tar_fp.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2 +
+                                -offset % tarfile.RECORDSIZE))
+
+
+def _cpio_header(name, mode, size, ino, tarinfo):
+    '''Return a cpio header in the "newc" format used by obscpio.'''
+
+    name += '\0'
+    fields = [ino, mode, tarinfo.uid, tarinfo.gid, 1, tarinfo.mtime, size,
+              0, 0, tarinfo.devmajor, tarinfo.devminor, len(name), 0]
+    header = '070701' + ''.join(['%08X' % field for field in fields]) + name
+    return header + '\0' * (-len(header) % 4)
+
+
+def _write_cpio_member(cpio_fp, path, tarinfo, ino):
+    '''Write the member described by tarinfo, with the contents of file
+    path, to a cpio archive. Hard links are stored as separate copies.
+    Returns the number of bytes written.'''
+
+    import tarfile
+
+    mode = tarinfo.mode | {
+        tarfile.REGTYPE: stat.S_IFREG,
+        tarfile.LNKTYPE: stat.S_IFREG,
+        tarfile.DIRTYPE: stat.S_IFDIR,
+        tarfile.SYMTYPE: stat.S_IFLNK,
+        tarfile.FIFOTYPE: stat.S_IFIFO,
+        tarfile.CHRTYPE: stat.S_IFCHR,
+        tarfile.BLKTYPE: stat.S_IFBLK,
+    }[tarinfo.type]
+
+    if tarinfo.type == tarfile.SYMTYPE:
+        header = _cpio_header(tarinfo.name, mode, len(tarinfo.linkname), ino,
+                              tarinfo)
+        data = tarinfo.linkname + '\0' * (-len(tarinfo.linkname) % 4)
+        cpio_fp.write(header + data)
+        return len(header) + len(data)
+
+    size = 0
+    if tarinfo.type in (tarfile.REGTYPE, tarfile.LNKTYPE):
+        size = tarinfo.size
+        if tarinfo.type == tarfile.LNKTYPE:
+            size = os.path.getsize(path)
+    header = _cpio_header(tarinfo.name, mode, size, ino, tarinfo)
+    cpio_fp.write(header)
+    length = len(header)
+    if size:
+        length += _write_body(cpio_fp, path, size, 4)
+    return length
+
+
+def _write_cpio_end(cpio_fp, offset):
+    '''Write the trailer of a cpio archive of offset bytes, padded to 512
+    bytes like cpio does.'''
+
+    import tarfile
+
+    trailer = _cpio_header('TRAILER!!!', 0, 0, 0, tarfile.TarInfo())
+    offset += len(trailer)
+    cpio_fp.write(trailer + '\0' * (-offset % 512))
+
+
+def _file_digest(path):
+    '''Return the SHA256 digest of the contents of file path.'''
+
+    import hashlib
+
+    digest = hashlib.sha256()
+    src_fp = open(path, 'rb')
+    try:
+        while True:
+            data = src_fp.read(TAR_MMAP_THRESHOLD)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        src_fp.close()
+    return digest.digest()
+
+
+class TarDeduplicator(object):
+    '''Find regular files whose contents and permissions are identical to a
+    file added to the archive before.
+
+    Files are grouped by size and mode first, so only files which could be
+    duplicates are hashed. The first file of each group is hashed only once
+    a second one shows up. Files smaller than TAR_DEDUPE_MIN_SIZE save
+    little space and aren't considered, which bounds the memory used.'''
+
+    def __init__(self):
+        self.candidates = {}
+
+    def find(self, path, tarinfo):
+        '''Return the member name of an earlier copy of path, or None if
+        it is the first file with these contents.'''
+
+        if tarinfo.size < TAR_DEDUPE_MIN_SIZE:
+            return None
+        key = (tarinfo.size, tarinfo.mode)
+        if key not in self.candidates:
+            self.candidates[key] = [[path, tarinfo.name, None]]
+            return None
+
+        digest = _file_digest(path)
+        for candidate in self.candidates[key]:
+            if candidate[2] is None:
+                candidate[2] = _file_digest(candidate[0])
+            if candidate[2] == digest:
+                return candidate[1]
+        self.candidates[key].append([path, tarinfo.name, digest])
+        return None
+
+
+LFS_POINTER_VERSION = 'version https://git-lfs.github.com/spec/v1\n'
+LFS_POINTER_MAX_SIZE = 1024
+
+
+class GitLfs(object):
+    '''Git LFS objects referenced by the pointer files of a GIT repository.
+
+    Objects are downloaded with the LFS batch API, or copied from the LFS
+    store of a local repository. They are kept in a content addressed cache
+    laid out like the object store of git-lfs, which can be shared by any
+    number of repositories.'''
+
+    def __init__(self, clone_dir, url, cachedir, revision='HEAD'):
+        self.clone_dir = clone_dir
+        self.url = url
+        self.cachedir = cachedir
+        # the commit whose .lfsconfig is used, the working tree of the clone
+        # may be at another one already
+        self.revision = revision
+
+    @staticmethod
+    def read_pointer(path, size):
+        '''Return the object id and size referenced by file path if it is a
+        LFS pointer file, or None.'''
+
+        if size > LFS_POINTER_MAX_SIZE:
+            return None
+        pointer_fp = open(path, 'rb')
+        data = pointer_fp.read(LFS_POINTER_MAX_SIZE)
+        pointer_fp.close()
+        if not data.startswith(LFS_POINTER_VERSION):
+            return None
+
+        fields = {}
+        for line in data.splitlines()[1:]:
+            key, _, value = line.partition(' ')
+            fields[key] = value
+        match = re.match('^sha256:([0-9a-f]{64})$', fields.get('oid', ''))
+        if not match or not fields.get('size', '').isdigit():
+            return None
+        return match.group(1), int(fields['size'])
+
+    def object_path(self, oid):
+        '''Return the location of object oid in the cache.'''
+
+        return os.path.join(self.cachedir, 'objects', oid[0:2], oid[2:4], oid)
+
+    def object_stat(self, oid, statres):
+        '''Return the location of object oid in the cache and the stat result
+        statres of its pointer file with the size and inode of the object,
+        for archiving the object in place of the pointer.'''
+
+        path = self.object_path(oid)
+        object_statres = os.stat(path)
+        fields = list(statres)
+        for field in [stat.ST_INO, stat.ST_DEV, stat.ST_NLINK, stat.ST_SIZE]:
+            fields[field] = object_statres[field]
+        return path, os.stat_result(fields)
+
+    def endpoint(self):
+        '''Return the URL of the LFS server of the repository, or None if it
+        is a local repository.'''
+
+        config = {}
+        output = safe_run(['git', 'config', '--list'], cwd=self.clone_dir)[1]
+        try:
+            # the repository's own settings take precedence
+            output += '\n' + safe_run(
+                ['git', 'config', '--blob', self.revision + ':.lfsconfig',
+                 '--list'], cwd=self.clone_dir)[1]
+        except SystemExit:
+            pass
+        for line in output.splitlines():
+            key, _, value = line.partition('=')
+            config[key.lower()] = value
+        for key in ['remote.origin.lfsurl', 'lfs.url']:
+            if config.get(key):
+                return config[key]
+
+        url = self.url.rstrip('/')
+        if os.path.isdir(re.sub('^file://', '', url)):
+            return None
+
+        # derive the server from the repository URL like git-lfs does
+        match = re.match('^(https?)://(.*)$', url)
+        if match:
+            scheme, path = match.groups()
+        else:
+            match = re.match('^(?:ssh://)?(?:[^@/]+@)?([^:/]+)(?::[0-9]+)?'
+                             '[:/](.+)$', url)
+            if not match:
+                return None
+            scheme, path = 'https', '/'.join(match.groups())
+        if not path.endswith('.git'):
+            path += '.git'
+        return '%s://%s/info/lfs' % (scheme, path)
+
+    def _store(self, oid, size, src_fp):
+        '''Copy object oid from src_fp into the cache, verifying its contents.
+        The object is renamed into place so concurrent runs never see a
+        partial object.'''
+
+        import errno
+        import hashlib
+        import tempfile
+
+        dst = self.object_path(oid)
+        try:
+            os.makedirs(os.path.dirname(dst))
+        except OSError, e:
+            # created by a concurrent run
+            if e.errno != errno.EEXIST:
+                raise
+
+        digest = hashlib.sha256()
+        length = 0
+        tmp_fp = tempfile.NamedTemporaryFile(dir=os.path.dirname(dst),
+                                             prefix='.' + oid, delete=False)
+        try:
+            while True:
+                data = src_fp.read(TAR_MMAP_THRESHOLD)
+                if not data:
+                    break
+                digest.update(data)
+                length += len(data)
+                tmp_fp.write(data)
+            tmp_fp.close()
+            if digest.hexdigest() != oid or length != size:
+                sys.exit("LFS object %s is corrupt" % oid)
+            os.rename(tmp_fp.name, dst)
+        finally:
+            tmp_fp.close()
+            if os.path.exists(tmp_fp.name):
+                os.unlink(tmp_fp.name)
+
+    def _fetch_local(self, objects):
+        path = re.sub('^file://', '', self.url)
+        for oid, size in objects:
+            for store in [os.path.join(path, '.git', 'lfs', 'objects'),
+                          os.path.join(path, 'lfs', 'objects')]:
+                src = os.path.join(store, oid[0:2], oid[2:4], oid)
+                if os.path.isfile(src):
+                    src_fp = open(src, 'rb')
+                    self._store(oid, size, src_fp)
+                    src_fp.close()
+                    break
+            else:
+                sys.exit("%s: LFS object %s not found" % (path, oid))
+
+    def credentials(self, endpoint):
+        '''Return the Authorization header for endpoint from the credential
+        helpers configured for the repository, or None. The user is never
+        prompted.'''
+
+        import base64
+        import subprocess
+
+        env = os.environ.copy()
+        env['GIT_TERMINAL_PROMPT'] = '0'
+        # not safe_run, which would log the password
+        proc = subprocess.Popen(['git', 'credential', 'fill'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=self.clone_dir,
+                                env=env)
+        output = proc.communicate('url=%s\n\n' % endpoint)[0]
+        if proc.returncode:
+            return None
+
+        fields = dict(line.partition('=')[::2]
+                      for line in output.splitlines())
+        if not fields.get('username') or 'password' not in fields:
+            return None
+        return 'Basic ' + base64.b64encode('%s:%s' % (fields['username'],
+                                                      fields['password']))
+
+    def _fetch_remote(self, endpoint, objects):
+        import json
+        import urllib2
+
+        headers = {
+            'Accept': 'application/vnd.git-lfs+json',
+            'Content-Type': 'application/vnd.git-lfs+json',
+        }
+        request = {
+            'operation': 'download',
+            'transfers': ['basic'],
+            'objects': [{'oid': oid, 'size': size} for oid, size in objects],
+        }
+        batch = endpoint.rstrip('/') + '/objects/batch'
+        try:
+            try:
+                response = urllib2.urlopen(urllib2.Request(
+                    batch, json.dumps(request), headers))
+            except urllib2.HTTPError, e:
+                if e.code != 401:
+                    raise
+                authorization = self.credentials(endpoint)
+                if not authorization:
+                    raise
+                headers['Authorization'] = authorization
+                response = urllib2.urlopen(urllib2.Request(
+                    batch, json.dumps(request), headers))
+            response = json.load(response)
+            for obj in response.get('objects', []):
+                if 'error' in obj:
+                    sys.exit("%s: LFS object %s: %s" %
+                             (endpoint, obj['oid'], obj['error']['message']))
+                download = obj['actions']['download']
+                logging.debug("Downloading LFS object %s", obj['oid'])
+                src_fp = urllib2.urlopen(urllib2.Request(
+                    download['href'], headers=download.get('header', {})))
+                self._store(obj['oid'], obj['size'], src_fp)
+                src_fp.close()
+        except (urllib2.URLError, ValueError, KeyError), e:
+            sys.exit("%s: LFS download failed (%s)" % (endpoint, e))
+
+    def fetch(self, objects):
+        '''Make sure the (oid, size) objects are in the cache.'''
+
+        missing = [obj for obj in set(objects)
+                   if not os.path.exists(self.object_path(obj[0]))]
+        logging.debug("LFS objects: %d referenced, %d missing",
+                      len(set(objects)), len(missing))
+        if not missing:
+            return
+
+        endpoint = self.endpoint()
+        if endpoint is None:
+            self._fetch_local(missing)
+        else:
+            self._fetch_remote(endpoint, missing)
+
+
+def write_tar(repodir, arcname, tarname, exclude, dedupe=False, lfs=None,
+              archive_format='tar'):
+    '''Write an uncompressed tarball of repodir to tarname, using arcname as
+    name of its top-level directory. This is a faster replacement for
+    tarfile.add() which stats each file once and writes through a large
+    output buffer. With archive_format 'obscpio', a cpio archive is written
+    instead.
+
+    With dedupe, files identical to one archived before are stored as hard
+    links to the first copy. With a GitLfs instance lfs, the objects of all
+    LFS pointer files being archived are fetched into its cache and stored
+    instead of the pointers.'''
+
+    import tarfile
+
+    pointers = {}
+    if lfs:
+        for path, name, statres in _walk_tar_members(repodir, arcname,
+                                                     exclude):
+            if stat.S_ISREG(statres.st_mode):
+                pointer = lfs.read_pointer(path, statres.st_size)
+                if pointer:
+                    pointers[path] = pointer
+        lfs.fetch(pointers.values())
+
+    output = OutputFile(tarname, TAR_BUFSIZE)
+    tar_fp = output.fp
+    try:
+        inodes = {}
+        inos = itertools.count(1)
+        offset = 0
+        deduplicator = None
+        if dedupe and archive_format == 'tar':
+            deduplicator = TarDeduplicator()
+        for path, name, statres in _walk_tar_members(repodir, arcname,
+                                                     exclude):
+            if path in pointers:
+                path, statres = lfs.object_stat(pointers[path][0], statres)
+            tarinfo = _get_tarinfo(path, name, statres, inodes)
+            if tarinfo is None:
+                logging.debug("Skipping %s", path)
+                continue
+            if deduplicator and tarinfo.type == tarfile.REGTYPE:
+                linkname = deduplicator.find(path, tarinfo)
+                if linkname:
+                    logging.debug("Storing %s as link to %s", name, linkname)
+                    tarinfo.type = tarfile.LNKTYPE
+                    tarinfo.linkname = linkname
+                    tarinfo.size = 0
+            if archive_format == 'obscpio':
+                offset += _write_cpio_member(tar_fp, path, tarinfo,
+                                             next(inos))
+            else:
+                offset += _write_tar_member(tar_fp, path, tarinfo)
+
+        if archive_format == 'obscpio':
+            _write_cpio_end(tar_fp, offset)
+        else:
+            _write_tar_end(tar_fp, offset)
+        output.commit()
+    finally:
+        output.abort()
+
+
+def write_obsinfo(outdir, name, version, commit, mtime=None):
+    '''Write the metadata of an obscpio archive, which tells later services
+    the name, version, commit time and commit of the sources without
+    unpacking them.'''
+
+    obsinfo = OutputFile(os.path.join(outdir, name + '.obsinfo'))
+    try:
+        obsinfo.write("name: %s\n" % name)
+        obsinfo.write("version: %s\n" % (version or ''))
+        if mtime is not None:
+            obsinfo.write("mtime: %d\n" % mtime)
+        if commit:
+            obsinfo.write("commit: %s\n" % commit)
+        obsinfo.commit()
+    finally:
+        obsinfo.abort()
+
+
 def create_tar(repodir, outdir, dstname, extension='tar',
-               exclude=[], include=[], package_metadata=False):
+               exclude=[], include=[], package_metadata=False,
+               writer='tarfile', dedupe=False, lfs=None,
+               archive_format='tar'):
     """Create a tarball of repodir in destination directory."""
 
-    (workdir, topdir) = os.path.split(repodir)
+    import tarfile
+
+    topdir = os.path.basename(repodir)
 
     incl_patterns = []
     excl_patterns = []
@@ -322,15 +1673,30 @@ def create_tar(repodir, outdir, dstname, extension='tar',
 
         return tarinfo
 
-    os.chdir(workdir)
+    tarname = os.path.join(outdir, dstname + '.' + extension)
 
-    tar = tarfile.open(os.path.join(outdir, dstname + '.' + extension), "w")
-    try:
-        tar.add(topdir, filter=tar_filter)
-    except TypeError:
-        # Python 2.6 compatibility
-        tar.add(topdir, exclude=tar_exclude)
-    tar.close()
+    # tarfile can't be told to store identical files as links or to replace
+    # the contents of LFS pointers
+    if writer == 'fast' or dedupe or lfs or archive_format != 'tar':
+        write_tar(repodir, topdir, tarname, tar_exclude, dedupe, lfs,
+                  archive_format)
+        return
+
+    # don't change the working directory, archives of several outputs are
+    # created concurrently
+    output = OutputFile(tarname)
+    try:
+        tar = tarfile.open(mode="w", fileobj=output.fp)
+        try:
+            tar.add(repodir, arcname=topdir, filter=tar_filter)
+        except TypeError:
+            # Python 2.6 compatibility
+            tar.add(repodir, arcname=topdir, exclude=lambda path:
+                    tar_exclude(topdir + path[len(repodir):]))
+        tar.close()
+        output.commit()
+    finally:
+        output.abort()
 
 
 CLEANUP_DIRS = []
@@ -342,6 +1708,7 @@ def cleanup(dirs):
     logging.info("Cleaning: %s", ' '.join(dirs))
 
     for d in dirs:
+        _release_tempdir(d)
         if not os.path.exists(d):
             continue
         for root, dirs, files in os.walk(d, topdown=False):
@@ -352,6 +1719,120 @@ def cleanup(dirs):
         os.rmdir(d)
 
 
+def _tree_size(path):
+    '''Return the number of bytes used by the files below path.'''
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+# the locked descriptors of the directories created by _mkdtemp()
+TEMPDIR_FDS = {}
+
+
+def _set_cloexec(fd):
+    '''Keep the commands run from inheriting the descriptor fd of a lock,
+    which would otherwise stay held by a command outliving tar_scm.'''
+
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _mkdtemp(parent, prefix):
+    '''Create a temporary directory in parent whose name tells prefix and
+    the PID of its owner. It stays locked until the owner exits or calls
+    _release_tempdir(), see _orphaned().'''
+
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp(prefix='%s.new-' % prefix, dir=parent)
+    fd = os.open(tmpdir, os.O_RDONLY)
+    _set_cloexec(fd)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        # e.g. NFS, the directory is never reclaimed then
+        logging.debug("%s: Failed to lock (%s)", tmpdir, e)
+
+    # only show up as a candidate for reclaiming once locked
+    path = os.path.join(parent, '%s.%d.%s' % (
+        prefix, os.getpid(), os.path.basename(tmpdir)[len(prefix) + 5:]))
+    os.rename(tmpdir, path)
+    TEMPDIR_FDS[path] = fd
+    return path
+
+
+def _release_tempdir(path):
+    '''Unlock the directory path created by _mkdtemp(), e.g. once it has
+    been moved or removed.'''
+
+    fd = TEMPDIR_FDS.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def _orphaned(parent, name):
+    '''Return the prefix of the temporary directory name in parent created
+    by _mkdtemp() if its owner is gone, otherwise None. The owner is gone if
+    the directory isn't locked: PIDs can't tell, as the owner may run on
+    another host or in another PID namespace sharing the directory.'''
+
+    match = re.match(r'^(.+)\.([0-9]+)\.[^.]+$', name)
+    if not match:
+        return None
+    try:
+        fd = os.open(os.path.join(parent, name), os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        _set_cloexec(fd)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return None
+    finally:
+        os.close(fd)
+    return match.group(1)
+
+
+def reclaim_orphans(parent, prefix='tar_scm'):
+    '''Remove the temporary directories in parent which were left behind
+    by processes killed before they could clean up.'''
+
+    for name in os.listdir(parent):
+        if _orphaned(parent, name) == prefix:
+            logging.info("Removing orphaned %s", os.path.join(parent, name))
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def mkscratchdir(scratchdir, fallback, tree=None):
+    '''Create a temporary directory in scratchdir, or in fallback if no
+    scratch directory is configured or it hasn't room for a copy of the
+    directory tree. The directory is removed on exit.'''
+
+    parent = fallback
+    if scratchdir:
+        try:
+            statres = os.statvfs(scratchdir)
+            size = 0
+            if tree:
+                size = _tree_size(tree)
+            if statres.f_bavail * statres.f_frsize > size:
+                parent = scratchdir
+            else:
+                logging.info("%s: Not enough space for %d bytes, using %s",
+                             scratchdir, size, fallback)
+        except OSError, e:
+            logging.warning("%s: %s, using %s", scratchdir, e.strerror,
+                            fallback)
+
+    tmpdir = _mkdtemp(parent, 'tar_scm')
+    CLEANUP_DIRS.append(tmpdir)
+    return tmpdir
+
+
 def version_iso_cleanup(version):
     '''Reformat timestamp value.'''
 
@@ -442,7 +1923,7 @@ def detect_version_bzr(repodir, versionformat):
     if versionformat is None:
         versionformat = '%r'
 
-    version = safe_run(['bzr', 'revno'], repodir)[1]
+    version = safe_run(['bzr', 'revno', '--tree'], repodir)[1]
     return re.sub('%r', version.strip(), versionformat)
 
 
@@ -461,9 +1942,491 @@ def detect_version(scm, repodir, versionformat=None):
     return version
 
 
+def _detect_scm(clone_dir):
+    '''Return the SCM used by the checkout in clone_dir.'''
+
+    for scm in ['git', 'svn', 'hg', 'bzr']:
+        if os.path.isdir(os.path.join(clone_dir, '.' + scm)):
+            return scm
+    return None
+
+
+def maintain_cache_git(clone_dir):
+    '''Repack and index a cached GIT repository.'''
+
+    # Make sure "git fetch" never triggers a "git gc --auto" during a
+    # service run, even for clones created by older versions.
+    safe_run(['git', 'config', 'gc.auto', '0'], clone_dir)
+    safe_run(['git', 'repack', '-a', '-d', '-l', '-q'], clone_dir)
+    # multi-pack-index and commit-graph need recent git versions
+    for cmd in [['git', 'multi-pack-index', 'write'],
+                ['git', 'commit-graph', 'write', '--reachable']]:
+        try:
+            safe_run(cmd, clone_dir)
+        except SystemExit, e:
+            logging.warning("%s: %s", ' '.join(cmd), e)
+    safe_run(['git', 'prune'], clone_dir)
+
+
+def maintain_cache_hg(clone_dir):
+    '''Recover and verify a cached HG repository.'''
+
+    try:
+        safe_run(['hg', 'recover'], clone_dir)
+    except SystemExit, e:
+        # hg recover returns exit code 1 when there is nothing to do
+        if re.match('.*no interrupted transaction available.*',
+                    e.message) is None:
+            raise
+    safe_run(['hg', 'verify'], clone_dir)
+
+
+MAINTAIN_CACHE_COMMANDS = {
+    'git': maintain_cache_git,
+    'hg':  maintain_cache_hg,
+}
+
+
+def lock_cache(repocachedir, repohash):
+    '''Take the exclusive lock of a cached repository. The lock is held until
+    the returned file object is closed.'''
+
+    lockfile = os.path.join(repocachedir, 'repo', repohash + '.lock')
+    lock_fp = open(lockfile, 'w')
+    _set_cloexec(lock_fp.fileno())
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logging.info("Waiting for lock %s", lockfile)
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+    return lock_fp
+
+
+def maintain_cache_repo(repocachedir, repohash):
+    '''Run maintenance commands for a cached repository. Returns False if the
+    maintenance failed.'''
+
+    repodir = os.path.join(repocachedir, 'repo', repohash)
+    lock_fp = lock_cache(repocachedir, repohash)
+    try:
+        for name in os.listdir(repodir):
+            clone_dir = os.path.join(repodir, name)
+            scm = _detect_scm(clone_dir)
+            if scm not in MAINTAIN_CACHE_COMMANDS:
+                continue
+            logging.info("Maintaining %s", clone_dir)
+            MAINTAIN_CACHE_COMMANDS[scm](clone_dir)
+    except (OSError, SystemExit), e:
+        logging.error("%s: maintenance failed: %s", repodir, e)
+        return False
+    finally:
+        lock_fp.close()
+    return True
+
+
+# Commands checking that an interrupted clone can be updated
+SALVAGE_COMMANDS = {
+    'git': [['git', 'config', 'remote.origin.url'],
+            ['git', 'fsck', '--connectivity-only']],
+    'svn': [['svn', 'cleanup'], ['svn', 'info']],
+    'hg':  [['hg', 'paths', 'default'], ['hg', 'verify']],
+    'bzr': [['bzr', 'check']],
+}
+
+
+def _salvageable(repodir):
+    '''Tell whether the clone in repodir, left behind by an interrupted
+    run, can be brought up to date by updating it.'''
+
+    names = os.listdir(repodir)
+    if len(names) != 1:
+        return False
+    clone_dir = os.path.join(repodir, names[0])
+    scm = _detect_scm(clone_dir)
+    if scm not in SALVAGE_COMMANDS:
+        return False
+    try:
+        for cmd in SALVAGE_COMMANDS[scm]:
+            safe_run(cmd, clone_dir)
+    except SystemExit:
+        return False
+    return True
+
+
+def adopt_orphan(repocachedir, repohash):
+    '''Return an orphaned clone of the repository repohash in the incoming
+    directory of the cache which can be salvaged, or None. All other
+    orphaned clones of it are removed. The caller must hold the lock of the
+    repository.'''
+
+    incoming = os.path.join(repocachedir, 'incoming')
+    adopted = None
+    for name in sorted(os.listdir(incoming)):
+        if _orphaned(incoming, name) != repohash:
+            continue
+        repodir = os.path.join(incoming, name)
+        if adopted is None and \
+                not os.path.isdir(os.path.join(repocachedir, 'repo',
+                                               repohash)) and \
+                _salvageable(repodir):
+            logging.info("Adopting interrupted clone %s", repodir)
+            adopted = repodir
+        else:
+            logging.info("Removing orphaned %s", repodir)
+            shutil.rmtree(repodir, ignore_errors=True)
+    return adopted
+
+
+def reclaim_incoming(repocachedir):
+    '''Move the salvageable clones left behind by interrupted runs in the
+    incoming directory of the cache into the cache and remove the rest.'''
+
+    repohashes = set()
+    incoming = os.path.join(repocachedir, 'incoming')
+    for name in os.listdir(incoming):
+        repohash = _orphaned(incoming, name)
+        if repohash:
+            repohashes.add(repohash)
+
+    for repohash in repohashes:
+        lock_fp = lock_cache(repocachedir, repohash)
+        try:
+            repodir = adopt_orphan(repocachedir, repohash)
+            if repodir:
+                os.rename(repodir,
+                          os.path.join(repocachedir, 'repo', repohash))
+        finally:
+            lock_fp.close()
+
+
+def _read_failures(failfile):
+    import json
+
+    try:
+        failures_fp = open(failfile)
+        try:
+            return json.load(failures_fp)
+        finally:
+            failures_fp.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_failures(failfile, failures):
+    import json
+
+    output = OutputFile(failfile)
+    try:
+        json.dump(failures, output.fp, indent=1, sort_keys=True)
+        output.commit()
+    finally:
+        output.abort()
+
+
+def check_failures(failfile, revisions, ttl):
+    '''Exit with the error of fetching any of the revisions recorded in
+    failfile by record_failure() within the last ttl seconds.'''
+
+    failures = _read_failures(failfile)
+    for revision in revisions:
+        if (revision or '') not in failures:
+            continue
+        timestamp, error = failures[revision or '']
+        age = int(time.time() - timestamp)
+        if 0 <= age < ttl:
+            sys.exit("%s\n(failed %ds ago, not retrying for %ds unless "
+                     "--force-retry is enabled)" % (error, age, ttl - age))
+
+
+def _lock_failures(failfile):
+    '''Take the exclusive lock of failfile, which concurrent runs for other
+    revisions of the repository update as well. The lock is held until the
+    returned file object is closed.'''
+
+    lock_fp = open(failfile + '.lock', 'w')
+    _set_cloexec(lock_fp.fileno())
+    fcntl.flock(lock_fp, fcntl.LOCK_EX)
+    return lock_fp
+
+
+def record_failure(failfile, revisions, error):
+    '''Record in failfile that fetching the revisions failed with error.'''
+
+    lock_fp = _lock_failures(failfile)
+    try:
+        failures = _read_failures(failfile)
+        for revision in revisions:
+            failures[revision or ''] = [time.time(), error]
+        _write_failures(failfile, failures)
+    finally:
+        lock_fp.close()
+
+
+def clear_failures(failfile, revisions):
+    '''Forget the failures of fetching the revisions recorded in
+    failfile.'''
+
+    # without a record of the revisions, there is nothing to lock for
+    failures = _read_failures(failfile)
+    if not [x for x in revisions if (x or '') in failures]:
+        return
+
+    lock_fp = _lock_failures(failfile)
+    try:
+        failures = _read_failures(failfile)
+        for revision in revisions:
+            failures.pop(revision or '', None)
+        if failures:
+            _write_failures(failfile, failures)
+        elif os.path.exists(failfile):
+            os.unlink(failfile)
+    finally:
+        lock_fp.close()
+
+
+def maintain_cache(repocachedir, jobs):
+    '''Run maintenance for all cached repositories in parallel. Returns False
+    if the maintenance of any repository failed.'''
+
+    import multiprocessing.pool
+
+    cachedir = os.path.join(repocachedir, 'repo')
+    repohashes = [x for x in os.listdir(cachedir)
+                  if os.path.isdir(os.path.join(cachedir, x))]
+
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        results = pool.map(lambda x: maintain_cache_repo(repocachedir, x),
+                           repohashes)
+    finally:
+        pool.close()
+        pool.join()
+
+    return all(results)
+
+
+# Commands printing the upstream URL of a cached repository. SVN and BZR
+# caches hold working copies, which are updated to the packaged revision
+# by each run anyway.
+REMOTE_URL_COMMANDS = {
+    'git': ['git', 'config', 'remote.origin.url'],
+    'hg':  ['hg', 'paths', 'default'],
+}
+
+
+def _cached_repos(repocachedir):
+    '''Return the SCM and upstream URL of all cached repositories which can
+    be prefetched.'''
+
+    repos = []
+    cachedir = os.path.join(repocachedir, 'repo')
+    for repohash in sorted(os.listdir(cachedir)):
+        repodir = os.path.join(cachedir, repohash)
+        if not os.path.isdir(repodir):
+            continue
+        for name in os.listdir(repodir):
+            clone_dir = os.path.join(repodir, name)
+            scm = _detect_scm(clone_dir)
+            if scm not in REMOTE_URL_COMMANDS:
+                continue
+            try:
+                url = safe_run(REMOTE_URL_COMMANDS[scm], clone_dir)[1].strip()
+            except SystemExit, e:
+                logging.warning("%s: no upstream URL: %s", clone_dir, e)
+                continue
+            if get_repocache_hash(scm, url, '') == repohash:
+                repos.append((scm, url))
+    return repos
+
+
+def _cached_scm(repocachedir, url):
+    '''Return the SCM of the cached repository of url, or None if it isn't
+    cached.'''
+
+    repodir = os.path.join(repocachedir, 'repo',
+                           get_repocache_hash(None, url, ''))
+    if not os.path.isdir(repodir):
+        return None
+    for name in os.listdir(repodir):
+        scm = _detect_scm(os.path.join(repodir, name))
+        if scm in REMOTE_URL_COMMANDS:
+            return scm
+    return None
+
+
+def prefetch_repo(repocachedir, scm, url, kwargs):
+    '''Fetch the repository at url into the cache, just like a service run
+    would, or update the cached clone of it. Returns False if fetching
+    failed.'''
+
+    repohash = get_repocache_hash(scm, url, '')
+    cachedir = os.path.join(repocachedir, 'repo', repohash)
+    lock_fp = lock_cache(repocachedir, repohash)
+    repodir = cachedir
+    try:
+        if not os.path.isdir(repodir):
+            repodir = adopt_orphan(repocachedir, repohash) or \
+                _mkdtemp(os.path.join(repocachedir, 'incoming'), repohash)
+        logging.info("Prefetching %s", url)
+        fetch_upstream(scm, url, None, repodir, dict(kwargs))
+        if repodir != cachedir:
+            os.rename(repodir, cachedir)
+    except (OSError, SystemExit), e:
+        logging.error("%s: prefetch failed: %s", url, e)
+        if repodir != cachedir:
+            shutil.rmtree(repodir, ignore_errors=True)
+        return False
+    finally:
+        _release_tempdir(repodir)
+        lock_fp.close()
+    logging.info("Prefetched %s", url)
+    return True
+
+
+def prefetch(repocachedir, repos, jobs, kwargs):
+    '''Prefetch the repositories, given as pairs of SCM and URL, in parallel.
+    Returns False if fetching any of them failed.'''
+
+    import multiprocessing.pool
+
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        results = pool.map(lambda x: prefetch_repo(repocachedir, x[0], x[1],
+                                                   kwargs),
+                           repos)
+    finally:
+        pool.close()
+        pool.join()
+
+    return all(results)
+
+
+# Fields of webhook payloads (GitHub, GitLab, Gitea, ...) naming the
+# repository pushed to
+PUSH_URL_FIELDS = ['clone_url', 'git_http_url', 'git_url', 'ssh_url',
+                   'git_ssh_url', 'url', 'html_url']
+# bytes of push notifications read at most
+PUSH_MAX_LENGTH = 1024 * 1024
+
+
+def _pushed_repos(repocachedir, path, body):
+    '''Return the SCM and URL of the cached repositories to prefetch for a
+    push notification posted to path with the JSON payload body. These are
+    the ones given by url query parameters and the first one of the URLs in
+    the payload. Anyone may post, so repositories not cached yet are never
+    fetched.'''
+
+    import json
+    import urlparse
+
+    query = urlparse.parse_qs(urlparse.urlparse(path)[4])
+    repos = [(_cached_scm(repocachedir, url), url)
+             for url in query.get('url', [])
+             if _cached_scm(repocachedir, url)]
+
+    if body.strip():
+        payload = json.loads(body)
+        objects = [payload]
+        if isinstance(payload, dict):
+            objects.extend([payload.get('repository'), payload.get('project')])
+        for obj in [x for x in objects if isinstance(x, dict)]:
+            urls = [obj[field] for field in PUSH_URL_FIELDS
+                    if isinstance(obj.get(field), basestring)]
+            cached = [url for url in urls if _cached_scm(repocachedir, url)]
+            if cached:
+                repos.append((_cached_scm(repocachedir, cached[0]),
+                              str(cached[0])))
+                break
+
+    return repos
+
+
+def serve_prefetch(address, repocachedir, jobs, kwargs):
+    '''Accept push notifications via HTTP POST requests on address and
+    prefetch the repositories pushed to, at most jobs at a time. Pushes
+    arriving while a repository is waiting to be prefetched are covered by
+    that prefetch.'''
+
+    import BaseHTTPServer
+    import SocketServer
+    import signal
+
+    slots = threading.Semaphore(jobs)
+    pending = set()
+    pending_lock = threading.Lock()
+
+    def prefetch_pushed(repo):
+        slots.acquire()
+        try:
+            pending_lock.acquire()
+            pending.discard(repo)
+            pending_lock.release()
+            prefetch_repo(repocachedir, repo[0], repo[1], kwargs)
+        finally:
+            slots.release()
+
+    class PushHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > PUSH_MAX_LENGTH:
+                    self.reply(413, "Payload exceeds %d bytes\n" %
+                               PUSH_MAX_LENGTH)
+                    return
+                repos = _pushed_repos(repocachedir, self.path,
+                                      self.rfile.read(length))
+            except ValueError, e:
+                self.reply(400, "Invalid payload: %s\n" % e)
+                return
+            if not repos:
+                self.reply(404, "No cached repository\n")
+                return
+
+            for repo in repos:
+                pending_lock.acquire()
+                queued = repo in pending
+                pending.add(repo)
+                pending_lock.release()
+                if not queued:
+                    thread = threading.Thread(target=prefetch_pushed,
+                                              args=(repo,))
+                    thread.daemon = True
+                    thread.start()
+            self.reply(202, ''.join(["Prefetching %s\n" % url
+                                     for _, url in repos]))
+
+        def reply(self, code, message):
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(message)))
+            self.end_headers()
+            self.wfile.write(message)
+
+        def log_message(self, fmt, *args):
+            logging.debug("%s: %s", self.client_address[0], fmt % args)
+
+    class PushServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = PushServer(address, PushHandler)
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    logging.info("Listening on %s:%d for push notifications",
+                 *server.server_address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
 def get_repocache_hash(scm, url, subdir):
     '''Calculate hash fingerprint for repository cache.'''
 
+    import hashlib
+
     digest = hashlib.new('sha256')
     digest.update(url)
     if scm == 'svn':
@@ -471,191 +2434,532 @@ def get_repocache_hash(scm, url, subdir):
     return digest.hexdigest()
 
 
-def read_changes_revision(url, srcdir, outdir):
-    """Reads the _servicedata file and returns a dictionary with 'revision' on
-    success. As a side-effect it creates the _servicedata file if it doesn't
-    exist. 'revision' is None in that case.
-    """
-
-    change = {
-        'revision': None,
-        'url': url,
-    }
-
-    try:
-        # If lxml is available, we can use a parser that doesn't
-        # destroy comments
-        import lxml.etree as ET
-        xml_parser = ET.XMLParser(remove_comments=False)
-    except ImportError:
-        import xml.etree.ElementTree as ET
-        xml_parser = None
+class ServiceData(object):
+    '''In-memory model of the _servicedata file. It is parsed once, the
+    changesrevision of any number of tar_scm services can be queried and
+    updated, and it is written back once to the output directory.'''
 
-    create_servicedata, tar_scm_service = False, None
-    tar_scm_xmlstring = """  <service name=\"tar_scm\">
+    service_xmlstring = """  <service name=\"tar_scm\">
     <param name=\"url\">%s</param>
   </service>
-""" % url
-    root = None
-    try:
-        tree = ET.parse(os.path.join(srcdir, "_servicedata"),
-                        parser=xml_parser)
-        root = tree.getroot()
-        for service in root.findall("service[@name='tar_scm']"):
+"""
+    param_xmlstring = "    <param name=\"%s\">%s</param>\n"
+
+    def __init__(self, srcdir):
+        try:
+            # If lxml is available, we can use a parser that doesn't
+            # destroy comments
+            import lxml.etree as ET
+            xml_parser = ET.XMLParser(remove_comments=False)
+        except ImportError:
+            import xml.etree.ElementTree as ET
+            xml_parser = None
+
+        self.ET = ET
+        self.filename = os.path.join(srcdir, "_servicedata")
+        self.changed = False
+
+        if os.path.isfile(self.filename) and \
+                os.path.getsize(self.filename) > 0:
+            tree = ET.parse(self.filename, parser=xml_parser)
+            self.root = tree.getroot()
+        else:
+            # File doesn't exist or is empty
+            self.root = ET.fromstring("<servicedata>\n</servicedata>\n")
+            self.changed = True
+
+    def _find_service(self, url):
+        for service in self.root.findall("service[@name='tar_scm']"):
             for param in service.findall("param[@name='url']"):
                 if param.text == url:
-                    tar_scm_service = service
-                    break
-        if tar_scm_service is not None:
-            params = tar_scm_service.findall("param[@name='changesrevision']")
-            if len(params) == 1:
-                # Found what we searched for!
-                change['revision'] = params[0].text
-        else:
-            # File exists, is well-formed but does not contain the service
-            # we search
-            root.append(ET.fromstring(tar_scm_xmlstring))
-            create_servicedata = True
-    except IOError as e:
-        # File doesnt exist
-        root = ET.fromstring("<servicedata>\n%s</servicedata>\n" %
-                             tar_scm_xmlstring)
-        create_servicedata = True
-    except ET.ParseError as e:
-        if e.message.startswith("Document is empty"):
-            # File is empty
-            root = ET.fromstring("<servicedata>\n%s</servicedata>\n" %
-                                 tar_scm_xmlstring)
-            create_servicedata = True
-        else:
-            # File is corrupt
-            raise
+                    return service
+        return None
 
-    if create_servicedata:
-        ET.ElementTree(root).write(os.path.join(outdir, "_servicedata"))
-    else:
-        if not os.path.samefile(os.path.join(srcdir, "_servicedata"),
-                                os.path.join(outdir, "_servicedata")):
-            shutil.copy(os.path.join(srcdir, "_servicedata"),
-                        os.path.join(outdir, "_servicedata"))
+    def get_param(self, url, name):
+        '''Return the value of parameter name recorded for url or None.'''
 
-    return change
+        service = self._find_service(url)
+        if service is None:
+            return None
+        params = service.findall("param[@name='%s']" % name)
+        if len(params) != 1:
+            return None
+        return params[0].text
+
+    def set_param(self, url, name, value):
+        '''Record value as parameter name for url.'''
+
+        service = self._find_service(url)
+        if service is None:
+            service = self.ET.fromstring(self.service_xmlstring % url)
+            self.root.append(service)
+            self.changed = True
+
+        params = service.findall("param[@name='%s']" % name)
+        if len(params) == 1:  # already present, just update
+            if params[0].text != value:
+                params[0].text = value
+                self.changed = True
+        else:  # not present, add param element
+            service.append(self.ET.fromstring(self.param_xmlstring %
+                                              (name, value)))
+            self.changed = True
+
+    def get_revision(self, url):
+        '''Return the changesrevision recorded for url or None.'''
+
+        return self.get_param(url, 'changesrevision')
 
+    def set_revision(self, url, revision):
+        '''Record revision as changesrevision for url.'''
+
+        self.set_param(url, 'changesrevision', revision)
+
+    def write(self, outdir):
+        '''Write the _servicedata file to outdir. The file is replaced
+        atomically by renaming a temporary file.'''
+
+        dst = os.path.join(outdir, "_servicedata")
+        if not self.changed and os.path.exists(dst) and \
+                os.path.samefile(self.filename, dst):
+            return
+
+        logging.debug("Updating %s", dst)
+
+        output = OutputFile(dst)
+        try:
+            if self.changed:
+                self.ET.ElementTree(self.root).write(output.fp)
+            else:
+                src_fp = open(self.filename, 'r')
+                shutil.copyfileobj(src_fp, output.fp)
+                src_fp.close()
+            output.commit()
+        finally:
+            output.abort()
 
-def write_changes_revision(url, outdir, revision):
-    '''Updates the changesrevision in the _servicedata file. '''
 
-    logging.debug("Updating %s", os.path.join(outdir, '_servicedata'))
+def format_changes_entry(lines, version, author):
+    '''Format a *.changes file entry for the given change log lines.'''
 
+    import datetime
+
+    entry = '-' * 66 + '\n'
+    entry += "%s - %s\n" % (
+        datetime.datetime.utcnow().strftime('%a %b %d %H:%M:%S UTC %Y'),
+        author)
+    entry += '\n'
+    entry += "- Update to version %s:\n" % version
+    for line in lines:
+        entry += " + %s\n" % line
+    entry += '\n'
+    return entry
+
+
+def write_changes(changes_filename, entry):
+    '''Prepend entry to given *.changes file.'''
+
+    logging.debug("Writing changes file %s", changes_filename)
+
+    changes = OutputFile(changes_filename)
     try:
-        # If lxml is available, we can use a parser that doesn't
-        # destroy comments
-        import lxml.etree as ET
-        xml_parser = ET.XMLParser(remove_comments=False)
-    except ImportError:
-        import xml.etree.ElementTree as ET
-        xml_parser = None
+        changes.write(entry)
 
-    tree = ET.parse(os.path.join(outdir, "_servicedata"), parser=xml_parser)
-    root = tree.getroot()
-    changed, tar_scm_service = False, None
-    for service in root.findall("service[@name='tar_scm']"):
-        for param in service.findall("param[@name='url']"):
-            if param.text == url:
-                tar_scm_service = service
-                break
-    if tar_scm_service is not None:
-        changerev_params = \
-            tar_scm_service.findall("param[@name='changesrevision']")
-        if len(changerev_params) == 1:  # already present, just update
-            if changerev_params[0].text != revision:
-                changerev_params[0].text = revision
-                changed = True
-        else:  # not present, add changesrevision element
-            tree = ET.fromstring(
-                "    <param name=\"changesrevision\">%s</param>\n"
-                % revision)
-            tar_scm_service.append(tree)
-            changed = True
-        if changed:
-            tree.write(os.path.join(outdir, "_servicedata"))
+        old_fp = open(changes_filename, 'r')
+        shutil.copyfileobj(old_fp, changes.fp)
+        old_fp.close()
+
+        changes.commit()
+    finally:
+        changes.abort()
+
+
+def get_current_revision_git(repodir):
+    '''Return the commit checked out in a GIT repository.'''
+
+    return safe_run(['git', 'log', '-n1', '--pretty=format:%H'],
+                    cwd=repodir)[1]
+
+
+def get_current_revision_svn(repodir):
+    '''Return the last changed revision of a SVN working copy.'''
+
+    svn_info = safe_run(['svn', 'info'], repodir)[1]
+
+    match = re.search('Last Changed Rev: (.*)', svn_info, re.MULTILINE)
+    if match:
+        return match.group(1).strip()
+    return None
+
+
+def get_current_revision_hg(repodir):
+    '''Return the changeset checked out in a HG repository.'''
+
+    return safe_run(['hg', 'log', '-l1', '-r.', '--template', '{node}'],
+                    repodir)[1]
+
+
+def get_current_revision_bzr(repodir):
+    '''Return the revision number of a BZR checkout.'''
+
+    return safe_run(['bzr', 'revno', '--tree'], repodir)[1].strip()
+
+
+def _parse_commit_date(text):
+    '''Return the seconds since the epoch of a date like
+    "2014-09-09 18:37:39 +0200", or None.'''
+
+    import calendar
+
+    match = re.search(r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):'
+                      r'([0-9]{2}):([0-9]{2}) ([-+])([0-9]{2})([0-9]{2})',
+                      text)
+    if not match:
+        return None
+    fields = [int(x) for x in match.group(1, 2, 3, 4, 5, 6, 8, 9)]
+    offset = (fields[6] * 60 + fields[7]) * 60
+    if match.group(7) == '-':
+        offset = -offset
+    return calendar.timegm(fields[:6]) - offset
+
+
+def get_commit_time_git(repodir):
+    '''Return the commit time of the commit checked out in a GIT
+    repository.'''
+
+    return int(safe_run(['git', 'log', '-n1', '--pretty=format:%ct'],
+                        cwd=repodir)[1])
+
+
+def get_commit_time_svn(repodir):
+    '''Return the time of the last changed revision of a SVN working
+    copy.'''
+
+    svn_info = safe_run(['svn', 'info'], repodir)[1]
+
+    match = re.search('Last Changed Date: (.*)', svn_info, re.MULTILINE)
+    if match:
+        return _parse_commit_date(match.group(1))
+    return None
+
+
+def get_commit_time_hg(repodir):
+    '''Return the commit time of the changeset checked out in a HG
+    repository.'''
+
+    # "1375437706 -3600", the first number is timezone-agnostic
+    return int(safe_run(['hg', 'log', '-l1', '-r.', '--template',
+                         '{date|hgdate}'], repodir)[1].split()[0])
+
+
+def get_commit_time_bzr(repodir):
+    '''Return the commit time of the revision of a BZR checkout.'''
+
+    return _parse_commit_date(safe_run(
+        ['bzr', 'version-info', '--custom', '--template={date}'],
+        repodir)[1])
+
+
+COMMIT_TIME_COMMANDS = {
+    'git': get_commit_time_git,
+    'svn': get_commit_time_svn,
+    'hg':  get_commit_time_hg,
+    'bzr': get_commit_time_bzr,
+}
+
+
+def read_changes_log_git(repodir, last_rev, current_rev, max_entries):
+    '''Yield the GIT commit subjects after last_rev, newest first.'''
+
+    command = ['git', 'log', '--no-merges', '--pretty=tformat:%s',
+               '-n%d' % max_entries]
+    if last_rev is None:
+        command.append(current_rev)
+    elif not _git_has_commit(repodir, last_rev):
+        # e.g. the branch was force-pushed, see _fetch_changesrevision_git()
+        logging.warning("%s: No such commit, not listing the changes since",
+                        last_rev)
+        command.extend(['-n0', current_rev])
     else:
-        sys.exit("File _servicedata is missing tar_scm with URL '%s'" % url)
+        command.append("%s..%s" % (last_rev, current_rev))
+    return run_lines(command, repodir)
 
 
-def write_changes(changes_filename, changes, version, author):
-    '''Add changes to given *.changes file.'''
+def read_changes_log_svn(repodir, last_rev, current_rev, max_entries):
+    '''Yield the first line of the SVN log messages after last_rev, newest
+    first.'''
 
-    if changes is None:
+    if last_rev is None:
+        last_rev = 0
+    elif int(last_rev) >= int(current_rev):
         return
+    command = ['svn', 'log', '--non-interactive', '-l%d' % max_entries,
+               '-r%s:%d' % (current_rev, int(last_rev) + 1)]
 
-    logging.debug("Writing changes file %s", changes_filename)
+    # Entries look like this; the message may be empty:
+    #
+    # ------------------------------------------------------------------------
+    # r2 | author | 2014-09-09 18:37:39 +0200 (Tue, 09 Sep 2014) | 1 line
+    #
+    # message
+    in_header = False
+    for line in run_lines(command, repodir):
+        if re.match(r'^r[0-9]+ \| ', line):
+            in_header = True
+        elif re.match('^-{72}$', line):
+            in_header = False
+        elif in_header and line:
+            in_header = False
+            yield line
+
+
+def read_changes_log_hg(repodir, last_rev, current_rev, max_entries):
+    '''Yield the first line of the HG commit messages after last_rev, newest
+    first.'''
 
-    tmp_fp = tempfile.NamedTemporaryFile(delete=False)
-    tmp_fp.write('-' * 66 + '\n')
-    tmp_fp.write("%s - %s\n" % (
-        datetime.datetime.utcnow().strftime('%a %b %d %H:%M:%S UTC %Y'),
-        author))
-    tmp_fp.write('\n')
-    tmp_fp.write("- Update to version %s:\n" % version)
-    for line in changes.split(os.linesep):
-        tmp_fp.write(" + %s\n" % line)
-    tmp_fp.write('\n')
+    if last_rev is None:
+        revset = "reverse(::%s)" % current_rev
+    else:
+        revset = "reverse(%s::%s) - %s" % (last_rev, current_rev, last_rev)
+    return run_lines(['hg', 'log', '--no-merges', '-l%d' % max_entries,
+                      '-r', revset, '--template', '{desc|firstline}\n'],
+                     repodir)
 
-    old_fp = open(changes_filename, 'r')
-    tmp_fp.write(old_fp.read())
-    old_fp.close()
 
-    tmp_fp.close()
+def read_changes_log_bzr(repodir, last_rev, current_rev, max_entries):
+    '''Yield the first line of the BZR commit messages after last_rev,
+    newest first.'''
 
-    os.rename(tmp_fp.name, changes_filename)
+    if last_rev is None:
+        last_rev = 0
+    elif int(last_rev) >= int(current_rev):
+        return
+    command = ['bzr', 'log', '--line', '-l%d' % max_entries,
+               '-r%d..%s' % (int(last_rev) + 1, current_rev)]
+
+    # Lines look like "2: author 2014-09-09 message"
+    for line in run_lines(command, repodir):
+        match = re.match(r'^\s*[0-9.]+: .*? [0-9]{4}-[0-9]{2}-[0-9]{2} (.*)$',
+                         line)
+        if match:
+            yield match.group(1)
+
+
+CHANGES_COMMANDS = {
+    'git': (get_current_revision_git, read_changes_log_git),
+    'svn': (get_current_revision_svn, read_changes_log_svn),
+    'hg':  (get_current_revision_hg, read_changes_log_hg),
+    'bzr': (get_current_revision_bzr, read_changes_log_bzr),
+}
 
 
-def detect_changes_commands_git(repodir, changes):
-    '''Detect changes between GIT revisions.'''
+def detect_changes(scm, last_rev, repodir, max_entries):
+    '''Detect changes since revision last_rev. At most max_entries log
+    messages are returned, oldest first.'''
 
-    last_rev = changes['revision']
+    get_current_revision, read_changes_log = CHANGES_COMMANDS[scm]
 
-    if last_rev is None:
-        last_rev = safe_run(['git', 'log', '-n1', '--pretty=format:%H',
-                             '--skip=10'], cwd=repodir)[1]
-    current_rev = safe_run(['git', 'log', '-n1', '--pretty=format:%H'],
-                           cwd=repodir)[1]
+    current_rev = get_current_revision(repodir)
 
     if last_rev == current_rev:
         logging.debug("No new commits, skipping changes file generation")
         return
 
+    if last_rev is None:
+        # no previous run, only report the most recent commits
+        max_entries = min(max_entries, 10)
+
     logging.debug("Generating changes between %s and %s", last_rev,
                   current_rev)
 
-    lines = safe_run(['git', 'log', '--no-merges', '--pretty=tformat:%s',
-                      "%s..%s" % (last_rev, current_rev)], repodir)[1]
+    log = read_changes_log(repodir, last_rev, current_rev, max_entries)
+    lines = list(itertools.islice(log, max_entries))
+    log.close()
+    lines.reverse()
 
-    changes['revision'] = current_rev
-    changes['lines'] = '\n'.join(reversed(lines.split('\n')))
-    return changes
+    return {
+        'revision': current_rev,
+        'lines': lines,
+    }
 
 
-def detect_changes(scm, url, repodir, outdir):
-    '''Detect changes between revisions.'''
+def probe_remote_git(url, revision, subdir):
+    '''Resolve a GIT branch or tag to a commit with git ls-remote.'''
 
+    if revision is None:
+        revision = 'master'
+
+    refs = {}
+    output = safe_run(['git', 'ls-remote', url, revision, revision + '^{}'],
+                      cwd=None)[1]
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 2:
+            refs[fields[1]] = fields[0]
+
+    # same precedence as switch_revision_git: branches before tags
+    for ref in ['refs/heads/' + revision, 'refs/tags/' + revision + '^{}',
+                'refs/tags/' + revision, revision + '^{}', revision]:
+        if ref in refs:
+            return refs[ref]
+
+    if re.match('^[0-9a-f]{40}$', revision):
+        return revision
+    if re.match('^[0-9a-f]{4,39}$', revision):
+        # abbreviated commits can only be resolved in a clone
+        return None
+    if revision.startswith('refs/') or (re.match(r'^[\w.+-]+$', revision) and
+                                        '..' not in revision):
+        sys.exit('%s: No such revision' % revision)
+    # other commit-ish revisions (HEAD~1, origin/foo, ...) can only be
+    # resolved in a clone
+    return None
+
+
+def _probe_failed(exc, revision, pattern):
+    '''Exit with a "No such revision" error if the output of the failed probe
+    command matches pattern, otherwise re-raise the original error.'''
+
+    if re.search(pattern, str(exc)):
+        sys.exit('%s: No such revision' % revision)
+    raise exc
+
+
+def probe_remote_svn(url, revision, subdir):
+    '''Return the last changed revision of the SVN URL.'''
+
+    command = ['svn', 'info', '--non-interactive']
+    if revision:
+        command.extend(['-r', revision])
+    command.append(_svn_url(url, subdir))
     try:
-        changes = read_changes_revision(url, os.getcwd(), outdir)
-    except Exception, e:
-        sys.exit("_servicedata: Failed to parse (%s)" % e)
+        svn_info = safe_run(command, cwd=None)[1]
+    except SystemExit as exc:
+        _probe_failed(exc, revision, 'E160006|E195012')
 
-    detect_changes_commands = {
-        'git': detect_changes_commands_git,
-    }
+    match = re.search('Last Changed Rev: (.*)', svn_info, re.MULTILINE)
+    if match:
+        return match.group(1).strip()
+    return None
 
-    return detect_changes_commands[scm](repodir, changes)
+
+def probe_remote_hg(url, revision, subdir):
+    '''Resolve a HG revision to a changeset with hg identify.'''
+
+    if revision is None:
+        revision = 'tip'
+    if revision.isdigit():
+        # revision numbers are local to each repository
+        return None
+
+    try:
+        output = safe_run(['hg', 'identify', '--debug', '-i', '-r', revision,
+                           url], cwd=None)[1]
+    except SystemExit as exc:
+        _probe_failed(exc, revision, 'unknown revision')
+
+    match = re.search('^([0-9a-f]{40})$', output, re.MULTILINE)
+    if match:
+        return match.group(1)
+    return None
+
+
+def probe_remote_bzr(url, revision, subdir):
+    '''Return the revision number of a BZR branch.'''
+
+    command = ['bzr', 'revno']
+    if revision:
+        command.extend(['-r', revision])
+    command.append(url)
+    try:
+        return safe_run(command, cwd=None)[1].strip()
+    except SystemExit as exc:
+        _probe_failed(exc, revision,
+                      'does not exist in branch|No namespace registered')
+
+
+PROBE_REMOTE_COMMANDS = {
+    'git': probe_remote_git,
+    'svn': probe_remote_svn,
+    'hg':  probe_remote_hg,
+    'bzr': probe_remote_bzr,
+}
+
+
+def probe_remote(scm, url, revision, subdir, url_rewrites):
+    '''Resolve revision on the remote repository without fetching it. The
+    result is comparable to the changesrevision recorded in _servicedata, or
+    None if the remote can't resolve revision. Exits if revision doesn't
+    exist.
+
+    Like fetch_upstream(), the mirror of url is probed first, falling back to
+    url if that fails.'''
+
+    sources = [url]
+    mirror = rewrite_url(url, url_rewrites)
+    if mirror:
+        sources.insert(0, mirror)
+    for source in sources:
+        try:
+            current_rev = PROBE_REMOTE_COMMANDS[scm](source, revision, subdir)
+            break
+        except SystemExit:
+            if source == url:
+                raise
+            logging.warning("Probing mirror %s failed, falling back to %s",
+                            source, url)
+    logging.debug("Remote revision of %s: %s", url, current_rev)
+    return current_rev
+
+
+def archive_params_hash(args):
+    '''Return a hash of the parameters affecting the archive created from
+    a given revision, so archives of other parameters aren't reused.'''
+
+    import hashlib
+    import json
+
+    params = dict((name, getattr(args, name)) for name in [
+        'scm', 'version', 'versionformat', 'versionprefix', 'extension',
+        'archive_format', 'output', 'include', 'exclude', 'package_meta',
+        'submodules', 'lfs', 'dedupe', 'tar_writer'])
+    return hashlib.sha256(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+def find_unchanged_files(servicedata, url, srcdir, current_rev, params):
+    '''Return the names and paths of the files created by the last run if
+    they were created from current_rev with the parameters hashed to params
+    and are all still present in srcdir, or None.'''
+
+    if current_rev is None or servicedata.get_revision(url) != current_rev:
+        return None
+    if servicedata.get_param(url, 'tarballparams') != params:
+        return None
+
+    files = []
+    for param in ['tarball', 'obsinfo']:
+        name = servicedata.get_param(url, param)
+        if not name:
+            if param == 'tarball':
+                return None
+            continue
+        for path in [os.path.join(srcdir, x)
+                     for x in [name, '_service:tar_scm:' + name]]:
+            if os.path.isfile(path):
+                files.append((name, path))
+                break
+        else:
+            return None
+    return files
 
 
 def get_config_options():
     '''Read user-specific and system-wide service configuration files, if not
     in test-mode. This function returns an instance of ConfigParser.'''
 
+    import ConfigParser
+    import StringIO
+
     config = ConfigParser.RawConfigParser()
     config.optionxform = str
 
@@ -677,6 +2981,9 @@ def get_config_options():
         except (OSError, IOError):
             continue
 
+    if not config.has_section('tar_scm'):
+        return config
+
     # strip quotes from pathname
     for opt in config.options('tar_scm'):
         config.set('tar_scm', opt, re.sub(r'"(.*)"', r'\1',
@@ -685,13 +2992,614 @@ def get_config_options():
     return config
 
 
-if __name__ == '__main__':
+def get_repocachedir():
+    '''Return the repository cache directory or None if caching is disabled.
+    The environment overrides the user and system wide configuration.'''
+
+    import ConfigParser
+
+    repocachedir = os.getenv('CACHEDIRECTORY')
+    if repocachedir is None:
+        config = get_config_options()
+        try:
+            repocachedir = config.get('tar_scm', 'CACHEDIRECTORY')
+        except ConfigParser.Error:
+            pass
+
+    return repocachedir
+
+
+def get_scratchdir():
+    '''Return the directory for temporary clones and staging trees, or None
+    if they are created in the output directory. The environment overrides
+    the user and system wide configuration.'''
+
+    import ConfigParser
+
+    scratchdir = os.getenv('SCRATCHDIRECTORY')
+    if scratchdir is None:
+        config = get_config_options()
+        try:
+            scratchdir = config.get('tar_scm', 'SCRATCHDIRECTORY')
+        except ConfigParser.Error:
+            pass
+
+    return scratchdir or None
+
+
+def get_url_rewrites():
+    '''Return the URL rewrite rules as list of (pattern, replacement), in
+    the order of their names. Rules are read from the URLREWRITE* options of
+    the configuration and the environment, which overrides the
+    configuration.
+
+    A pattern is either a URL prefix which is replaced, or a regular
+    expression prefixed with "re:" whose match is substituted.'''
+
+    options = {}
+    config = get_config_options()
+    if config.has_section('tar_scm'):
+        for opt in config.options('tar_scm'):
+            if opt.startswith('URLREWRITE'):
+                options[opt] = config.get('tar_scm', opt)
+    for opt, value in os.environ.items():
+        if opt.startswith('URLREWRITE'):
+            options[opt] = value
+
+    rules = []
+    for opt in sorted(options):
+        rule = options[opt].split()
+        if len(rule) != 2:
+            sys.exit("%s: expected a pattern and a replacement URL" % opt)
+        if rule[0].startswith('re:'):
+            try:
+                re.compile(rule[0][3:])
+            except re.error, e:
+                sys.exit("%s: invalid regular expression (%s)" % (opt, e))
+        rules.append((rule[0], rule[1]))
+    return rules
+
+
+def rewrite_url(url, rules):
+    '''Return the URL of the mirror url is fetched from according to the
+    first matching rule, or None.'''
+
+    for pattern, replacement in rules:
+        if pattern.startswith('re:'):
+            match = re.match(pattern[3:], url)
+            if match:
+                return match.expand(replacement) + url[match.end():]
+        elif url.startswith(pattern):
+            return replacement + url[len(pattern):]
+    return None
+
+
+def get_daemon_socket():
+    '''Return the socket of the daemon invocations are handed to, or None.
+    The environment overrides the user and system wide configuration.'''
+
+    import ConfigParser
+
+    sockname = os.getenv('TAR_SCM_DAEMON')
+    if sockname is None:
+        config = get_config_options()
+        try:
+            sockname = config.get('tar_scm', 'DAEMONSOCKET')
+        except ConfigParser.Error:
+            pass
+
+    return sockname or None
+
+
+def get_durability():
+    '''Return the durability of the files written, see OutputFile. The
+    environment overrides the user and system wide configuration.'''
+
+    import ConfigParser
+
+    durability = os.getenv('TAR_SCM_DURABILITY')
+    if durability is None:
+        config = get_config_options()
+        try:
+            durability = config.get('tar_scm', 'DURABILITY')
+        except ConfigParser.Error:
+            pass
+
+    durability = durability or 'none'
+    if durability not in ('none', 'file', 'dir'):
+        sys.exit("%s: Invalid durability, use none, file or dir" %
+                 durability)
+    return durability
+
+
+def get_failure_ttl():
+    '''Return the number of seconds failures to fetch a revision are
+    remembered in the cache, 0 if they aren't. The environment overrides the
+    user and system wide configuration.'''
+
+    import ConfigParser
+
+    ttl = os.getenv('TAR_SCM_FAILURE_TTL')
+    if ttl is None:
+        config = get_config_options()
+        try:
+            ttl = config.get('tar_scm', 'FAILURETTL')
+        except ConfigParser.Error:
+            pass
+
+    ttl = ttl or '300'
+    if not ttl.isdigit():
+        sys.exit("%s: Invalid failure TTL, use a number of seconds" % ttl)
+    return int(ttl)
+
+
+# environment variables passed on to the jobs run by the daemon
+DAEMON_ENV = ['LANG', 'CACHEDIRECTORY', 'SCRATCHDIRECTORY',
+              'http_proxy', 'https_proxy', 'ftp_proxy', 'all_proxy',
+              'no_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'FTP_PROXY',
+              'ALL_PROXY', 'NO_PROXY']
+DAEMON_ENV_PREFIXES = ['TAR_SCM_', 'URLREWRITE']
+
+# not exported by the socket module of Python 2
+SO_PEERCRED = 17
+
+
+def daemon_env(env):
+    '''Return the variables of the environment env passed on to daemon
+    jobs.'''
+
+    return dict((name, value) for name, value in env.items()
+                if name in DAEMON_ENV or
+                any(name.startswith(p) for p in DAEMON_ENV_PREFIXES))
+
+
+# options of invocations which aren't service runs, run by tar_scm itself
+LOCAL_OPTIONS = ['--daemon', '--prefetch', '--prefetch-listen',
+                 '--maintain-cache']
+
+
+def is_daemon_job(argv):
+    '''Tell whether the invocation argv is a service run, which can be handed
+    to the daemon. Abbreviated options are recognized like argparse does.'''
+
+    for arg in argv:
+        opt = arg.split('=', 1)[0]
+        if opt.startswith('--') and len(opt) > 2 and \
+                any(name.startswith(opt) for name in LOCAL_OPTIONS):
+            return False
+    return True
+
+
+def run_daemon_job(sockname, argv):
+    '''Hand the invocation to the daemon listening on sockname and print its
+    output. Returns the exit status of the job, or None if the daemon isn't
+    reachable and the job has to be run locally.'''
+
+    import json
+    import socket
+
+    try:
+        request = json.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': daemon_env(os.environ),
+        })
+    except UnicodeDecodeError:
+        logging.debug("Not UTF-8, running locally")
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockname)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.sendall(request + '\n')
+        sock_fp = sock.makefile('rb')
+        header = sock_fp.readline().split()
+        if len(header) != 3:
+            sys.exit("%s: daemon closed the connection" % sockname)
+        status, stdout_length, stderr_length = [int(x) for x in header]
+        sys.stdout.write(sock_fp.read(stdout_length))
+        sys.stdout.flush()
+        sys.stderr.write(sock_fp.read(stderr_length))
+        sys.stderr.flush()
+        sock_fp.close()
+    finally:
+        sock.close()
+
+    return status
+
+
+def run_job(argv, cwd, env, stdout_fp, stderr_fp, trace=None, job_id=None):
+    '''Run one invocation in a forked daemon worker process, just like a
+    separate tar_scm process would, with the environment of the daemon
+    overridden by env. Its output goes to the files stdout_fp and
+    stderr_fp. If trace is given, the trace events of the job are appended
+    to it on the track job_id. Returns the exit status.'''
+
+    import signal
+    import traceback
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.chdir(cwd)
+    # variables the client left unset mustn't be taken from the daemon
+    job_env = dict((name, value) for name, value in os.environ.items()
+                   if name not in daemon_env(os.environ))
+    job_env.update(env)
+    os.environ.clear()
+    os.environ.update(job_env)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(stdout_fp.fileno(), sys.stdout.fileno())
+    os.dup2(stderr_fp.fileno(), sys.stderr.fileno())
+    logging.getLogger().setLevel(logging.INFO)
+
+    if trace:
+        TRACE.enable(job_id, ' '.join(['Job %d:' % job_id] + argv))
+        TRACE.filenames = [trace]
+    else:
+        TRACE.events = None
+        TRACE.filenames = []
+
+    status = 0
+    try:
+        main(argv, use_daemon=False)
+    except SystemExit, e:
+        status = e.code
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        if CLEANUP_DIRS:
+            cleanup(CLEANUP_DIRS)
+            del CLEANUP_DIRS[:]
+        TRACE.flush()
+
+    if status is None:
+        status = 0
+    elif not isinstance(status, int):
+        sys.stderr.write("%s\n" % status)
+        status = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return status
+
+
+def _job_repohash(argv):
+    '''Return the repository cache hash of the invocation argv without fully
+    parsing it, or None if it doesn't name a repository.'''
+
+    opts = {'--scm': '', '--subdir': ''}
+    for i, arg in enumerate(argv):
+        for opt in ['--scm', '--url', '--subdir']:
+            if arg == opt and i + 1 < len(argv):
+                opts[opt] = argv[i + 1]
+            elif arg.startswith(opt + '='):
+                opts[opt] = arg[len(opt) + 1:]
+
+    if '--url' not in opts:
+        return None
+    return get_repocache_hash(opts['--scm'], opts['--url'], opts['--subdir'])
+
+
+# seconds a client may take to send its request or receive the output
+DAEMON_TIMEOUT = 60
+
+
+def serve_daemon(sockname, jobs, trace=None):
+    '''Accept invocations on the Unix socket sockname and run up to jobs of
+    them at once, each in a freshly forked worker process which inherits
+    the loaded modules but no state from previous jobs. Invocations for the
+    same repository are run one after the other, so they don't occupy
+    workers waiting for the cache lock. If trace is given, the trace events
+    of each job are appended to it once the job is done.
+
+    The daemon is single threaded, workers mustn't be forked while another
+    thread holds a lock, e.g. the one of a logging handler.'''
+
+    import errno
+    import json
+    import select
+    import signal
+    import socket
+    import struct
+    import tempfile
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(sockname):
+        try:
+            sock.connect(sockname)
+            sys.exit("%s: daemon already running" % sockname)
+        except socket.error:
+            os.unlink(sockname)
+        sock.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the daemon may connect, see also read_request
+    umask = os.umask(0177)
+    try:
+        sock.bind(sockname)
+    finally:
+        os.umask(umask)
+    sock.listen(128)
+
+    # wakes up select() when a worker exits
+    wakeup = os.pipe()
+    fcntl.fcntl(wakeup[1], fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup[1])
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    # the jobs waiting for a worker, in the order received
+    pending = []
+    # the jobs running, by worker PID
+    running = {}
+    # the repositories of the running jobs
+    busy = set()
+    job_ids = itertools.count(1)
+
+    def read_request(conn, job_id):
+        creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize('3i'))
+        uid = struct.unpack('3i', creds)[1]
+        if uid != os.getuid():
+            logging.error("Job %d: rejecting uid %d", job_id, uid)
+            return None
+
+        conn_fp = conn.makefile('rb')
+        request = json.loads(conn_fp.readline())
+        conn_fp.close()
+        argv = [arg.encode('utf-8') for arg in request['argv']]
+        env = daemon_env(dict((k.encode('utf-8'), v.encode('utf-8'))
+                              for k, v in request['env'].items()))
+        logging.info("Job %d: %s", job_id, ' '.join(argv))
+        return {'id': job_id, 'conn': conn, 'start': time.time(),
+                'argv': argv, 'cwd': request['cwd'].encode('utf-8'),
+                'env': env, 'repohash': _job_repohash(argv)}
+
+    def start_job(job):
+        job['stdout'] = tempfile.TemporaryFile()
+        job['stderr'] = tempfile.TemporaryFile()
+        pid = os.fork()
+        if pid:
+            running[pid] = job
+            if job['repohash']:
+                busy.add(job['repohash'])
+            return
+
+        status = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for other in pending + running.values() + [job]:
+                other['conn'].close()
+            sock.close()
+            os.close(wakeup[0])
+            os.close(wakeup[1])
+            status = run_job(job['argv'], job['cwd'], job['env'],
+                             job['stdout'], job['stderr'], trace, job['id'])
+        finally:
+            os._exit(status)
+
+    def finish_job(pid, wait_status):
+        job = running.pop(pid)
+        busy.discard(job['repohash'])
+        if os.WIFEXITED(wait_status):
+            status = os.WEXITSTATUS(wait_status)
+        else:
+            logging.error("Job %d: killed by signal %d", job['id'],
+                          os.WTERMSIG(wait_status))
+            status = 1
+        logging.info("Job %d: exit status %d", job['id'], status)
+
+        if trace:
+            # the daemon runs for long, so don't keep them in memory
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': TRACE.pid,
+                       'tid': job['id'],
+                       'args': {'name': 'Job %d' % job['id']}}]
+            for event in TRACE.complete_events('job', 'job', job['start'],
+                                               argv=job['argv'],
+                                               status=status):
+                if event['ph'] == 'X':
+                    events.append(dict(event, tid=job['id']))
+            write_trace(trace, events)
+
+        conn = job['conn']
+        try:
+            output = []
+            for output_fp in [job['stdout'], job['stderr']]:
+                output_fp.seek(0, os.SEEK_SET)
+                output.append(output_fp.read())
+                output_fp.close()
+            conn.sendall("%d %d %d\n" % (status, len(output[0]),
+                                         len(output[1])))
+            conn.sendall(output[0] + output[1])
+        except socket.error, e:
+            logging.error("Job %d failed: %s", job['id'], e)
+        finally:
+            conn.close()
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    logging.info("Listening on %s with %d workers", sockname, jobs)
+    try:
+        while True:
+            try:
+                readable = select.select([sock, wakeup[0]], [], [])[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = [wakeup[0]]
+
+            if sock in readable:
+                conn = sock.accept()[0]
+                conn.settimeout(DAEMON_TIMEOUT)
+                job_id = next(job_ids)
+                try:
+                    job = read_request(conn, job_id)
+                except Exception, e:
+                    logging.error("Job %d failed: %s", job_id, e)
+                    job = None
+                if job:
+                    pending.append(job)
+                else:
+                    conn.close()
+
+            if wakeup[0] in readable:
+                try:
+                    os.read(wakeup[0], 4096)
+                except OSError:
+                    pass
+                while running:
+                    pid, wait_status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        break
+                    finish_job(pid, wait_status)
+
+            for job in pending[:]:
+                if len(running) >= jobs:
+                    break
+                if job['repohash'] not in busy:
+                    pending.remove(job)
+                    start_job(job)
+    finally:
+        sock.close()
+        os.unlink(sockname)
+        for pid in running:
+            os.kill(pid, signal.SIGTERM)
+        for pid in running:
+            os.waitpid(pid, 0)
+
+
+class PipelineStep(object):
+    '''A step of a Pipeline, running in a thread of its own.'''
+
+    def __init__(self, pipeline, name, func, args, inputs, after):
+        self.pipeline = pipeline
+        self.result = None
+        self.error = None
+        # written to once the step is done, see get()
+        self.done = os.pipe()
+        self.thread = threading.Thread(name=name, target=self._run, args=(
+            pipeline, name, func, args, inputs, after))
+        # don't keep a terminated run waiting for its steps
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, pipeline, name, func, args, inputs, after):
+        try:
+            for step in after:
+                step.get()
+            args = args + tuple([step.get() for step in inputs])
+            pipeline.slots.acquire()
+            try:
+                if pipeline.cancelled:
+                    sys.exit("%s: Cancelled" % name)
+                self.result = pipeline.run(name, func, *args)
+            finally:
+                pipeline.slots.release()
+        except BaseException:
+            self.error = sys.exc_info()
+        os.write(self.done[1], '.')
+
+    def wait(self):
+        '''Wait for the step to be done.'''
+
+        import errno
+
+        if threading.current_thread() is self.pipeline.main_thread and \
+                self.done:
+            # unlike joining the thread, reading the pipe is interrupted by
+            # signals, so the main thread still handles them
+            while True:
+                try:
+                    os.read(self.done[0], 1)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+            os.close(self.done[0])
+            os.close(self.done[1])
+            self.done = None
+        self.thread.join()
+
+    def get(self):
+        '''Wait for the step and return its result. Errors of the step,
+        including those of the steps it depends on, are raised again.'''
+
+        self.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class Pipeline(object):
+    '''Run the steps of an invocation concurrently as soon as the steps
+    they depend on are done, at most jobs at a time, and record how long
+    each step took.'''
+
+    def __init__(self, jobs):
+        self.main_thread = threading.current_thread()
+        self.slots = threading.Semaphore(max(jobs, 1))
+        self.steps = []
+        self.cancelled = False
+        self.start = time.time()
+        self.timings = []
+
+    def run(self, name, func, *args):
+        '''Run the step name calling func(*args) in the calling thread.'''
+
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings.append((name, time.time() - start))
+            TRACE.complete(name, 'step', start)
+
+    def add(self, name, func, args=(), inputs=(), after=()):
+        '''Add the step name calling func with args followed by the results
+        of the steps inputs, once those and the steps after are done.'''
+
+        step = PipelineStep(self, name, func, args, inputs, after)
+        self.steps.append(step)
+        return step
+
+    def cancel(self):
+        '''Cancel the steps which haven't started yet and wait for the
+        others, e.g. before removing the directories they write to.'''
+
+        self.cancelled = True
+        for step in self.steps:
+            step.wait()
+
+    def report(self):
+        '''Log the time taken by each step and by the whole pipeline.'''
+
+        for name, elapsed in self.timings:
+            logging.debug("%-24s %8.3fs", name, elapsed)
+        logging.info("Steps took %.3fs, %.3fs elapsed",
+                     sum([elapsed for name, elapsed in self.timings]),
+                     time.time() - self.start)
+
+
+def parse_args(argv):
+    '''Parse and validate the command line arguments argv.'''
+
+    import argparse
+    import multiprocessing
+
     parser = argparse.ArgumentParser(description='Git Tarballs')
-    parser.add_argument('--scm', required=True,
+    parser.add_argument('--scm',
                         help='Used SCM')
-    parser.add_argument('--url', required=True,
+    parser.add_argument('--url',
                         help='upstream tarball URL to download')
-    parser.add_argument('--outdir', required=True,
+    parser.add_argument('--outdir',
                         help='osc service parameter that does nothing')
     parser.add_argument('--verbose', '-v', action='store_true', default=False,
                         help='enable verbose output')
@@ -711,6 +3619,9 @@ if __name__ == '__main__':
                         help='Whether or not to generate changes file entries '
                              'from SCM commit log since a given parent '
                              'revision (see changesrevision).')
+    parser.add_argument('--changesmaxentries', type=int, default=1000,
+                        help='Maximum number of commit log entries to add '
+                             'to the changes file.')
     parser.add_argument('--changesauthor',
                         help='The author of the changes file entry to be '
                              'written, defaults to first email entry in '
@@ -719,13 +3630,26 @@ if __name__ == '__main__':
     parser.add_argument('--filename',
                         help='name of package - used together with version '
                              'to determine tarball name')
-    parser.add_argument('--extension', default='tar',
+    parser.add_argument('--extension',
                         help='suffix name of package - used together with '
-                             'filename to determine tarball name')
+                             'filename to determine tarball name (default: '
+                             'tar, or obscpio for obscpio archives)')
+    parser.add_argument('--archive-format', choices=['tar', 'obscpio'],
+                        default='tar',
+                        help='Create a tar ball, or a cpio archive as used '
+                             'by obs_scm together with an .obsinfo file '
+                             'describing it.')
     parser.add_argument('--revision',
                         help='revision to package')
     parser.add_argument('--subdir', default='',
                         help='package just a sub directory')
+    parser.add_argument('--output', action='append', default=[],
+                        metavar='revision=REV,subdir=DIR,filename=NAME',
+                        help='Create an archive of the given revision and '
+                             'sub directory named after filename. May be '
+                             'given several times to create all archives '
+                             'from a single fetch. Omitted fields default '
+                             'to --revision, --subdir and --filename.')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--include', action='append', default=[],
                        help='for specifying subset of files/subdirectories to '
@@ -733,6 +3657,40 @@ if __name__ == '__main__':
     group.add_argument('--exclude', action='append', default=[],
                        help='for specifying excludes when creating the '
                             'tar ball')
+    parser.add_argument('--tar-writer', choices=['tarfile', 'fast'],
+                        default='tarfile',
+                        help='Implementation used to write the tar ball: '
+                             'Python\'s tarfile module or a faster writer '
+                             'using large buffers and memory mapped files. '
+                             'Unlike tarfile, it doesn\'t keep the members '
+                             'written in memory.')
+    parser.add_argument('--targeted-fetch', choices=['enable', 'disable'],
+                        default='disable',
+                        help='GIT only: Fetch just the branch, tag, commit '
+                             'or ref of the revision to package instead of '
+                             'all branches and tags of the remote.')
+    parser.add_argument('--dedupe', choices=['enable', 'disable'],
+                        default='disable',
+                        help='Store files of at least 4 KiB identical to '
+                             'one already in the tar ball as hard links to '
+                             'it. Memory use grows with the number of such '
+                             'files. Implies --tar-writer=fast.')
+    parser.add_argument('--probe-remote', choices=['enable', 'disable'],
+                        default='disable',
+                        help='Resolve the revision on the remote before '
+                             'fetching. Nonexistent revisions are rejected '
+                             'and, with changesgenerate, an unchanged '
+                             'revision reuses the existing tar ball.')
+    parser.add_argument('--force-retry', choices=['enable', 'disable'],
+                        default='disable',
+                        help='Fetch the revision even if fetching it failed '
+                             'recently. Such failures are otherwise '
+                             'remembered in the cache for a while and '
+                             'reported right away.')
+    parser.add_argument('--lfs', choices=['enable', 'disable'],
+                        default='disable',
+                        help='Package the contents of Git LFS or hg '
+                             'largefiles files instead of their pointers.')
     parser.add_argument('--package-meta', choices=['yes', 'no'], default='no',
                         help='Package the meta data of SCM to allow the user '
                              'or OBS to update after un-tar')
@@ -743,10 +3701,53 @@ if __name__ == '__main__':
                         help='Whether or not to include git submodules.'
                              'from SCM commit log since a given parent '
                              'revision (see changesrevision).')
-    args = parser.parse_args()
+    parser.add_argument('--maintain-cache', action='store_true',
+                        default=False,
+                        help='Repack and verify all repositories in the '
+                             'cache instead of creating a tarball.')
+    parser.add_argument('--prefetch', nargs='*', metavar='URL',
+                        help='Fetch the repositories at the given URLs, or '
+                             'update all cached repositories, into the '
+                             'cache instead of creating a tarball. GIT and '
+                             'HG only.')
+    parser.add_argument('--prefetch-listen', metavar='[ADDRESS:]PORT',
+                        help='After prefetching, keep running and prefetch '
+                             'the repositories named by push notifications '
+                             'POSTed to this address (default: 127.0.0.1). '
+                             'Accepts the JSON payloads of common webhooks '
+                             'and url=URL query parameters. Only cached '
+                             'repositories are prefetched.')
+    parser.add_argument('--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of repositories to process in parallel '
+                             'when maintaining the cache or prefetching, '
+                             'number of archives to create in parallel, or '
+                             'number of worker processes of the daemon.')
+    parser.add_argument('--daemon', metavar='SOCKET',
+                        help='Keep running and accept tar_scm invocations '
+                             'on the Unix socket SOCKET.')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Append the commands run and the steps taken, '
+                             'with their timing, to FILE in the Chrome '
+                             'trace event format. The trace of a daemon '
+                             'covers all the jobs it runs.')
+    args = parser.parse_args(argv)
+
+    if args.prefetch_listen:
+        address, _, port = args.prefetch_listen.rpartition(':')
+        if not port.isdigit():
+            parser.error('argument --prefetch-listen: invalid port %s' % port)
+        args.prefetch_listen = (address or '127.0.0.1', int(port))
+        if args.prefetch is None:
+            args.prefetch = []
+
+    if not args.maintain_cache and not args.daemon and args.prefetch is None:
+        for opt in ['scm', 'url', 'outdir']:
+            if getattr(args, opt) is None:
+                parser.error('argument --%s is required' % opt)
 
     # basic argument validation
-    if not os.path.isdir(args.outdir):
+    if args.outdir and not os.path.isdir(args.outdir):
         sys.exit("%s: No such directory" % args.outdir)
 
     if args.history_depth:
@@ -758,6 +3759,31 @@ if __name__ == '__main__':
     else:
         args.changesgenerate = False
 
+    if args.probe_remote == 'enable':
+        args.probe_remote = True
+    else:
+        args.probe_remote = False
+
+    if args.targeted_fetch == 'enable':
+        args.targeted_fetch = True
+    else:
+        args.targeted_fetch = False
+
+    if args.force_retry == 'enable':
+        args.force_retry = True
+    else:
+        args.force_retry = False
+
+    if args.dedupe == 'enable':
+        args.dedupe = True
+    else:
+        args.dedupe = False
+
+    if args.lfs == 'enable':
+        args.lfs = True
+    else:
+        args.lfs = False
+
     if args.package_meta == 'yes':
         args.package_meta = True
     else:
@@ -768,79 +3794,366 @@ if __name__ == '__main__':
     else:
         args.submodules = False
 
+    if args.changesmaxentries < 0:
+        parser.error('argument --changesmaxentries: must not be negative')
+
+    if args.extension is None:
+        args.extension = args.archive_format
+
+    outputs = []
+    for spec in args.output or ['']:
+        output = {'revision': args.revision, 'subdir': args.subdir,
+                  'filename': args.filename}
+        for field in filter(None, spec.split(',')):
+            key, sep, value = field.partition('=')
+            if not sep or key not in output:
+                parser.error('argument --output: invalid field %s' % field)
+            output[key] = value or output[key]
+        outputs.append(output)
+    args.output = outputs
+
     # force verbose mode in test-mode
     if os.getenv('DEBUG_TAR_SCM'):
         args.verbose = True
 
+    return args
+
+
+def main(argv=None, use_daemon=True):
+    '''Run tar_scm with the command line arguments argv. Unless use_daemon is
+    False, the invocation is handed to a running daemon if one is
+    configured.'''
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if use_daemon and is_daemon_job(argv):
+        sockname = get_daemon_socket()
+        if sockname:
+            status = run_daemon_job(sockname, argv)
+            if status is not None:
+                sys.exit(status)
+
+    args = parse_args(argv)
+
     FORMAT = "%(message)s"
     logging.basicConfig(format=FORMAT, stream=sys.stderr, level=logging.INFO)
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    # force cleaning of our workspace on exit
+    # check for enabled caches (1. environment, 2. user confog, 3. system wide)
+    repocachedir = get_repocachedir()
+    if repocachedir:
+        logging.debug("REPOCACHE: %s", repocachedir)
+
+    if args.maintain_cache:
+        if not repocachedir or \
+                not os.path.isdir(os.path.join(repocachedir, 'repo')):
+            sys.exit("No repository cache configured")
+        if os.path.isdir(os.path.join(repocachedir, 'incoming')):
+            reclaim_incoming(repocachedir)
+        if not maintain_cache(repocachedir, args.jobs):
+            sys.exit("Cache maintenance failed")
+        sys.exit(0)
+
+    if args.trace:
+        if TRACE.events is None:
+            TRACE.enable(os.getpid(), ' '.join(['tar_scm'] + argv))
+            atexit.register(TRACE.flush)
+        TRACE.filenames.append(os.path.abspath(args.trace))
+
+    if args.daemon:
+        serve_daemon(args.daemon, args.jobs, args.trace)
+        sys.exit(0)
+
+    if args.prefetch is not None:
+        if not repocachedir or \
+                not os.path.isdir(os.path.join(repocachedir, 'repo')):
+            sys.exit("No repository cache configured")
+        scm = args.scm or 'git'
+        if scm not in REMOTE_URL_COMMANDS:
+            sys.exit("%s: Prefetching is not supported" % scm)
+        kwargs = dict(args.__dict__, repocachedir=repocachedir,
+                      url_rewrites=get_url_rewrites(), subdir='',
+                      targeted_fetch=False)
+        repos = [(scm, url) for url in args.prefetch] or \
+            _cached_repos(repocachedir)
+        succeeded = prefetch(repocachedir, repos, args.jobs, kwargs)
+        if args.prefetch_listen:
+            serve_prefetch(args.prefetch_listen, repocachedir, args.jobs,
+                           kwargs)
+        if not succeeded:
+            sys.exit("Prefetch failed")
+        sys.exit(0)
+
+    # force cleaning of our workspace on exit, also when terminated
     atexit.register(cleanup, CLEANUP_DIRS)
 
-    # check for enabled caches (1. environment, 2. user confog, 3. system wide)
-    repocachedir = os.getenv('CACHEDIRECTORY')
-    if repocachedir is None:
-        config = get_config_options()
-        try:
-            repocachedir = config.get('tar_scm', 'CACHEDIRECTORY')
-        except ConfigParser.Error:
-            pass
+    import signal
+
+    def terminate(signum, frame):
+        terminate_commands()
+        sys.exit(128 + signum)
+
+    for signum in [signal.SIGTERM, signal.SIGHUP]:
+        signal.signal(signum, terminate)
 
+    OutputFile.durability = get_durability()
+
+    servicedata = None
+    if args.changesgenerate:
+        try:
+            servicedata = ServiceData(os.getcwd())
+        except Exception, e:
+            sys.exit("_servicedata: Failed to parse (%s)" % e)
+
+    # caching requires the repo directory inside the cache
+    if repocachedir and not os.path.isdir(os.path.join(repocachedir, 'repo')):
+        repocachedir = None
+
+    # A single fetch provides the sources of all outputs. SVN checkouts
+    # only hold the sub-directory containing all requested ones.
+    revisions = [output['revision'] for output in args.output]
+    fetch_revision = revisions[0]
+    if len(set(revisions)) > 1:
+        fetch_revision = None
+    fetch_subdir = _common_subdir([output['subdir']
+                                   for output in args.output])
     if repocachedir:
-        logging.debug("REPOCACHE: %s", repocachedir)
+        repohash = get_repocache_hash(args.scm, args.url, fetch_subdir)
+        logging.debug("HASH: %s", repohash)
+
+    # Failures to fetch a revision are remembered for a while, so runs
+    # during an outage or for a missing revision fail right away.
+    failfile = None
+    failure_ttl = get_failure_ttl()
+    if repocachedir and failure_ttl:
+        failfile = os.path.join(repocachedir, 'repo', repohash + '.failed')
+        if not args.force_retry:
+            check_failures(failfile, revisions, failure_ttl)
+
+    def remember_failure(revisions, func, *func_args):
+        '''Call func, recording in failfile if it fails to fetch the
+        revisions.'''
+
+        try:
+            return func(*func_args)
+        except SystemExit, e:
+            # terminated runs exit with a status instead of an error, but
+            # the commands they terminate fail with one
+            if failfile and isinstance(e.code, basestring) and \
+                    not TERMINATING:
+                record_failure(failfile, revisions, e.code)
+            raise
+
+    url_rewrites = get_url_rewrites()
+    if args.probe_remote:
+        for output in args.output:
+            current_rev = remember_failure([output['revision']],
+                                           probe_remote, args.scm, args.url,
+                                           output['revision'],
+                                           output['subdir'], url_rewrites)
+        unchanged = None
+        if servicedata and len(args.output) == 1:
+            unchanged = find_unchanged_files(servicedata, args.url,
+                                             os.getcwd(), current_rev,
+                                             archive_params_hash(args))
+        for name, path in unchanged or []:
+            dst = os.path.join(args.outdir, name)
+            try:
+                os.link(path, dst)
+            except OSError:
+                output = OutputFile(dst)
+                try:
+                    src_fp = open(path, 'rb')
+                    shutil.copyfileobj(src_fp, output.fp)
+                    src_fp.close()
+                    output.commit()
+                    shutil.copystat(path, dst)
+                finally:
+                    output.abort()
+        if unchanged:
+            servicedata.write(args.outdir)
+            if failfile:
+                clear_failures(failfile, revisions)
+            print "%s: revision %s unchanged, reusing %s" % \
+                (args.url, current_rev, unchanged[0][0])
+            sys.exit(0)
 
     # construct repodir (the parent directory of the checkout)
     repodir = None
-    if repocachedir and os.path.isdir(os.path.join(repocachedir, 'repo')):
-        repohash = get_repocache_hash(args.scm, args.url, args.subdir)
-        logging.debug("HASH: %s", repohash)
+    cache_lock = None
+    if repocachedir:
+        cache_lock = lock_cache(repocachedir, repohash)
         repodir = os.path.join(repocachedir, 'repo')
         repodir = os.path.join(repodir, repohash)
 
-    # if caching is enabled but we haven't cached something yet
+    # if caching is enabled but we haven't cached something yet, continue
+    # where an interrupted run left off
     if repodir and not os.path.isdir(repodir):
-        repodir = tempfile.mkdtemp(dir=os.path.join(repocachedir, 'incoming'))
+        repodir = adopt_orphan(repocachedir, repohash) or \
+            _mkdtemp(os.path.join(repocachedir, 'incoming'), repohash)
 
+    scratchdir = get_scratchdir()
+    for tmpdir in [scratchdir, args.outdir]:
+        if tmpdir and os.path.isdir(tmpdir):
+            reclaim_orphans(tmpdir)
     if repodir is None:
-        repodir = tempfile.mkdtemp(dir=args.outdir)
-        CLEANUP_DIRS.append(repodir)
-
-    clone_dir = fetch_upstream(out_dir=repodir, **args.__dict__)
-
-    if args.filename:
-        dstname = args.filename
-    else:
-        dstname = os.path.basename(clone_dir)
-
-    version = args.version
-    if version == '_auto_' or args.versionformat:
-        version = detect_version(args.scm, clone_dir, args.versionformat)
-    if args.versionprefix:
-        version = "%s.%s" % (args.versionprefix, version)
-    if version:
-        dstname = dstname + '-' + version
-
-    logging.debug("DST: %s", dstname)
+        repodir = mkscratchdir(scratchdir, args.outdir)
+
+    kwargs = dict(args.__dict__, repocachedir=repocachedir,
+                  scratchdir=scratchdir, url_rewrites=url_rewrites,
+                  subdir=fetch_subdir)
+    if servicedata:
+        kwargs['changesrevision'] = servicedata.get_revision(args.url)
+    if args.scm == 'svn' and \
+            [output for output in args.output
+             if output['subdir'].strip('/') != fetch_subdir]:
+        # the include patterns are relative to the sub-directories
+        kwargs['include'] = []
+    # Once a revision is checked out, the steps reading it run concurrently.
+    # The next revision is only checked out when they are done, while the
+    # archives are still being created.
+    pipeline = Pipeline(args.jobs)
+    clone_dir = pipeline.run('fetch', remember_failure, revisions,
+                             fetch_upstream, args.scm, args.url,
+                             fetch_revision, repodir, kwargs)
+
+    lfs_cachedir = None
+    if args.lfs and args.scm == 'git':
+        if repocachedir:
+            lfs_cachedir = os.path.join(repocachedir, 'lfs')
+        else:
+            lfs_cachedir = mkscratchdir(scratchdir, args.outdir)
+
+    def get_version(checkout_dir):
+        '''Return the version of the sources in checkout_dir.'''
+
+        version = args.version
+        if version == '_auto_' or args.versionformat:
+            version = detect_version(args.scm, checkout_dir,
+                                     args.versionformat)
+        if args.versionprefix:
+            version = "%s.%s" % (args.versionprefix, version)
+        return version
+
+    def get_changes(checkout_dir):
+        '''Return the changes since the last run.'''
+
+        return detect_changes(args.scm, servicedata.get_revision(args.url),
+                              checkout_dir, args.changesmaxentries)
+
+    def prep_tree(subdir, checkout_dir):
+        '''Copy the tree to archive, named after the checkout for now.'''
+
+        if args.scm == 'svn':
+            subdir = subdir.strip('/')[len(fetch_subdir):].lstrip('/')
+        stagedir = mkscratchdir(scratchdir, args.outdir,
+                                os.path.join(checkout_dir, subdir))
+        return prep_tree_for_tar(args.scm, checkout_dir, subdir, stagedir,
+                                 dstname=os.path.basename(checkout_dir),
+                                 package_metadata=args.package_meta)
+
+    outfiles = []
+
+    def name_output(filename, checkout_dir, version, tree):
+        '''Name the archive of an output and its prepared tree after the
+        version.'''
+
+        basename = filename or os.path.basename(checkout_dir)
+        dstname = basename
+        if version:
+            dstname = dstname + '-' + version
+
+        logging.debug("DST: %s", dstname)
+
+        names = [dstname + '.' + args.extension]
+        if args.archive_format == 'obscpio':
+            names.append(basename + '.obsinfo')
+        for name in names:
+            if name in outfiles:
+                sys.exit("%s: Created by several outputs" % name)
+        outfiles.extend(names)
+
+        tar_dir = os.path.join(os.path.dirname(tree), dstname)
+        if tar_dir != tree:
+            os.rename(tree, tar_dir)
+        return tar_dir, dstname, basename, version
+
+    def read_commit(repodir):
+        '''Return the commit of an output and its commit time.'''
+
+        return (CHANGES_COMMANDS[args.scm][0](repodir),
+                COMMIT_TIME_COMMANDS[args.scm](repodir))
+
+    def export(named, commit=(None, None)):
+        '''Create the archive of an output from its prepared tree.'''
+
+        tar_dir, dstname, basename, version = named
+        lfs = None
+        if lfs_cachedir:
+            lfs = GitLfs(clone_dir, args.url, lfs_cachedir, commit[0])
+        create_tar(tar_dir, args.outdir,
+                   dstname=dstname, extension=args.extension,
+                   exclude=args.exclude, include=args.include,
+                   package_metadata=args.package_meta,
+                   writer=args.tar_writer, dedupe=args.dedupe, lfs=lfs,
+                   archive_format=args.archive_format)
+        if args.archive_format == 'obscpio':
+            write_obsinfo(args.outdir, basename, version, *commit)
+
+    readers = []
+    exports = []
+    changes_step = None
+    for number, output in enumerate(args.output):
+        suffix = ''
+        if len(args.output) > 1:
+            suffix = ' #%d' % (number + 1)
+
+        switch = pipeline.add('switch revision' + suffix, remember_failure,
+                              args=([output['revision']], switch_revision,
+                                    args.scm, clone_dir, output['revision'],
+                                    kwargs),
+                              after=readers)
+        version = pipeline.add('detect version' + suffix, get_version,
+                               inputs=[switch])
+        if number == 0:
+            changes_version = version
+        tree = pipeline.add('prepare tree' + suffix, prep_tree,
+                            args=(output['subdir'],), inputs=[switch])
+        named = pipeline.add('name output' + suffix, name_output,
+                             args=(output['filename'],),
+                             inputs=[switch, version, tree])
+        readers = [named]
+        if servicedata and number == 0:
+            changes_step = pipeline.add('detect changes', get_changes,
+                                        inputs=[switch])
+            readers.append(changes_step)
+        inputs = [named]
+        if args.archive_format == 'obscpio' or lfs_cachedir:
+            commit = pipeline.add('read commit' + suffix, read_commit,
+                                  inputs=[switch])
+            readers.append(commit)
+            inputs.append(commit)
+        exports.append(pipeline.add('create archive' + suffix, export,
+                                    inputs=inputs))
 
     changes = None
-    if args.changesgenerate:
-        changes = detect_changes(args.scm, args.url, clone_dir, args.outdir)
-
-    tar_dir = prep_tree_for_tar(clone_dir, args.subdir, args.outdir,
-                                dstname=dstname)
-    CLEANUP_DIRS.append(tar_dir)
-
-    create_tar(tar_dir, args.outdir,
-               dstname=dstname, extension=args.extension,
-               exclude=args.exclude, include=args.include,
-               package_metadata=args.package_meta)
+    try:
+        for step in exports:
+            step.get()
+        if changes_step:
+            changes = changes_step.get()
+            changesversion = changes_version.get()
+    except BaseException:
+        # the steps must be done before their directories are cleaned up
+        pipeline.cancel()
+        raise
 
     if changes:
         changesauthor = args.changesauthor
         if changesauthor is None:
+            import ConfigParser
             config = ConfigParser.RawConfigParser({
                 'email': 'opensuse-packaging@opensuse.org',
             })
@@ -849,16 +4162,41 @@ if __name__ == '__main__':
 
         logging.debug("AUTHOR: %s", changesauthor)
 
-        for filename in glob.glob(os.path.join(args.outdir, '*.changes')):
-            write_changes(filename, changes['lines'], version, changesauthor)
-        write_changes_revision(changes['url'], args.outdir,
-                               changes['revision'])
+        if changes['lines']:
+            entry = format_changes_entry(changes['lines'], changesversion,
+                                         changesauthor)
+            for filename in glob.glob(os.path.join(args.outdir, '*.changes')):
+                write_changes(filename, entry)
+        servicedata.set_revision(args.url, changes['revision'])
+
+    # remember the files created for reusing them, see --probe-remote
+    if servicedata and args.probe_remote and len(args.output) == 1:
+        servicedata.set_param(args.url, 'tarball', outfiles[0])
+        if args.archive_format == 'obscpio':
+            servicedata.set_param(args.url, 'obsinfo', outfiles[1])
+        servicedata.set_param(args.url, 'tarballparams',
+                              archive_params_hash(args))
+
+    if servicedata:
+        servicedata.write(args.outdir)
 
     # Populate cache
-    if repocachedir and os.path.isdir(os.path.join(repocachedir, 'repo')):
+    if repocachedir:
         repodir2 = os.path.join(repocachedir, 'repo')
         repodir2 = os.path.join(repodir2, repohash)
         if repodir2 and not os.path.isdir(repodir2):
             os.rename(repodir, repodir2)
         elif not os.path.samefile(repodir, repodir2):
             CLEANUP_DIRS.append(repodir)
+
+    if failfile:
+        clear_failures(failfile, revisions)
+
+    if cache_lock:
+        cache_lock.close()
+
+    pipeline.report()
+
+
+if __name__ == '__main__':
+    main()
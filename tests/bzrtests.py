@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+import os
+
 from   commontests import CommonTests
 from   bzrfixtures import BzrFixtures
 from   utils       import run_bzr
@@ -34,3 +36,38 @@ class BzrTests(CommonTests):
         basename = self.basename(version = 'foo2')
         th = self.assertTarOnly(basename)
         self.assertTarMemberContains(th, basename + '/a', '2')
+
+    def test_cache_shared_repo(self):
+        self.tar_scm_std()
+        self.assertTarOnly(self.basename())
+        self.assertTrue(os.path.isdir(os.path.join(self.cachedir, 'bzr')))
+        self.postRun()
+
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        self.scmlogs.next()
+        self.tar_scm_std()
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+        loglines = ''.join(self.scmlogs.read())
+        self.assertRegexpMatches(loglines, 'bzr pull --overwrite')
+        self.assertNotRegexpMatches(loglines, 'bzr branch')
+
+        # the revno of the lightweight checkout is that of the branch
+        basename = self.basename(version = self.rev(3))
+        th = self.assertTarOnly(basename)
+        self.assertTarMemberContains(th, basename + '/a', '3')
+
+    def test_cache_lightweight_revision(self):
+        self.fixtures.create_commits(2)
+        os.chdir(self.pkgdir)
+        self.tar_scm_std()
+        self.postRun()
+
+        self.scmlogs.next()
+        self.tar_scm_std('--revision', self.rev(3))
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+        basename = self.basename(version = self.rev(3))
+        th = self.assertTarOnly(basename)
+        self.assertTarMemberContains(th, basename + '/a', '3')
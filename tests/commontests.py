@@ -1,6 +1,11 @@
 #!/usr/bin/python
 
+import fcntl
+import json
 import os
+import shutil
+import subprocess
+import time
 
 from pprint         import pprint, pformat
 
@@ -29,6 +34,273 @@ class CommonTests(TestEnvironment, TestAssertions):
         self.tar_scm_std('--exclude', '.' + self.scm)
         self.assertTarOnly(self.basename())
 
+    def test_tar_writer_fast(self):
+        self.tar_scm_std('--tar-writer', 'fast')
+        self.assertTarOnly(self.basename())
+
+    def test_daemon(self):
+        sockname = os.path.join(self.test_dir, 'daemon.sock')
+        logname = os.path.join(self.test_dir, 'daemon.log')
+        log = open(logname, 'w')
+        daemon = subprocess.Popen(['python', self.tar_scm_bin(),
+                                   '--daemon', sockname, '--jobs', '2'],
+                                  stdout=log, stderr=subprocess.STDOUT)
+        try:
+            for i in range(100):
+                if os.path.exists(sockname):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(os.stat(sockname).st_mode & 0777, 0600)
+            os.putenv('TAR_SCM_DAEMON', sockname)
+            self.tar_scm_std()
+            self.assertTarOnly(self.basename())
+            (stdout, stderr, ret) = self.tar_scm_std_fail(
+                '--revision', 'nosuchrevision')
+            self.assertRegexpMatches(stdout, 'No such revision')
+        finally:
+            os.unsetenv('TAR_SCM_DAEMON')
+            daemon.terminate()
+            daemon.wait()
+            log.close()
+
+        log = open(logname)
+        output = log.read()
+        log.close()
+        self.assertRegexpMatches(output, 'Job 1: .*--url')
+        self.assertRegexpMatches(output, 'Job 2: exit status 1')
+        self.assertFalse(os.path.exists(sockname))
+
+    def test_daemon_env_stderr(self):
+        sockname = os.path.join(self.test_dir, 'daemon.sock')
+        os.putenv('TAR_SCM_DURABILITY', 'always')
+        try:
+            daemon = subprocess.Popen(['python', self.tar_scm_bin(),
+                                       '--daemon', sockname])
+        finally:
+            os.unsetenv('TAR_SCM_DURABILITY')
+        try:
+            for i in range(100):
+                if os.path.exists(sockname):
+                    break
+                time.sleep(0.1)
+            os.putenv('TAR_SCM_DAEMON', sockname)
+            mkfreshdir(self.outdir)
+            # the daemon's invalid durability isn't passed on
+            proc = subprocess.Popen(
+                ['python', self.tar_scm_bin()] +
+                self.stdargs('--revision', 'nosuchrevision',
+                             '--outdir', self.outdir),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout, stderr) = proc.communicate()
+        finally:
+            os.unsetenv('TAR_SCM_DAEMON')
+            daemon.terminate()
+            daemon.wait()
+
+        self.assertEqual(proc.returncode, 1)
+        self.assertNotRegexpMatches(stdout, 'No such revision')
+        self.assertRegexpMatches(stderr, 'No such revision')
+        self.assertNotRegexpMatches(stderr, 'durability')
+
+    def test_daemon_not_utf8(self):
+        sockname = os.path.join(self.test_dir, 'daemon.sock')
+        logname = os.path.join(self.test_dir, 'daemon.log')
+        log = open(logname, 'w')
+        daemon = subprocess.Popen(['python', self.tar_scm_bin(),
+                                   '--daemon', sockname],
+                                  stdout=log, stderr=subprocess.STDOUT)
+        try:
+            for i in range(100):
+                if os.path.exists(sockname):
+                    break
+                time.sleep(0.1)
+            os.putenv('TAR_SCM_DAEMON', sockname)
+            os.putenv('TAR_SCM_NOT_UTF8', '\xff')
+            self.tar_scm_std()
+            self.assertTarOnly(self.basename())
+        finally:
+            os.unsetenv('TAR_SCM_DAEMON')
+            os.unsetenv('TAR_SCM_NOT_UTF8')
+            daemon.terminate()
+            daemon.wait()
+            log.close()
+
+        # run locally
+        log = open(logname)
+        output = log.read()
+        log.close()
+        self.assertNotRegexpMatches(output, 'Job 1')
+
+    def _read_trace(self, path):
+        # the array is left open for further events
+        data = open(path).read()
+        self.assertTrue(data.startswith('[\n'))
+        return json.loads(data.rstrip().rstrip(',') + ']')
+
+    def test_trace(self):
+        trace = os.path.join(self.test_dir, 'trace.json')
+        if os.path.exists(trace):
+            os.unlink(trace)
+        self.tar_scm_std('--trace', trace)
+        self.tar_scm_std('--trace', trace)
+        events = self._read_trace(trace)
+
+        names = [e['args']['name'] for e in events
+                 if e['name'] == 'process_name']
+        self.assertEqual(len(names), 2)
+        self.assertTrue(self.fixtures.repo_url in names[0])
+        steps = [e['name'] for e in events if e.get('cat') == 'step']
+        self.assertEqual(steps.count('fetch'), 2)
+        self.assertEqual(steps.count('create archive'), 2)
+        commands = [e for e in events if e.get('cat') == 'command']
+        self.assertNotEqual(commands, [])
+        for event in commands:
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['name'].split()[0], self.scm)
+            self.assertEqual(sorted(event['args'].keys()),
+                             ['cmd', 'cwd', 'output', 'status'])
+
+    def test_daemon_trace(self):
+        sockname = os.path.join(self.test_dir, 'daemon.sock')
+        trace = os.path.join(self.test_dir, 'trace.json')
+        if os.path.exists(trace):
+            os.unlink(trace)
+        daemon = subprocess.Popen(['python', self.tar_scm_bin(),
+                                   '--daemon', sockname, '--jobs', '2',
+                                   '--trace', trace])
+        try:
+            for i in range(100):
+                if os.path.exists(sockname):
+                    break
+                time.sleep(0.1)
+            os.putenv('TAR_SCM_DAEMON', sockname)
+            self.tar_scm_std()
+            self.tar_scm_std_fail('--revision', 'nosuchrevision')
+
+            # written once each job is done
+            events = self._read_trace(trace)
+            jobs = [e for e in events if e.get('cat') == 'job']
+            self.assertEqual([e['args']['status'] for e in jobs], [0, 1])
+        finally:
+            os.unsetenv('TAR_SCM_DAEMON')
+            daemon.terminate()
+            daemon.wait()
+
+        events = self._read_trace(trace)
+        self.assertEqual(len(set([e['pid'] for e in jobs])), 1)
+        for pid in (1, 2):
+            steps = [e['name'] for e in events
+                     if e['pid'] == pid and e.get('cat') == 'step']
+            self.assertTrue('fetch' in steps)
+
+    def test_durability(self):
+        os.putenv('TAR_SCM_DURABILITY', 'dir')
+        try:
+            self.tar_scm_std()
+            self.assertTarOnly(self.basename())
+        finally:
+            os.unsetenv('TAR_SCM_DURABILITY')
+
+    def test_durability_invalid(self):
+        os.putenv('TAR_SCM_DURABILITY', 'always')
+        try:
+            (stdout, stderr, ret) = self.tar_scm_std_fail()
+            self.assertRegexpMatches(stdout, 'always: Invalid durability')
+        finally:
+            os.unsetenv('TAR_SCM_DURABILITY')
+
+    def test_scratchdir(self):
+        scratchdir = os.path.join(self.test_dir, 'scratch')
+        if os.path.exists(scratchdir):
+            shutil.rmtree(scratchdir)
+        os.mkdir(scratchdir)
+        self.disableCache()
+        os.putenv('SCRATCHDIRECTORY', scratchdir)
+        try:
+            self.tar_scm_std()
+        finally:
+            os.unsetenv('SCRATCHDIRECTORY')
+        self.assertTarOnly(self.basename())
+        self.assertTrue(scratchdir in ''.join(self.scmlogs.read()))
+        self.assertEqual(os.listdir(scratchdir), [])
+
+    def test_scratchdir_missing(self):
+        os.putenv('SCRATCHDIRECTORY',
+                  os.path.join(self.test_dir, 'nonexistent'))
+        try:
+            (stdout, stderr, ret) = self.tar_scm_std()
+        finally:
+            os.unsetenv('SCRATCHDIRECTORY')
+        self.assertRegexpMatches(stdout, 'nonexistent: .*, using ')
+        self.assertTarOnly(self.basename())
+
+    def _dead_pid(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_adopt_interrupted_clone(self):
+        self.tar_scm_std()
+        self.postRun()
+        self.scmlogs.next()
+
+        # pretend a killed run left its clone in incoming/
+        repodir = os.path.join(self.cachedir, 'repo')
+        repohash = [x for x in os.listdir(repodir)
+                    if os.path.isdir(os.path.join(repodir, x))][0]
+        orphan = os.path.join(self.cachedir, 'incoming',
+                              '%s.%d.killed' % (repohash, self._dead_pid()))
+        os.rename(os.path.join(repodir, repohash), orphan)
+
+        (stdout, stderr, ret) = self.tar_scm_std()
+        self.assertRegexpMatches(stdout, 'Adopting interrupted clone')
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+        self.assertTarOnly(self.basename())
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.isdir(os.path.join(repodir, repohash)))
+
+    def test_reclaim_orphans(self):
+        scratchdir = os.path.join(self.test_dir, 'scratch')
+        mkfreshdir(scratchdir)
+        orphan = os.path.join(scratchdir, 'tar_scm.%d.killed' %
+                              self._dead_pid())
+        os.mkdir(orphan)
+        # the PID may belong to another PID namespace, only the lock tells
+        alive = os.path.join(scratchdir, 'tar_scm.%d.alive' %
+                             self._dead_pid())
+        os.mkdir(alive)
+        fd = os.open(alive, os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.putenv('SCRATCHDIRECTORY', scratchdir)
+        try:
+            (stdout, stderr, ret) = self.tar_scm_std()
+        finally:
+            os.unsetenv('SCRATCHDIRECTORY')
+            os.close(fd)
+        self.assertRegexpMatches(stdout, 'Removing orphaned')
+        self.assertTarOnly(self.basename())
+        self.assertEqual(os.listdir(scratchdir), [os.path.basename(alive)])
+
+    def test_step_timings(self):
+        (stdout, stderr, ret) = self.tar_scm_std('--verbose')
+        self.assertRegexpMatches(stdout, ':fetch +[0-9.]+s\n')
+        self.assertRegexpMatches(stdout, ':create archive +[0-9.]+s\n')
+        self.assertRegexpMatches(stdout, 'Steps took [0-9.]+s, [0-9.]+s '
+                                 'elapsed')
+
+    def test_obscpio(self):
+        self.tar_scm_std('--archive-format', 'obscpio', '--version', '1.0')
+        self.assertNumDirents(self.outdir, 2)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.outdir, self.basename(version = '1.0') + '.obscpio')))
+        f = open(os.path.join(self.outdir, 'repo.obsinfo'))
+        obsinfo = f.read()
+        f.close()
+        self.assertRegexpMatches(obsinfo,
+                                 '^name: repo\nversion: 1.0\nmtime: \d+\n')
+        self.assertRegexpMatches(obsinfo, '\ncommit: \S+\n$')
+
     def test_subdir(self):
         self.tar_scm_std('--subdir', self.fixtures.subdir)
         self.assertTarOnly(self.basename(), tarchecker=self.assertSubdirTar)
@@ -60,6 +332,211 @@ class CommonTests(TestEnvironment, TestAssertions):
         self.tar_scm_std('--filename', filename, '--version', version)
         self.assertTarOnly(self.basename(filename, version))
 
+    def _changesgenerate(self, *args):
+        old_entry = '- Initial version\n'
+        self.tar_scm_std('--changesgenerate', 'enable',
+                         '--changesauthor', 'test@example.com',
+                         '--version', '1.0', *args,
+                         outdir_files={ 'pkg.changes' : old_entry })
+        self.assertNumDirents(self.outdir, 3)
+        f = open(os.path.join(self.outdir, 'pkg.changes'))
+        changes = f.read()
+        f.close()
+        self.assertRegexpMatches(changes, ' - test@example.com\n')
+        self.assertRegexpMatches(changes, '- Update to version 1.0:\n')
+        self.assertTrue(changes.endswith('\n\n' + old_entry))
+        self.assertTrue(os.path.exists(os.path.join(self.outdir,
+                                                    '_servicedata')))
+        return changes
+
+    def test_changesgenerate(self):
+        changes = self._changesgenerate()
+        self.assertRegexpMatches(changes, ':\n \+ 1\n \+ 2\n\n')
+        self.postRun()
+
+        self.fixtures.create_commits(2)
+        os.chdir(self.pkgdir)
+        changes = self._changesgenerate()
+        self.assertRegexpMatches(changes, ':\n \+ 3\n \+ 4\n\n')
+
+    def test_changesgenerate_maxentries(self):
+        self._changesgenerate()
+        self.postRun()
+
+        self.fixtures.create_commits(3)
+        os.chdir(self.pkgdir)
+        changes = self._changesgenerate('--changesmaxentries', '2')
+        self.assertRegexpMatches(changes, ':\n \+ 4\n \+ 5\n\n')
+
+    def test_probe_remote_unchanged(self):
+        self._changesgenerate('--probe-remote', 'enable')
+        self.postRun()
+
+        self.scmlogs.next()
+        (stdout, stderr, ret) = self.tar_scm_std(
+            '--changesgenerate', 'enable', '--version', '1.0',
+            '--probe-remote', 'enable')
+        self.assertRegexpMatches(stdout, 'unchanged')
+        loglines = ''.join(self.scmlogs.read())
+        self.assertNotRegexpMatches(loglines, self.initial_clone_command)
+        self.assertNotRegexpMatches(loglines, self.update_cache_command)
+        self.assertNumDirents(self.outdir, 2)
+        self.checkTar(self.basename(version='1.0') + '.tar',
+                      self.basename(version='1.0'))
+        self.postRun()
+
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        self.scmlogs.next()
+        changes = self._changesgenerate('--probe-remote', 'enable')
+        self.assertRegexpMatches(changes, ':\n \+ 3\n\n')
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+
+    def test_probe_remote_params_changed(self):
+        self._changesgenerate('--probe-remote', 'enable')
+        self.postRun()
+
+        (stdout, stderr, ret) = self.tar_scm_std(
+            '--changesgenerate', 'enable', '--version', '1.0',
+            '--probe-remote', 'enable', '--exclude', 'a')
+        self.assertNotRegexpMatches(stdout, 'unchanged')
+        self.assertNumDirents(self.outdir, 2)
+
+    def test_probe_remote_unchanged_obscpio(self):
+        args = ['--changesgenerate', 'enable',
+                '--changesauthor', 'test@example.com', '--version', '1.0',
+                '--probe-remote', 'enable', '--archive-format', 'obscpio']
+        self.tar_scm_std(*args)
+        self.postRun()
+
+        (stdout, stderr, ret) = self.tar_scm_std(*args)
+        self.assertRegexpMatches(stdout, 'unchanged')
+        self.assertNumDirents(self.outdir, 3)
+        self.assertTrue(os.path.exists(os.path.join(self.outdir,
+                                                    'repo.obsinfo')))
+
+    def test_probe_remote_disabled_servicedata(self):
+        self._changesgenerate()
+        f = open(os.path.join(self.outdir, '_servicedata'))
+        servicedata = f.read()
+        f.close()
+        self.assertNotRegexpMatches(servicedata, 'tarball')
+
+    def test_probe_remote_no_such_revision(self):
+        (stdout, stderr, ret) = self.tar_scm_std_fail(
+            '--probe-remote', 'enable', '--revision', 'nosuchrevision')
+        self.assertRegexpMatches(stdout, 'No such revision')
+        loglines = ''.join(self.scmlogs.read())
+        self.assertNotRegexpMatches(loglines, self.initial_clone_command)
+
+    def test_probe_remote_unreachable(self):
+        url = os.path.join(self.test_dir, 'nosuchrepo')
+        (stdout, stderr, ret) = self.tar_scm(
+            ['--url', url, '--scm', self.scm, '--probe-remote', 'enable'],
+            should_succeed=False)
+        self.assertRegexpMatches(stdout, 'Command failed')
+        self.assertNotRegexpMatches(stdout, 'No such revision')
+
+    def test_failure_cached(self):
+        self.tar_scm_std_fail('--revision', 'nosuchrevision')
+
+        self.scmlogs.next('remembered')
+        (stdout, stderr, ret) = self.tar_scm_std_fail(
+            '--revision', 'nosuchrevision')
+        self.assertRegexpMatches(stdout, '\(failed \d+s ago, not retrying')
+        self.assertEqual(self.scmlogs.read(), '<no %s log>' % self.scm)
+
+        # other revisions are unaffected
+        self.tar_scm_std()
+        self.assertTarOnly(self.basename())
+
+        self.scmlogs.next('force-retry')
+        (stdout, stderr, ret) = self.tar_scm_std_fail(
+            '--revision', 'nosuchrevision', '--force-retry', 'enable')
+        self.assertNotRegexpMatches(stdout, 'not retrying')
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+
+    def test_failure_ttl_disabled(self):
+        os.putenv('TAR_SCM_FAILURE_TTL', '0')
+        try:
+            self.tar_scm_std_fail('--revision', 'nosuchrevision')
+            self.scmlogs.next()
+            (stdout, stderr, ret) = self.tar_scm_std_fail(
+                '--revision', 'nosuchrevision')
+        finally:
+            os.unsetenv('TAR_SCM_FAILURE_TTL')
+        self.assertNotRegexpMatches(stdout, 'not retrying')
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+
+    def test_mirror(self):
+        mirror_path = os.path.join(self.test_dir, 'mirror')
+        if os.path.exists(mirror_path):
+            shutil.rmtree(mirror_path)
+        shutil.copytree(self.fixtures.repo_path, mirror_path)
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        basename = self.basename(version='1.0')
+
+        os.putenv('URLREWRITE_test', '%s file://%s' %
+                  (self.fixtures.repo_url, mirror_path))
+        try:
+            self.tar_scm_std('--version', '1.0')
+            th = self.assertTarOnly(basename)
+            self.assertTarMemberContains(th, basename + '/a', '2')
+            self.postRun()
+
+            # fall back to upstream, using the same cache entry
+            os.putenv('URLREWRITE_test', 're:^%s$ file:///nonexistent' %
+                      self.fixtures.repo_url)
+            self.scmlogs.next()
+            self.tar_scm_std('--version', '1.0')
+            self.assertRanUpdate(self.scmlogs.current_log_path,
+                                 self.scmlogs.read())
+            th = self.assertTarOnly(basename)
+            self.assertTarMemberContains(th, basename + '/a', '3')
+        finally:
+            os.unsetenv('URLREWRITE_test')
+
+    def test_probe_remote_mirror(self):
+        # upstream is down, the mirror is up
+        upstream = self.fixtures.repo_url + '-down'
+        os.putenv('URLREWRITE_test', '%s %s' %
+                  (upstream, self.fixtures.repo_url))
+        try:
+            self.tar_scm(['--url', upstream, '--scm', self.scm,
+                          '--probe-remote', 'enable', '--version', '1.0'])
+            self.assertTarOnly(self.basename(name='repo-down',
+                                             version='1.0'))
+        finally:
+            os.unsetenv('URLREWRITE_test')
+
+    def test_output(self):
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        self.tar_scm_std('--version', '1.0',
+                         '--output', 'revision=%s,filename=old' % self.rev(2),
+                         '--output', 'subdir=%s,filename=new' %
+                         self.fixtures.subdir)
+        tars = sorted(os.listdir(self.outdir))
+        self.assertEqual(tars, ['new-1.0.tar', 'old-1.0.tar'])
+        th = self.checkTar(tars[1], 'old-1.0')
+        self.assertTarMemberContains(th, 'old-1.0/a', '2')
+        th = self.checkTar(tars[0], 'new-1.0', tarchecker=self.assertSubdirTar)
+        self.assertTarMemberContains(th, 'new-1.0/b', '3')
+
+    def test_changesmaxentries_negative(self):
+        (stdout, stderr, ret) = self.tar_scm_std_fail(
+            '--changesgenerate', 'enable', '--changesmaxentries', '-1')
+        self.assertRegexpMatches(stdout, 'must not be negative')
+
+    def test_output_duplicate(self):
+        (stdout, stderr, ret) = self.tar_scm_std_fail(
+            '--output', 'subdir=' + self.fixtures.subdir, '--output', '')
+        self.assertRegexpMatches(stdout, 'Created by several outputs')
+
     def test_revision_nop(self):
         self.tar_scm_std('--revision', self.rev(2))
         th = self.assertTarOnly(self.basename())
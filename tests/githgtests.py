@@ -1,6 +1,12 @@
 #!/usr/bin/python
 
+import json
 import os
+import re
+import signal
+import subprocess
+import time
+import urllib2
 
 from   commontests import CommonTests
 from   utils       import run_hg
@@ -48,3 +54,117 @@ class GitHgTests(CommonTests):
         basename = self.basename(version = self.sha1s(self.rev(2)))
         th = self.assertTarOnly(basename)
         self.assertTarMemberContains(th, basename + '/a', '2')
+
+    def test_maintain_cache(self):
+        self.tar_scm_std()
+        self.scmlogs.next('maintain-cache')
+        self.tar_scm(['--maintain-cache'])
+        logpath  = self.scmlogs.current_log_path
+        loglines = self.scmlogs.read()
+        self._find(logpath, loglines, self.maintain_cache_command,
+                   self.initial_clone_command)
+
+    def test_prefetch(self):
+        self.tar_scm_std()
+        self.fixtures.create_commits(1)
+        self.scmlogs.next('prefetch')
+        (stdout, stderr, ret) = self.tar_scm(['--prefetch'])
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+        self.assertRegexpMatches(stdout, 'Prefetched ' +
+                                 re.escape(self.fixtures.repo_url))
+
+    def test_prefetch_daemon(self):
+        self.tar_scm_std()
+        sockname = os.path.join(self.test_dir, 'daemon.sock')
+        logname = os.path.join(self.test_dir, 'daemon.log')
+        log = open(logname, 'w')
+        daemon = subprocess.Popen(['python', self.tar_scm_bin(),
+                                   '--daemon', sockname],
+                                  stdout=log, stderr=subprocess.STDOUT)
+        try:
+            for i in range(100):
+                if os.path.exists(sockname):
+                    break
+                time.sleep(0.1)
+            os.putenv('TAR_SCM_DAEMON', sockname)
+            (stdout, stderr, ret) = self.tar_scm(['--prefetch'])
+            self.assertRegexpMatches(stdout, 'Prefetched ')
+        finally:
+            os.unsetenv('TAR_SCM_DAEMON')
+            daemon.terminate()
+            daemon.wait()
+            log.close()
+
+        # run by tar_scm itself
+        log = open(logname)
+        output = log.read()
+        log.close()
+        self.assertNotRegexpMatches(output, 'Job 1')
+
+    def test_prefetch_url(self):
+        self.scmlogs.next('prefetch')
+        self.tar_scm(['--prefetch', self.fixtures.repo_url, '--scm', self.scm])
+        self.assertRanInitialClone(self.scmlogs.current_log_path,
+                                   self.scmlogs.read())
+        self.assertEqual(os.listdir(os.path.join(self.cachedir, 'incoming')),
+                         [])
+
+        self.scmlogs.next()
+        self.tar_scm_std()
+        self.assertRanUpdate(self.scmlogs.current_log_path,
+                             self.scmlogs.read())
+        self.assertTarOnly(self.basename())
+
+    def _updates(self):
+        return [line for line in self.scmlogs.read()
+                if re.match(self.update_cache_command, line)]
+
+    def _read_until(self, proc, pattern):
+        while True:
+            line = proc.stderr.readline()
+            self.assertNotEqual(line, '', "tar_scm exited")
+            match = re.search(pattern, line)
+            if match:
+                return match
+
+    def test_prefetch_listen(self):
+        self.tar_scm_std()
+        self.scmlogs.next('prefetch-listen')
+        proc = subprocess.Popen(['python', self.tar_scm_bin(), '--scm',
+                                 self.scm, '--prefetch-listen', '0'],
+                                stderr=subprocess.PIPE)
+        try:
+            port = self._read_until(proc, 'Listening on 127.0.0.1:(\d+)')
+            url = 'http://127.0.0.1:%s/' % port.group(1)
+
+            self.fixtures.create_commits(1)
+            updates = len(self._updates())
+            payload = {'repository': {'url': self.fixtures.repo_url}}
+            reply = urllib2.urlopen(url, json.dumps(payload))
+            self.assertEqual(reply.getcode(), 202)
+            self._read_until(proc, 'Prefetched ')
+            self.assertTrue(len(self._updates()) > updates)
+
+            payload = {'repository': {'url': 'file:///nonexistent'}}
+            for request in [
+                    urllib2.Request(url, json.dumps(payload)),
+                    urllib2.Request(url + '?url=file:///nonexistent', '')]:
+                try:
+                    urllib2.urlopen(request)
+                    self.fail("uncached repository accepted")
+                except urllib2.HTTPError, e:
+                    self.assertEqual(e.code, 404)
+
+            for length, code in [('x', 400), ('%d' % (1 << 30), 413)]:
+                request = urllib2.Request(url, '{}',
+                                          {'Content-Length': length})
+                try:
+                    urllib2.urlopen(request)
+                    self.fail("Content-Length %s accepted" % length)
+                except urllib2.HTTPError, e:
+                    self.assertEqual(e.code, code)
+        finally:
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.wait()
+        self.assertEqual(proc.returncode, 0)
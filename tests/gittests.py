@@ -1,12 +1,19 @@
 #!/usr/bin/python
 
+import base64
 import datetime
+import hashlib
 import os
+import re
+import signal
+import socket
+import subprocess
 import tarfile
 
 from   githgtests  import GitHgTests
 from   gitfixtures import GitFixtures
-from   utils       import run_git
+from   lfsserver   import LfsServer
+from   utils       import mkfreshdir, run_git
 
 class GitTests(GitHgTests):
 
@@ -18,7 +25,8 @@ class GitTests(GitHgTests):
 
     scm = 'git'
     initial_clone_command = 'git clone'
-    update_cache_command  = 'git fetch'
+    update_cache_command  = r'git (-c \S+ )*fetch'
+    maintain_cache_command = 'git repack'
     fixtures_class = GitFixtures
 
     abbrev_hash_format = '%h'
@@ -93,6 +101,28 @@ class GitTests(GitHgTests):
         th = tarfile.open(os.path.join(self.outdir , self.basename(version = 'tag3')+'.tar'))
         self.assertTarMemberContains(th ,os.path.join(self.basename(version = 'tag3'),submod_name,'a'),'5')
 
+    def test_submodule_update_unchanged(self):
+        submod_name = 'submod1'
+
+        self._submodule_fixture(submod_name)
+
+        for tag, expected, updated in [('tag3', '5', True),
+                                       ('tag3', '5', False),
+                                       ('tag4', '3', True)]:
+            self.scmlogs.next()
+            self.tar_scm_std('--submodules', 'enable', '--revision', tag,
+                             '--version', tag)
+            loglines = ''.join(self.scmlogs.read())
+            if updated:
+                self.assertRegexpMatches(loglines, r'git (-c \S+ )*submodule update')
+            else:
+                self.assertNotRegexpMatches(loglines, r'git (-c \S+ )*submodule update')
+            th = tarfile.open(os.path.join(
+                self.outdir, self.basename(version = tag) + '.tar'))
+            self.assertTarMemberContains(th, os.path.join(
+                self.basename(version = tag), submod_name, 'a'), expected)
+            self.postRun()
+
     def test_submodule_disabled_update(self):
         submod_name = 'submod1'
 
@@ -104,3 +134,275 @@ class GitTests(GitHgTests):
                                        self.basename(version = 'tag3')+'.tar'))
         self.assertRaises(KeyError, th.getmember, os.path.join(
             self.basename(version = 'tag3'), submod_name, 'a'))
+
+    def test_submodule_targeted_fetch(self):
+        submod_name = 'submod1'
+
+        self._submodule_fixture(submod_name)
+
+        self.tar_scm_std('--submodules', 'enable', '--targeted-fetch',
+                         'enable', '--revision', 'tag3', '--version', 'tag3')
+        th = tarfile.open(os.path.join(self.outdir,
+                                       self.basename(version = 'tag3')+'.tar'))
+        self.assertTarMemberContains(th, os.path.join(
+            self.basename(version = 'tag3'), submod_name, 'a'), '5')
+
+    def _cached_refs(self):
+        repodir = os.path.join(self.cachedir, 'repo')
+        for name in os.listdir(repodir):
+            if os.path.isdir(os.path.join(repodir, name)):
+                os.chdir(os.path.join(repodir, name, 'repo'))
+        refs = run_git("for-each-ref --format='%(refname)'")[0].split()
+        os.chdir(self.pkgdir)
+        return refs
+
+    def test_targeted_fetch(self):
+        self.fixtures.create_commits(1)
+        os.chdir(self.fixtures.repo_path)
+        self.fixtures.safe_run('branch other')
+        sha1 = self.fixtures.safe_run('rev-parse tag2')[0].strip()
+        os.chdir(self.pkgdir)
+
+        self.tar_scm_std('--targeted-fetch', 'enable', '--version', '1.0')
+        self.assertTarOnly(self.basename(version = '1.0'))
+        self.assertEqual(self._cached_refs(),
+                         ['refs/heads/master', 'refs/remotes/origin/master'])
+        self.postRun()
+
+        self.scmlogs.next()
+        self.tar_scm_std('--targeted-fetch', 'enable', '--version', '1.0',
+                         '--revision', self.rev(2))
+        self.assertRegexpMatches(''.join(self.scmlogs.read()),
+                                 'git -c gc.auto=0 fetch --update-head-ok '
+                                 '--no-tags origin '
+                                 r'\+refs/tags/tag2:refs/tags/tag2')
+        th = self.assertTarOnly(self.basename(version = '1.0'))
+        self.assertTarMemberContains(th, self.basename(version = '1.0') +
+                                     '/a', '2')
+        self.assertFalse('refs/remotes/origin/other' in self._cached_refs())
+        self.postRun()
+
+        # the commit is known already
+        self.scmlogs.next()
+        self.tar_scm_std('--targeted-fetch', 'enable', '--version', '1.0',
+                         '--revision', sha1)
+        self.assertNotRegexpMatches(''.join(self.scmlogs.read()),
+                                    self.update_cache_command)
+        th = self.assertTarOnly(self.basename(version = '1.0'))
+        self.assertTarMemberContains(th, self.basename(version = '1.0') +
+                                     '/a', '2')
+
+    def test_targeted_fetch_outputs(self):
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        self.tar_scm_std('--targeted-fetch', 'enable', '--version', '1.0',
+                         '--output', 'revision=tag2,filename=old',
+                         '--output', 'revision=master,filename=new')
+        fetches = [line for line in self.scmlogs.read()
+                   if re.search(self.update_cache_command, line)]
+        self.assertEqual(len(fetches), 1)
+        self.assertTrue('+refs/tags/tag2:refs/tags/tag2' in fetches[0])
+        self.assertTrue('+refs/heads/master:refs/remotes/origin/master'
+                        in fetches[0])
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ['new-1.0.tar', 'old-1.0.tar'])
+
+    def test_targeted_fetch_tags(self):
+        # tag3 is on another branch
+        os.chdir(self.fixtures.repo_path)
+        self.fixtures.safe_run('checkout -b other')
+        self.fixtures.create_commits(1)
+        self.fixtures.safe_run('checkout master')
+        os.chdir(self.pkgdir)
+
+        self.tar_scm_std('--targeted-fetch', 'enable', '--version', '1.0',
+                         '--changesgenerate', 'enable',
+                         '--changesauthor', 'test@example.com')
+        refs = self._cached_refs()
+        self.assertTrue('refs/tags/tag2' in refs)
+        self.assertFalse('refs/tags/tag3' in refs)
+        self.assertFalse('refs/remotes/origin/other' in refs)
+
+    def test_targeted_fetch_changes_other_branch(self):
+        # the last changes revision is only on another branch
+        os.chdir(self.fixtures.repo_path)
+        self.fixtures.safe_run('checkout -b other')
+        self.fixtures.create_commits(1)
+        self.fixtures.safe_run('checkout master')
+        os.chdir(self.pkgdir)
+        self._changesgenerate('--targeted-fetch', 'enable',
+                              '--revision', 'other')
+        self.postRun()
+
+        mkfreshdir(os.path.join(self.cachedir, 'repo'))
+        self.fixtures.create_commits(1)
+        os.chdir(self.pkgdir)
+        changes = self._changesgenerate('--targeted-fetch', 'enable')
+        self.assertRegexpMatches(changes, ':\n \+ 4\n\n')
+
+    def test_targeted_fetch_changes_force_pushed(self):
+        self._changesgenerate('--targeted-fetch', 'enable')
+        self.postRun()
+
+        # the last changes revision is gone from the remote
+        os.chdir(self.fixtures.repo_path)
+        sha = self.fixtures.safe_run('rev-parse HEAD')[0].strip()
+        self.fixtures.safe_run('reset --hard HEAD~1')
+        self.fixtures.safe_run('tag -d tag2')
+        os.unlink(os.path.join('.git', 'objects', sha[:2], sha[2:]))
+        self.fixtures.create_commits(1)
+        mkfreshdir(os.path.join(self.cachedir, 'repo'))
+        os.chdir(self.pkgdir)
+        (stdout, stderr, ret) = self.tar_scm_std(
+            '--changesgenerate', 'enable', '--targeted-fetch', 'enable',
+            '--changesauthor', 'test@example.com', '--version', '1.0',
+            outdir_files={'pkg.changes': '- Initial version\n'})
+        self.assertRegexpMatches(stdout, 'No such commit')
+        f = open(os.path.join(self.outdir, 'pkg.changes'))
+        self.assertEqual(f.read(), '- Initial version\n')
+        f.close()
+
+    def test_probe_remote_commitish(self):
+        self.tar_scm_std('--probe-remote', 'enable', '--revision', 'master~1',
+                         '--version', '1.0')
+        self.assertTarOnly(self.basename(version='1.0'))
+
+    def test_fetch_no_auto_gc(self):
+        self.tar_scm_std()
+        self.postRun()
+
+        # clones cached by older versions have auto-gc enabled
+        repodir = os.path.join(self.cachedir, 'repo')
+        for name in os.listdir(repodir):
+            if os.path.isdir(os.path.join(repodir, name)):
+                os.chdir(os.path.join(repodir, name, 'repo'))
+                run_git('config --unset gc.auto')
+        os.chdir(self.pkgdir)
+
+        self.scmlogs.next()
+        self.tar_scm_std()
+        loglines = self.scmlogs.read()
+        self.assertTrue(loglines)
+        for line in loglines:
+            if ' fetch' in line:
+                self.assertRegexpMatches(line, '^git -c gc.auto=0 ')
+
+    def _lfs_fixture(self, contents, lfsconfig):
+        fix = self.fixtures
+        os.chdir(fix.repo_path)
+        if lfsconfig:
+            f = open('.lfsconfig', 'w')
+            f.write(lfsconfig)
+            f.close()
+        f = open('large.bin', 'w')
+        f.write('version https://git-lfs.github.com/spec/v1\n'
+                'oid sha256:%s\nsize %d\n' %
+                (hashlib.sha256(contents).hexdigest(), len(contents)))
+        f.close()
+        fix.safe_run('add .')
+        fix.safe_run('commit -m lfs')
+        os.chdir(self.pkgdir)
+
+    def test_terminate_cleanup(self):
+        # a server accepting the connection but never answering
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        server.settimeout(60)
+        self.disableCache()
+        mkfreshdir(self.outdir)
+        proc = subprocess.Popen(
+            ['python', self.tar_scm_bin(), '--scm', 'git', '--url',
+             'http://127.0.0.1:%d/repo.git' % server.getsockname()[1],
+             '--outdir', self.outdir])
+        try:
+            conn = server.accept()[0]
+            self.assertNotEqual(os.listdir(self.outdir), [])
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.wait()
+            # git was terminated as well, closing the connection
+            conn.settimeout(10)
+            while conn.recv(4096):
+                pass
+            conn.close()
+        finally:
+            server.close()
+        self.assertEqual(proc.returncode, 128 + signal.SIGTERM)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+    def test_lfs(self):
+        contents = 'large file contents ' * 1000
+        oid = hashlib.sha256(contents).hexdigest()
+        server = LfsServer({ oid : contents })
+        try:
+            self._lfs_fixture(contents, '[lfs]\n\turl = %s\n' % server.url)
+            basename = self.basename(version = '1.0')
+
+            tarpath = os.path.join(self.outdir, basename + '.tar')
+
+            self.tar_scm_std('--lfs', 'enable', '--version', '1.0')
+            th = tarfile.open(tarpath)
+            self.assertTarMemberContains(th, basename + '/large.bin',
+                                         contents)
+            self.assertEqual(server.downloads, [ oid ])
+            self.postRun()
+
+            # the cached object is reused
+            self.tar_scm_std('--lfs', 'enable', '--version', '1.0')
+            th = tarfile.open(tarpath)
+            self.assertTarMemberContains(th, basename + '/large.bin',
+                                         contents)
+            self.assertEqual(server.downloads, [ oid ])
+        finally:
+            server.stop()
+
+    def test_lfs_outputs(self):
+        contents = 'large file contents'
+        oid = hashlib.sha256(contents).hexdigest()
+        server = LfsServer({ oid : contents })
+        try:
+            self._lfs_fixture(contents, '[lfs]\n\turl = %s\n' % server.url)
+            os.chdir(self.fixtures.repo_path)
+            lfs_rev = self.fixtures.safe_run('rev-parse HEAD')[0].strip()
+            self.fixtures.safe_run('rm -q .lfsconfig large.bin')
+            self.fixtures.safe_run('commit -m nolfs')
+            os.chdir(self.pkgdir)
+
+            # the .lfsconfig of the exported revision is used
+            self.tar_scm_std('--lfs', 'enable', '--version', '1.0',
+                             '--output', 'revision=%s,filename=old' % lfs_rev,
+                             '--output', 'revision=master,filename=new')
+            th = tarfile.open(os.path.join(self.outdir, 'old-1.0.tar'))
+            self.assertTarMemberContains(th, 'old-1.0/large.bin', contents)
+            self.assertEqual(server.downloads, [ oid ])
+        finally:
+            server.stop()
+
+    def test_lfs_credentials(self):
+        contents = 'large file contents'
+        oid = hashlib.sha256(contents).hexdigest()
+        server = LfsServer({ oid : contents },
+                           'Basic ' + base64.b64encode('user:secret'))
+        os.putenv('GIT_CONFIG_PARAMETERS',
+                  "'credential.helper=!f() { echo username=user; "
+                  "echo password=secret; }; f'")
+        try:
+            self._lfs_fixture(contents, '[lfs]\n\turl = %s\n' % server.url)
+            self.tar_scm_std('--lfs', 'enable')
+            self.assertEqual(server.downloads, [ oid ])
+        finally:
+            os.unsetenv('GIT_CONFIG_PARAMETERS')
+            server.stop()
+
+    def test_lfs_missing_object(self):
+        server = LfsServer({ })
+        try:
+            self._lfs_fixture('missing', '[lfs]\n\turl = %s\n' % server.url)
+            (stdout, stderr, ret) = self.tar_scm_std_fail('--lfs', 'enable')
+            self.assertRegexpMatches(stdout, 'Object not found')
+            self.postRun()
+
+            # excluded pointers are not resolved
+            self.tar_scm_std('--lfs', 'enable', '--exclude', '*/large.bin')
+        finally:
+            server.stop()
@@ -15,8 +15,9 @@ class HgTests(GitHgTests):
     """
 
     scm = 'hg'
-    initial_clone_command = 'hg clone'
+    initial_clone_command = 'hg clone -U'
     update_cache_command  = 'hg pull'
+    maintain_cache_command = 'hg verify'
     fixtures_class = HgFixtures
 
     abbrev_hash_format = '{node|short}'
@@ -46,3 +47,12 @@ class HgTests(GitHgTests):
         repo_url = self.fixtures.repo_url + '/'
         args = ['--url', repo_url, '--scm', self.scm]
         self.tar_scm(args)
+
+    def test_pull_revision(self):
+        rev = self.sha1s(self.rev(2))
+        self.tar_scm_std('--revision', rev)
+        self.scmlogs.next('pull-revision')
+        self.fixtures.create_commits(2)
+        self.tar_scm_std('--revision', rev)
+        self.assertRegexpMatches(''.join(self.scmlogs.read()),
+                                 '(^|\n)hg pull -r %s' % rev)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import json
+import threading
+
+
+class LfsServer:
+
+    """Minimal Git LFS server for the tests.
+
+    It implements the download part of the batch API for a fixed set
+    of objects and records which objects were downloaded.
+    """
+
+    def __init__(self, objects, authorization=None):
+        self.objects = objects
+        self.authorization = authorization
+        self.downloads = []
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.headers.get('Authorization') != server.authorization:
+                    self.reply(401, '', 'text/plain')
+                    return
+                length = int(self.headers['Content-Length'])
+                request = json.loads(self.rfile.read(length))
+                response = { 'transfer' : 'basic', 'objects' : [] }
+                for obj in request['objects']:
+                    entry = { 'oid' : obj['oid'], 'size' : obj['size'] }
+                    if obj['oid'] in server.objects:
+                        entry['actions'] = { 'download' : {
+                            'href' : server.url + '/objects/' + obj['oid'] } }
+                    else:
+                        entry['error'] = { 'code' : 404,
+                                           'message' : 'Object not found' }
+                    response['objects'].append(entry)
+                self.reply(200, json.dumps(response),
+                           'application/vnd.git-lfs+json')
+
+            def do_GET(self):
+                oid = self.path.split('/')[-1]
+                if oid not in server.objects:
+                    self.reply(404, '', 'text/plain')
+                    return
+                server.downloads.append(oid)
+                self.reply(200, server.objects[oid],
+                           'application/octet-stream')
+
+            def reply(self, code, data, content_type):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Compare the throughput of the tar writers on a generated tree.
+# See TESTING.md for more information.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tar_scm import create_tar
+
+CHUNK = 1024 * 1024
+
+
+def populate(srcdir, size, files):
+    '''Create files with random contents adding up to size bytes.'''
+    per_file = size // files
+    for i in range(files):
+        subdir = os.path.join(srcdir, 'dir%02d' % (i % 16))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        f = open(os.path.join(subdir, 'file%04d' % i), 'wb')
+        left = per_file
+        while left > 0:
+            f.write(os.urandom(min(CHUNK, left)))
+            left -= CHUNK
+        f.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tar writer benchmark')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='total size of the tree in MiB')
+    parser.add_argument('--files', type=int, default=32,
+                        help='number of files in the tree')
+    parser.add_argument('--keep',
+                        help='directory to keep the generated tree in')
+    args = parser.parse_args()
+
+    basedir = args.keep or tempfile.mkdtemp(prefix='tarbench-')
+    srcdir = os.path.join(basedir, 'bench-1.0')
+    outdir = os.path.join(basedir, 'out')
+    if not os.path.isdir(srcdir):
+        print("Creating %d MiB in %d files below %s" %
+              (args.size, args.files, srcdir))
+        os.makedirs(srcdir)
+        populate(srcdir, args.size * CHUNK, args.files)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    try:
+        for writer in ('tarfile', 'fast'):
+            cwd = os.getcwd()
+            start = time.time()
+            create_tar(srcdir, outdir, writer, writer=writer)
+            elapsed = time.time() - start
+            os.chdir(cwd)
+            os.unlink(os.path.join(outdir, writer + '.tar'))
+            print("%-8s %7.2fs %8.1f MiB/s" %
+                  (writer, elapsed, args.size / max(elapsed, 0.001)))
+    finally:
+        if not args.keep:
+            shutil.rmtree(basedir)
@@ -134,9 +134,13 @@ class TestEnvironment:
     def stdargs(self, *args):
         return [ '--url', self.fixtures.repo_url, '--scm', self.scm ] + list(args)
 
-    def tar_scm(self, args, should_succeed=True):
+    def tar_scm(self, args, should_succeed=True, outdir_files={}):
         # simulate new temporary outdir for each tar_scm invocation
         mkfreshdir(self.outdir)
+        for filename, contents in outdir_files.items():
+            f = open(os.path.join(self.outdir, filename), 'w')
+            f.write(contents)
+            f.close()
         cmdargs = args + [ '--outdir', self.outdir ]
         quotedargs = [ "'%s'" % arg for arg in cmdargs ]
         cmdstr = 'python %s %s 2>&1' % (self.tar_scm_bin(), " ".join(quotedargs))
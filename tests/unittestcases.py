@@ -2,9 +2,33 @@
 
 import unittest
 import sys
+import fcntl
+import hashlib
 import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from tar_scm import _calc_dir_to_clone_to
+from tar_scm import _calc_dir_to_clone_to, _common_subdir, _mkdtemp, \
+    _parse_commit_date, _release_tempdir, _svn_sparse_dirs, GitLfs, \
+    OutputFile, Pipeline, ServiceData, TEMPDIR_FDS, check_failures, \
+    clear_failures, create_tar, is_daemon_job, lock_cache, record_failure, \
+    rewrite_url, run_lines
+from testenv import TestEnvironment
+from utils import mkfreshdir
+
+# Seconds importing tar_scm may add to the interpreter startup
+STARTUP_BUDGET = 0.1
+# Files in the tree archived by test_tar_writer_memory, which only runs if
+# $TAR_SCM_TEST_SLOW is set
+RSS_TREE_FILES = 1000 * 1000
+# Files in the single directory archived by test_tar_writer_memory_flat
+RSS_FLAT_FILES = 50 * 1000
+# KiB the fast tar writer may add to the peak RSS when archiving them
+RSS_BUDGET = 32 * 1024
 
 class UnitTestCases(unittest.TestCase):
 
@@ -26,3 +50,436 @@ class UnitTestCases(unittest.TestCase):
 
         clone_dir = _calc_dir_to_clone_to(scm, 'http://remote/repo/.git;param?query#fragment', outdir)
         self.assertEqual(clone_dir, os.path.join(outdir, 'repo'))
+
+    def test_rewrite_url(self):
+        rules = [
+            ('https://github.com/', 'https://mirror/github/'),
+            (r're:^git://git\.kernel\.org/pub/scm/(.*)\.git$',
+             r'https://mirror/kernel/\1'),
+        ]
+        self.assertEqual(rewrite_url('https://github.com/foo/bar.git', rules),
+                         'https://mirror/github/foo/bar.git')
+        self.assertEqual(
+            rewrite_url('git://git.kernel.org/pub/scm/git/git.git', rules),
+            'https://mirror/kernel/git/git')
+        self.assertEqual(rewrite_url('https://gitlab.com/foo/bar', rules),
+                         None)
+
+    def test_is_daemon_job(self):
+        self.assertTrue(is_daemon_job(['--url', 'u', '--scm', 'git']))
+        self.assertTrue(is_daemon_job(['--exclude', 'a', '--version=--']))
+        for argv in [['--daemon', 'sock'], ['--prefetch'],
+                     ['--prefetch-listen', '8080'], ['--prefetch-l=8080'],
+                     ['--maintain-cache'], ['--scm', 'git', '--maint']]:
+            self.assertFalse(is_daemon_job(argv))
+
+    def test_servicedata(self):
+        srcdir = os.path.join(TestEnvironment.tmp_dir, 'servicedata', 'src')
+        outdir = os.path.join(TestEnvironment.tmp_dir, 'servicedata', 'out')
+        mkfreshdir(srcdir)
+        mkfreshdir(outdir)
+        f = open(os.path.join(srcdir, '_servicedata'), 'w')
+        f.write('<servicedata>\n'
+                '  <!-- keep me -->\n'
+                '  <service name="tar_scm">\n'
+                '    <param name="url">url1</param>\n'
+                '    <param name="changesrevision">rev1</param>\n'
+                '  </service>\n'
+                '</servicedata>\n')
+        f.close()
+
+        servicedata = ServiceData(srcdir)
+        self.assertEqual(servicedata.get_revision('url1'), 'rev1')
+        self.assertEqual(servicedata.get_revision('url2'), None)
+        servicedata.set_revision('url1', 'rev2')
+        servicedata.set_revision('url2', 'rev3')
+        servicedata.write(outdir)
+        self.assertEqual(os.listdir(outdir), ['_servicedata'])
+
+        servicedata = ServiceData(outdir)
+        self.assertEqual(servicedata.get_revision('url1'), 'rev2')
+        self.assertEqual(servicedata.get_revision('url2'), 'rev3')
+
+    def test_common_subdir(self):
+        self.assertEqual(_common_subdir(['']), '')
+        self.assertEqual(_common_subdir(['/doc/', 'doc']), 'doc')
+        self.assertEqual(_common_subdir(['src/a', 'src/b/c']), 'src')
+        self.assertEqual(_common_subdir(['src', 'srcx']), '')
+        self.assertEqual(_common_subdir(['src/a', '']), '')
+
+    def test_svn_sparse_dirs(self):
+        clone_dir = os.path.join(TestEnvironment.tmp_dir, 'sparse')
+        mkfreshdir(clone_dir)
+        for d in ('.svn', 'doc', 'src', 'tests'):
+            os.mkdir(os.path.join(clone_dir, d))
+        open(os.path.join(clone_dir, 'README'), 'w').close()
+
+        self.assertEqual(_svn_sparse_dirs(clone_dir, []), None)
+        self.assertEqual(_svn_sparse_dirs(clone_dir, ['*']), None)
+        self.assertEqual(_svn_sparse_dirs(clone_dir, ['pkg-1.0']), [])
+        self.assertEqual(
+            sorted(_svn_sparse_dirs(clone_dir, ['*/src*', 'pkg-1.0/doc'])),
+            ['doc', 'src'])
+
+    def test_tar_writer_fast(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'tarwriter')
+        srcdir = os.path.join(basedir, 'pkg-1.0')
+        mkfreshdir(basedir)
+        os.makedirs(os.path.join(srcdir, 'sub', 'dir'))
+        os.mkdir(os.path.join(srcdir, '.git'))
+        open(os.path.join(srcdir, '.git', 'HEAD'), 'w').close()
+        open(os.path.join(srcdir, 'empty'), 'w').close()
+        f = open(os.path.join(srcdir, 'sub', 'big'), 'wb')
+        f.write(os.urandom(1024 * 1024 + 17))
+        f.close()
+        f = open(os.path.join(srcdir, 'sub', 'dir', 'small'), 'w')
+        f.write('small file\n')
+        f.close()
+        os.symlink('sub/dir/small', os.path.join(srcdir, 'link'))
+        os.link(os.path.join(srcdir, 'sub', 'big'),
+                os.path.join(srcdir, 'sub', 'dir', 'big'))
+
+        members = {}
+        for writer in ('tarfile', 'fast'):
+            create_tar(srcdir, basedir, writer, writer=writer,
+                       exclude=['*/empty'])
+            tar = tarfile.open(os.path.join(basedir, writer + '.tar'))
+            members[writer] = {}
+            for info in tar.getmembers():
+                # tarfile walks directories unsorted, so which copy of
+                # a hardlinked file comes first differs between writers
+                data = linkname = None
+                if info.isfile() or info.islnk():
+                    data = tar.extractfile(info).read()
+                elif info.issym():
+                    linkname = info.linkname
+                members[writer][info.name] = (info.isdir(), info.mode,
+                                              info.mtime, info.uid,
+                                              linkname, data)
+            tar.close()
+
+        self.assertEqual(members['fast'], members['tarfile'])
+        self.assertTrue('pkg-1.0/link' in members['fast'])
+        self.assertFalse('pkg-1.0/empty' in members['fast'])
+        self.assertFalse('pkg-1.0/.git' in members['fast'])
+
+    def test_run_lines_stderr(self):
+        # more errors than fit into a pipe, written before any output
+        script = ('import sys; sys.stderr.write("warning\\n" * 100000); '
+                  'print "a"; print "b"; sys.exit(1)')
+        lines = []
+        try:
+            for line in run_lines([sys.executable, '-c', script], None):
+                lines.append(line)
+            self.fail("failure not reported")
+        except SystemExit, e:
+            self.assertTrue('warning' in str(e.code))
+        self.assertEqual(lines, ['a', 'b'])
+
+    def test_output_file(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'outputfile')
+        mkfreshdir(basedir)
+        dst = os.path.join(basedir, 'pkg.changes')
+        open(dst, 'w').write('old\n')
+
+        for durability in ('none', 'file', 'dir'):
+            old = open(dst).read()
+            OutputFile.durability = durability
+            try:
+                output = OutputFile(dst)
+                output.write('new\n')
+                self.assertEqual(open(dst).read(), old)
+                output.abort()
+                self.assertEqual(os.listdir(basedir), ['pkg.changes'])
+
+                output = OutputFile(dst)
+                output.write(durability + '\n')
+                output.commit()
+                output.abort()
+            finally:
+                OutputFile.durability = 'none'
+            self.assertEqual(os.listdir(basedir), ['pkg.changes'])
+            self.assertEqual(open(dst).read(), durability + '\n')
+
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0666 & ~umask)
+
+    def test_locks_not_inherited(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'locks')
+        mkfreshdir(os.path.join(basedir, 'repo'))
+        lock_fp = lock_cache(basedir, 'hash')
+        tmpdir = _mkdtemp(basedir, 'tar_scm')
+        try:
+            for fd in [lock_fp.fileno(), TEMPDIR_FDS[tmpdir]]:
+                self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) &
+                                fcntl.FD_CLOEXEC)
+        finally:
+            _release_tempdir(tmpdir)
+            lock_fp.close()
+
+    def test_failures(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'failures')
+        mkfreshdir(basedir)
+        failfile = os.path.join(basedir, 'repo.failed')
+
+        check_failures(failfile, [None, 'v1'], 60)
+        record_failure(failfile, [None, 'v1'], 'unreachable')
+        record_failure(failfile, ['v2'], 'No such revision')
+        for revision in (None, 'v1', 'v2'):
+            self.assertRaises(SystemExit, check_failures, failfile,
+                              [revision], 60)
+        check_failures(failfile, ['v3'], 60)
+        check_failures(failfile, [None], 0)
+
+        clear_failures(failfile, [None, 'v1'])
+        check_failures(failfile, [None, 'v1'], 60)
+        self.assertRaises(SystemExit, check_failures, failfile, ['v2'], 60)
+        clear_failures(failfile, ['v2'])
+        self.assertEqual(os.listdir(basedir), ['repo.failed.lock'])
+
+    def test_failures_concurrent(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'failures')
+        mkfreshdir(basedir)
+        failfile = os.path.join(basedir, 'repo.failed')
+
+        threads = [threading.Thread(target=record_failure,
+                                    args=(failfile, ['v%d' % i], 'failed'))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(20):
+            self.assertRaises(SystemExit, check_failures, failfile,
+                              ['v%d' % i], 60)
+
+    def test_pipeline(self):
+        def wait(value):
+            time.sleep(0.2)
+            return value
+
+        def fail():
+            sys.exit('failed')
+
+        pipeline = Pipeline(2)
+        start = time.time()
+        first = pipeline.add('first', wait, args=(1,))
+        second = pipeline.add('second', wait, args=(2,))
+        total = pipeline.add('total', lambda x, y: x + y,
+                             inputs=[first, second])
+        self.assertEqual(total.get(), 3)
+        self.assertTrue(time.time() - start < 0.35)
+        self.assertEqual(sorted([name for name, elapsed in pipeline.timings]),
+                         ['first', 'second', 'total'])
+
+        failed = pipeline.add('fail', fail)
+        after = pipeline.add('after', wait, args=(3,), after=[failed])
+        self.assertRaises(SystemExit, after.get)
+
+    def test_pipeline_cancel(self):
+        done = []
+
+        def record(value):
+            time.sleep(0.2)
+            done.append(value)
+
+        def fail():
+            sys.exit('failed')
+
+        pipeline = Pipeline(2)
+        running = pipeline.add('running', record, args=(1,))
+        failed = pipeline.add('fail', fail)
+        pipeline.add('pending', record, args=(2,), after=[running])
+        self.assertRaises(SystemExit, failed.get)
+        pipeline.cancel()
+        # the running step is waited for, the pending one never runs
+        self.assertEqual(done, [1])
+        time.sleep(0.3)
+        self.assertEqual(done, [1])
+
+    def _create_files(self, dirpath, count):
+        mkfreshdir(dirpath)
+        for i in range(count):
+            f = open(os.path.join(dirpath, 'file%06d' % i), 'w')
+            f.write('%d\n' % i)
+            f.close()
+
+    def _tar_writer_rss(self, srcdir):
+        code = (
+            'import os, resource\n'
+            'from tar_scm import write_tar\n'
+            'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+            'write_tar(%r, "pkg-1.0", os.devnull, lambda name: False)\n'
+            'after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+            'print(after - before)\n' % srcdir)
+        proc = subprocess.Popen([sys.executable, '-c', code],
+                                cwd=os.path.dirname(
+                                    TestEnvironment.tar_scm_bin()),
+                                stdout=subprocess.PIPE)
+        try:
+            growth = int(proc.communicate()[0])
+        finally:
+            shutil.rmtree(srcdir)
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(growth < RSS_BUDGET,
+                        "peak RSS grew by %d KiB" % growth)
+
+    @unittest.skipUnless(os.getenv('TAR_SCM_TEST_SLOW'),
+                         'takes minutes, set TAR_SCM_TEST_SLOW to run')
+    def test_tar_writer_memory(self):
+        srcdir = os.path.join(TestEnvironment.tmp_dir, 'manyfiles')
+        mkfreshdir(srcdir)
+        for i in range(RSS_TREE_FILES // 1000):
+            self._create_files(os.path.join(srcdir, 'dir%03d' % i), 1000)
+        self._tar_writer_rss(srcdir)
+
+    def test_tar_writer_memory_flat(self):
+        # the names of a directory are kept while it's walked
+        srcdir = os.path.join(TestEnvironment.tmp_dir, 'flat')
+        self._create_files(srcdir, RSS_FLAT_FILES)
+        self._tar_writer_rss(srcdir)
+
+    def test_tar_dedupe(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'dedupe')
+        srcdir = os.path.join(basedir, 'pkg-1.0')
+        mkfreshdir(basedir)
+        os.makedirs(os.path.join(srcdir, 'vendor'))
+        same = 'same\n' * 1024
+        contents = {
+            'a': same,
+            'vendor/a': same,
+            'b': 'diff\n' * 1024,
+            'script': same,
+            'small1': 'small\n',
+            'small2': 'small\n',
+            'empty1': '',
+            'empty2': '',
+        }
+        for name, data in contents.items():
+            f = open(os.path.join(srcdir, name), 'w')
+            f.write(data)
+            f.close()
+        os.chmod(os.path.join(srcdir, 'script'), 0755)
+
+        create_tar(srcdir, basedir, 'pkg-1.0', dedupe=True)
+        tar = tarfile.open(os.path.join(basedir, 'pkg-1.0.tar'))
+        links = {}
+        for info in tar.getmembers():
+            name = info.name[len('pkg-1.0/'):]
+            if info.islnk():
+                links[name] = info.linkname
+            if name in contents:
+                self.assertEqual(tar.extractfile(info).read(), contents[name])
+        tar.close()
+
+        self.assertEqual(links, {'vendor/a': 'pkg-1.0/a'})
+
+    def _python_time(self, code):
+        '''Return the fastest of several runs of a python process.'''
+        srcdir = os.path.dirname(TestEnvironment.tar_scm_bin())
+        times = []
+        for i in range(5):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code], cwd=srcdir)
+            times.append(time.time() - start)
+        return min(times)
+
+    def test_lazy_imports(self):
+        srcdir = os.path.dirname(TestEnvironment.tar_scm_bin())
+        proc = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, tar_scm; '
+             'print " ".join(sorted(sys.modules))'],
+            cwd=srcdir, stdout=subprocess.PIPE)
+        modules = proc.communicate()[0].split()
+        for module in ['argparse', 'ConfigParser', 'hashlib', 'json',
+                       'multiprocessing', 'socket', 'subprocess', 'tarfile',
+                       'tempfile', 'urlparse']:
+            self.assertFalse(module in modules,
+                             '%s imported at startup' % module)
+
+    def test_startup_time(self):
+        interpreter = self._python_time('pass')
+        startup = self._python_time('import tar_scm')
+        self.assertTrue(startup - interpreter < STARTUP_BUDGET,
+                        'importing tar_scm took %.3fs' %
+                        (startup - interpreter))
+
+    def _read_cpio(self, path):
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        members = {}
+        offset = 0
+        while True:
+            self.assertEqual(data[offset:offset + 6], '070701')
+            fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16)
+                      for i in range(13)]
+            mode, size, namesize = fields[1], fields[6], fields[11]
+            offset += 110
+            name = data[offset:offset + namesize - 1]
+            offset += namesize + (-(110 + namesize) % 4)
+            if name == 'TRAILER!!!':
+                break
+            members[name] = (mode, data[offset:offset + size])
+            offset += size + (-size % 4)
+        self.assertEqual(len(data) % 512, 0)
+        return members
+
+    def test_obscpio(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'obscpio')
+        srcdir = os.path.join(basedir, 'pkg-1.0')
+        mkfreshdir(basedir)
+        os.makedirs(os.path.join(srcdir, 'sub'))
+        f = open(os.path.join(srcdir, 'sub', 'file'), 'w')
+        f.write('contents\n')
+        f.close()
+        os.link(os.path.join(srcdir, 'sub', 'file'),
+                os.path.join(srcdir, 'link'))
+        os.symlink('sub/file', os.path.join(srcdir, 'symlink'))
+
+        create_tar(srcdir, basedir, 'pkg-1.0', extension='obscpio',
+                   archive_format='obscpio')
+        members = self._read_cpio(os.path.join(basedir, 'pkg-1.0.obscpio'))
+        self.assertEqual(sorted(members), ['pkg-1.0', 'pkg-1.0/link',
+                                           'pkg-1.0/sub', 'pkg-1.0/sub/file',
+                                           'pkg-1.0/symlink'])
+        self.assertEqual(members['pkg-1.0/link'][1], 'contents\n')
+        self.assertEqual(members['pkg-1.0/sub/file'][1], 'contents\n')
+        self.assertEqual(members['pkg-1.0/symlink'][1], 'sub/file')
+        self.assertTrue(stat.S_ISDIR(members['pkg-1.0/sub'][0]))
+        self.assertTrue(stat.S_ISLNK(members['pkg-1.0/symlink'][0]))
+
+    def test_obscpio_lfs(self):
+        basedir = os.path.join(TestEnvironment.tmp_dir, 'obscpio_lfs')
+        srcdir = os.path.join(basedir, 'pkg-1.0')
+        mkfreshdir(basedir)
+        os.makedirs(srcdir)
+        contents = 'large file contents\n'
+        oid = hashlib.sha256(contents).hexdigest()
+        lfs = GitLfs(srcdir, 'file:///nonexistent',
+                     os.path.join(basedir, 'lfs'))
+        os.makedirs(os.path.dirname(lfs.object_path(oid)))
+        f = open(lfs.object_path(oid), 'w')
+        f.write(contents)
+        f.close()
+        f = open(os.path.join(srcdir, 'large.bin'), 'w')
+        f.write('version https://git-lfs.github.com/spec/v1\n'
+                'oid sha256:%s\nsize %d\n' % (oid, len(contents)))
+        f.close()
+        os.link(os.path.join(srcdir, 'large.bin'),
+                os.path.join(srcdir, 'link.bin'))
+
+        create_tar(srcdir, basedir, 'pkg-1.0', extension='obscpio',
+                   lfs=lfs, archive_format='obscpio')
+        members = self._read_cpio(os.path.join(basedir, 'pkg-1.0.obscpio'))
+        self.assertEqual(members['pkg-1.0/large.bin'][1], contents)
+        self.assertEqual(members['pkg-1.0/link.bin'][1], contents)
+
+    def test_parse_commit_date(self):
+        self.assertEqual(_parse_commit_date('2014-09-09 18:37:39 +0200 '
+                                            '(Tue, 09 Sep 2014)'),
+                         1410280659)
+        self.assertEqual(_parse_commit_date('2014-09-09 14:07:39 -0230'),
+                         1410280659)
+        self.assertEqual(_parse_commit_date('yesterday'), None)